@@ -16,6 +16,8 @@ FASTQ=${FASTQ}                                        # 是否从fastq文件开
 CTRL=${CTRL}                                          # 是否为对照组样本
 STRUCT=${STRUCT}                                      # 是否使用RNAStructure进行结构预测
 CHUNK_SIZE=${CHUNK_SIZE}                              # 每个任务的分析区间大小
+STATS_ONLY=${STATS_ONLY}                              # 对照组样本是否只记录统计数据 (不进行EM聚类)
+CTRL_STORE=${CTRL_STORE}                              # 对照组统计数据文件 (由DREEM_Submit.sh设置)
 # -------------------------------------------------------------------
 if [ -z "$REF_NAME" ]; then
   echo "[error] REF_NAME not set!"
@@ -52,7 +54,8 @@ RESULTS_DIR=../results_${CUR_DATE}_${DATA_NAME}/results_${CUR_DATE}_${DATA_NAME}
 LOG_DIR=../logs/${CUR_DATE}_${DATA_NAME}_${TASK_START}_${TASK_END}/
 # -------------------------------------------------------------------
 if [ "$FASTQ" = "yes" ]; then
-    FASTQ_FLAG="--fastq"
+    # All the array tasks share one alignment of the sample
+    FASTQ_FLAG="--fastq --shared_dir ../results_${CUR_DATE}_${DATA_NAME}/shared/"
 else
     FASTQ_FLAG=""
 fi
@@ -66,18 +69,24 @@ if [ "$STRUCT" = "yes" ]; then
 else
     STRUCT_FLAG=""
 fi
+if [ "$STATS_ONLY" = "yes" ]; then
+    CTRL_FLAG="$CTRL_FLAG --stats_only"
+fi
+if [ -n "$CTRL_STORE" ]; then
+    CTRL_FLAG="$CTRL_FLAG --ctrl_store $CTRL_STORE"
+fi
 # -------------------------------------------------------------------
 cd $WORK_DIR
 mkdir -p "$LOG_DIR"
+if [ -n "$CTRL_STORE" ] && [ "$CTRL" = "yes" ]; then
+    mkdir -p "$(dirname "$CTRL_STORE")"
+fi
 cd /sibcb1/hanshuolab1/wangziyuan/DREEM/data/$DATA_NAME
-if [ "$FASTQ" = "yes" ]; then
-    if [ -f "$REF_FILE" ]; then
-        bowtie2-build "$REF_FILE" "$REF_NAME"
-        echo "[INFO] Bowtie2 index builded for $REF_FILE" >> "${WORK_DIR%code/}${LOG_DIR#../}${CUR_DATE}_${DATA_NAME}_${TASK_START}_${TASK_END}.log"
-    else
-        echo "[error] Reference file $REF_FILE not found!"
-        exit 1
-    fi
+# The Bowtie2 index is built by Mapping.py, once, and checked against the
+# checksum of $REF_FILE by every task
+if [ "$FASTQ" = "yes" ] && [ ! -f "$REF_FILE" ]; then
+    echo "[error] Reference file $REF_FILE not found!"
+    exit 1
 fi
 cd $WORK_DIR
 
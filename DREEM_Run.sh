@@ -14,6 +14,7 @@ DATA_NAME=MTS_s4U_APDF20_0906_rep1                            # 分析样本的
 FASTQ=no                                             # 是否从fastq文件开始进行分析
 CTRL=no                                              # 是否为对照组样本
 STRUCT=yes                                             # 是否使用RNAStructure进行结构预测
+CTRL_STORE=                                            # 对照组统计数据文件 (实验组样本必填, 对照组默认为 ../${DATA_NAME}_control_stats.bin)
 # -------------------------------------------------------------------
 WORK_DIR=/sibcb1/hanshuolab1/wangziyuan/DREEM/code/
 CUR_DATE=$(date +%Y%m%d)
@@ -36,18 +37,18 @@ if [ "$STRUCT" = "yes" ]; then
 else
     STRUCT_FLAG=""
 fi
+if [ -n "$CTRL_STORE" ]; then
+    CTRL_FLAG="$CTRL_FLAG --ctrl_store $CTRL_STORE"
+fi
 # -------------------------------------------------------------------
 cd $WORK_DIR
 mkdir -p "$LOG_DIR"
 cd /sibcb1/hanshuolab1/wangziyuan/DREEM/data/$DATA_NAME
-if [ "$FASTQ" = "yes" ]; then
-    if [ -f "$REF_FILE" ]; then
-        bowtie2-build "$REF_FILE" "$REF_NAME"
-        echo "[INFO] Bowtie2 index builded for $REF_FILE" >> "${WORK_DIR%code/}${LOG_DIR#../}${CUR_DATE}_${DATA_NAME}_${POS_START}_${POS_END}.log"
-    else
-        echo "[error] Reference file $REF_FILE not found!"
-        exit 1
-    fi
+# The Bowtie2 index is built by Mapping.py, once, and checked against the
+# checksum of $REF_FILE by every task
+if [ "$FASTQ" = "yes" ] && [ ! -f "$REF_FILE" ]; then
+    echo "[error] Reference file $REF_FILE not found!"
+    exit 1
 fi
 cd $WORK_DIR
 echo "[INFO] Current working directory: $WORK_DIR"
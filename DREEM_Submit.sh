@@ -8,6 +8,7 @@ DATA_NAME=MTS_s4U_APDF20_0906_rep1                            # 分析样本的
 FASTQ=no                                             # 是否从fastq文件开始进行分析
 CTRL=no                                              # 是否为对照组样本
 STRUCT=yes                                             # 是否使用RNAStructure进行结构预测
+CTRL_NAME=                                             # 对照组样本的名称 (CTRL=no时, 先自动提交对照组统计任务)
 # -------------------------------------------------------------------
 CHUNK_SIZE=100                                        # 每个任务的分析区间大小
 # -------------------------------------------------------------------
@@ -18,9 +19,25 @@ CUR_DATE=$(date +%Y%m%d)
 QSUB_LOG_DIR=/sibcb1/hanshuolab1/wangziyuan/qsub_logs/DREEM/${CUR_DATE}_${DATA_NAME}_${POS_START}_${POS_END}/
 mkdir -p "$QSUB_LOG_DIR"
 # -------------------------------------------------------------------
+# 对照组统计任务: 实验组的每个区间任务只在对应的对照组区间任务完成后才开始 (-hold_jid_ad)
+# 对照组统计数据文件在提交时确定, 两个任务组使用同一路径 (与任务开始的日期无关)
+HOLD_FLAG=""
+CTRL_STORE=""
+if [ -n "$CTRL_NAME" ] && [ "$CTRL" = "no" ]; then
+    CTRL_STORE=../results_${CUR_DATE}_${CTRL_NAME}/${CTRL_NAME}_control_stats.bin
+    CTRL_JOB_ID=$(qsub -terse -q b1.q \
+        -l hostname=fnode006 \
+        -wd $QSUB_LOG_DIR \
+        -t 1:$NUM_TASKS \
+        -v REF_NAME="$REF_NAME",POS_START="$POS_START",POS_END="$POS_END",DATA_NAME="$CTRL_NAME",FASTQ="$FASTQ",CTRL="yes",STATS_ONLY="yes",STRUCT="$STRUCT",CHUNK_SIZE="$CHUNK_SIZE",CTRL_STORE="$CTRL_STORE" \
+        DREEM_Parallel_Run.sh | cut -d. -f1)
+    HOLD_FLAG="-hold_jid_ad $CTRL_JOB_ID"
+fi
+# -------------------------------------------------------------------
 qsub -q b1.q \
     -l hostname=fnode006 \
     -wd $QSUB_LOG_DIR \
     -t 1:$NUM_TASKS \
-    -v REF_NAME="$REF_NAME",POS_START="$POS_START",POS_END="$POS_END",DATA_NAME="$DATA_NAME",FASTQ="$FASTQ",CTRL="$CTRL",STRUCT="$STRUCT",CHUNK_SIZE="$CHUNK_SIZE" \
+    $HOLD_FLAG \
+    -v REF_NAME="$REF_NAME",POS_START="$POS_START",POS_END="$POS_END",DATA_NAME="$DATA_NAME",FASTQ="$FASTQ",CTRL="$CTRL",STRUCT="$STRUCT",CHUNK_SIZE="$CHUNK_SIZE",CTRL_STORE="$CTRL_STORE" \
     DREEM_Parallel_Run.sh
\ No newline at end of file
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+# Copyright (c) <2019> <The Whitehead Institute for Biomedical Research>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Benchmark of the Bit Vector stage on synthetic data.
+
+A deterministic generator writes paired- or single-end SAM files (and BAM
+files, with samtools or pysam) with a configurable mix of read length,
+mismatch/deletion/insertion/soft-clip rates, base qualities, mate overlap
+and duplicates. Process_SamFile is then timed end to end, and per sub-stage
+in a second, instrumented pass:
+parse (Mate), convert (Convert_Read), combine (Combine_Mates),
+accumulate (Plotting_Variables) and write (BitVector_Sink.add).
+Each pass runs in its own process so that its peak RSS can be reported.
+The parsing of the records (split, Mate and Parse_CIGAR) is also timed
+alone, against the parser Bit Vector used to have (legacy_us_per_record).
+
+Usage: python Bench_BitVector.py [--n_reads 20000] [--single] [--out res.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+bases = 'ACGT'
+# Optional fields of a Bowtie2 record, before and after MD:Z (the values
+# do not matter to Bit Vector)
+bt2_tags = ['AS:i:-6', 'XS:i:-20', 'XN:i:0', 'XM:i:1', 'XO:i:0', 'XG:i:0',
+            'NM:i:1', 'YS:i:-3', 'YT:Z:CP']
+
+
+def Make_Ref(ref_len, seed):
+    """
+    Random reference sequence
+    """
+    rng = random.Random(seed)
+    return ''.join(rng.choice(bases) for i in range(ref_len))
+
+
+def Qual_Char(rng, low_qual):
+    """
+    Phred+33 symbol of a base quality: 2-19 for a fraction low_qual of the
+    bases, 30-40 otherwise
+    """
+    if rng.random() < low_qual:
+        return chr(rng.randint(2, 19) + 33)
+    return chr(rng.randint(30, 40) + 33)
+
+
+def Make_Read(rng, ref_seq, pos, params):
+    """
+    A read aligned at pos (1-based) with its CIGAR string, sequence,
+    qualities and MD tag. Indels are only placed between matched bases.
+    """
+    read_len = params['read_len']
+    ops, seq, qual, md = [], [], [], []
+
+    def Add_Op(op, length):
+        if ops and ops[-1][0] == op:
+            ops[-1][1] += length
+        else:
+            ops.append([op, length])
+
+    clip5 = rng.randint(1, 10) if rng.random() < params['clip_rate'] else 0
+    clip3 = rng.randint(1, 10) if rng.random() < params['clip_rate'] else 0
+    for k in range(clip5):  # Soft clipped bases at 5' end
+        seq.append(rng.choice(bases))
+        qual.append(Qual_Char(rng, params['low_qual']))
+    if clip5:
+        Add_Op('S', clip5)
+
+    i = pos - 1  # 0-based index in ref
+    n_aligned, md_run = 0, 0
+    aligned_len = read_len - clip5 - clip3
+    while n_aligned < aligned_len:
+        room = aligned_len - n_aligned  # Read bases left to align
+        indel_ok = ops and ops[-1][0] == 'M' and room > 5
+        if indel_ok and rng.random() < params['del_rate']:
+            length = rng.randint(1, 3)
+            md.append(str(md_run) + '^' + ref_seq[i:i + length])
+            md_run = 0
+            Add_Op('D', length)
+            i += length
+            continue
+        if indel_ok and rng.random() < params['ins_rate']:
+            length = rng.randint(1, 3)
+            for k in range(length):
+                seq.append(rng.choice(bases))
+                qual.append(Qual_Char(rng, params['low_qual']))
+            Add_Op('I', length)
+            n_aligned += length
+            continue
+        ref_base = ref_seq[i]
+        if rng.random() < params['mut_rate']:  # Mismatch
+            seq.append(rng.choice([b for b in bases if b != ref_base]))
+            md.append(str(md_run) + ref_base)
+            md_run = 0
+        else:
+            seq.append(ref_base)
+            md_run += 1
+        qual.append(Qual_Char(rng, params['low_qual']))
+        Add_Op('M', 1)
+        n_aligned += 1
+        i += 1
+    md.append(str(md_run))
+
+    for k in range(clip3):  # Soft clipped bases at 3' end
+        seq.append(rng.choice(bases))
+        qual.append(Qual_Char(rng, params['low_qual']))
+    if clip3:
+        Add_Op('S', clip3)
+
+    cigar = ''.join(str(length) + op for (op, length) in ops)
+    return cigar, ''.join(seq), ''.join(qual), ''.join(md), i - pos + 1
+
+
+def Make_SamFile(sam_file, ref, ref_seq, n_reads, paired, params, seed):
+    """
+    Write a SAM file of n_reads reads (read pairs if paired). The mates of
+    a pair are on consecutive lines, like the Bowtie2 output.
+    """
+    rng = random.Random(seed)
+    read_len = params['read_len']
+    max_pos = len(ref_seq) - 2 * read_len - 40  # Room for mates and dels
+    sam_fileobj = open(sam_file, 'w')
+    sam_fileobj.write('@HD\tVN:1.0\tSO:unsorted\n')
+    sam_fileobj.write('@SQ\tSN:{}\tLN:{}\n'.format(ref, len(ref_seq)))
+    sam_fileobj.write('@PG\tID:Bench_BitVector\n')
+    records = None
+    for n in range(n_reads):
+        q_name = 'read{}'.format(n)
+        if records is None or rng.random() >= params['dup_frac']:
+            pos1 = rng.randint(1, max_pos)
+            read1 = Make_Read(rng, ref_seq, pos1, params)
+            if paired:
+                shift = int(read_len * (1 - params['overlap'])) + \
+                    rng.randint(-5, 5)
+                pos2 = pos1 + max(0, shift)
+                read2 = Make_Read(rng, ref_seq, pos2, params)
+                records = [(pos1, read1, pos2, '99'),
+                           (pos2, read2, pos1, '147')]
+            else:
+                records = [(pos1, read1, 0, '0')]
+        # else: duplicate of the previous read, with a new name
+        for pos, read, pnext, flag in records:
+            cigar, seq, qual, md, span = read
+            if paired:
+                rnext, tlen = '=', str(abs(pnext - pos) + span)
+            else:
+                rnext, tlen = '*', '0'
+            sam_fileobj.write('\t'.join([
+                q_name, flag, ref, str(pos), '42', cigar, rnext, str(pnext),
+                tlen, seq, qual] + bt2_tags[:-2] + ['MD:Z:' + md] +
+                (bt2_tags[-2:] if paired else ['YT:Z:UU'])) + '\n')
+    sam_fileobj.close()
+
+
+def Make_BamFile(sam_file, bam_file):
+    """
+    Convert a SAM file to BAM with samtools or pysam. Returns False if
+    neither is available.
+    """
+    if shutil.which('samtools'):
+        subprocess.check_call(['samtools', 'view', '-b', '-o', bam_file,
+                               sam_file])
+        return True
+    try:
+        import pysam
+    except ImportError:
+        return False
+    with pysam.AlignmentFile(sam_file, 'r') as infile:
+        with pysam.AlignmentFile(bam_file, 'wb', template=infile) as outfile:
+            for read in infile:
+                outfile.write(read)
+    return True
+
+
+def Timed(func, stage, stage_times):
+    """
+    Wrap func to add its run time to stage_times[stage]
+    """
+    def Timed_Func(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stage_times[stage] += time.perf_counter() - start_time
+    return Timed_Func
+
+
+def Run_Pass(sam_file, ref_seq, ref, start, end, paired, bv_file, keep,
+             instrument):
+    """
+    Run Process_SamFile once. Runs in a child process.
+    """
+    import BitVector
+    import BitVector_Functions
+
+    stage_times = {'parse': 0.0, 'convert': 0.0, 'combine': 0.0,
+                   'accumulate': 0.0, 'write': 0.0}
+    if instrument:  # Time the sub-stages
+        BitVector_Functions.Mate = Timed(BitVector_Functions.Mate, 'parse',
+                                         stage_times)
+        BitVector.Convert_Read = Timed(BitVector.Convert_Read, 'convert',
+                                       stage_times)
+        BitVector.Combine_Mates = Timed(BitVector.Combine_Mates, 'combine',
+                                        stage_times)
+        BitVector.Plotting_Variables = Timed(BitVector.Plotting_Variables,
+                                             'accumulate', stage_times)
+        BitVector_Functions.BitVector_Sink.add = Timed(
+            BitVector_Functions.BitVector_Sink.add, 'write', stage_times)
+
+    refs_seq = {ref: ref_seq}
+    phred_qscore = BitVector_Functions.Parse_PhredFile('phred_ascii.txt')
+    mod_bases, mut_bases, delmut_bases, info_bases, cov_bases, num_reads = \
+        BitVector.Init_Counters(refs_seq, start, end)
+    fileobj = open(bv_file, 'w') if bv_file else None
+    sinks = {ref: BitVector_Functions.BitVector_Sink(
+        fileobj, 'bench', ref, ref_seq[start - 1:end], start, end, keep)}
+
+    start_time = time.perf_counter()
+    BitVector.Process_SamFile(sam_file, paired, refs_seq, start, end,
+                              phred_qscore, 20, 10, cov_bases, info_bases,
+                              mod_bases, mut_bases, delmut_bases, num_reads,
+                              sinks)
+    sinks[ref].close()
+    seconds = time.perf_counter() - start_time
+
+    result = {'seconds': round(seconds, 4),
+              'reads_per_s': round(num_reads[ref] / seconds, 1),
+              'n_bitvectors': num_reads[ref],
+              'peak_rss_mb': round(resource.getrusage(
+                  resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+    if instrument:
+        # Accumulate includes write, which it calls
+        stage_times['accumulate'] -= stage_times['write']
+        stage_times['other'] = max(0.0, seconds - sum(stage_times.values()))
+        result['stages_s'] = {stage: round(secs, 4) for (stage, secs) in
+                              stage_times.items()}
+    return result
+
+
+class Legacy_Mate():
+    """
+    Mate as it used to be parsed, for the parse benchmark
+    """
+    def __init__(self, line_split):
+        self.QNAME = line_split[0]
+        self.FLAG = line_split[1]
+        self.RNAME = line_split[2]
+        self.POS = int(line_split[3])
+        self.MAPQ = int(line_split[4])
+        self.CIGAR = line_split[5]
+        self.RNEXT = line_split[6]
+        self.PNEXT = int(line_split[7])
+        self.TLEN = line_split[8]
+        self.SEQ = line_split[9]
+        self.QUAL = line_split[10]
+        self.MDSTRING = line_split[11].split(":")[2]
+
+
+def Legacy_Parse_CIGAR(cigar_string):
+    import re
+    ops = re.findall(r'(\d+)([A-Z]{1})', cigar_string)
+    return ops
+
+
+def Run_ParsePass(sam_file, repeats=3):
+    """
+    Time of the parsing of a record, current and legacy parser (best of
+    repeats). Runs in a child process.
+    """
+    import BitVector_Functions
+
+    with open(sam_file) as f:
+        lines = [line for line in f if not line.startswith('@')]
+
+    def Current():
+        for line in lines:
+            mate = BitVector_Functions.Mate(
+                BitVector_Functions.Split_Record(line))
+            BitVector_Functions.Parse_CIGAR(mate.CIGAR)
+
+    def Legacy():
+        for line in lines:
+            mate = Legacy_Mate(line.strip().split())
+            Legacy_Parse_CIGAR(mate.CIGAR)
+
+    result = {}
+    for name, func in (('us_per_record', Current),
+                       ('legacy_us_per_record', Legacy)):
+        best = None
+        for i in range(repeats):
+            start_time = time.perf_counter()
+            func()
+            seconds = time.perf_counter() - start_time
+            best = seconds if best is None else min(best, seconds)
+        result[name] = round(best / len(lines) * 1e6, 3)
+    result['speedup'] = round(result['legacy_us_per_record'] /
+                              result['us_per_record'], 2)
+    return result
+
+
+def Run_Child(args):
+    """
+    Run a pass in a fresh process and get its JSON result
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '--child',
+           json.dumps(args)]
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.check_output(cmd, cwd=code_dir)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the Bit ' +
+                                     'Vector stage on synthetic data')
+    parser.add_argument('--n_reads', type=int, default=20000,
+                        help='Number of reads (read pairs if paired)')
+    parser.add_argument('--single', action='store_true',
+                        help='Single-end reads')
+    parser.add_argument('--ref_len', type=int, default=2000)
+    parser.add_argument('--read_len', type=int, default=150)
+    parser.add_argument('--mut_rate', type=float, default=0.01,
+                        help='Mismatches per aligned base')
+    parser.add_argument('--del_rate', type=float, default=0.002,
+                        help='Deletions per aligned base')
+    parser.add_argument('--ins_rate', type=float, default=0.001,
+                        help='Insertions per aligned base')
+    parser.add_argument('--clip_rate', type=float, default=0.1,
+                        help='Fraction of reads soft clipped at each end')
+    parser.add_argument('--low_qual', type=float, default=0.05,
+                        help='Fraction of bases with Q < 20')
+    parser.add_argument('--overlap', type=float, default=0.3,
+                        help='Overlap of the mates, fraction of read length')
+    parser.add_argument('--dup_frac', type=float, default=0.1,
+                        help='Fraction of duplicate reads')
+    parser.add_argument('--start', type=int, default=1,
+                        help='Start of the region (1-based)')
+    parser.add_argument('--end', type=int, default=0,
+                        help='End of the region. Default: end of ref')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bam', action='store_true',
+                        help='Also write a BAM file (samtools or pysam)')
+    parser.add_argument('--no_write', action='store_true',
+                        help='Do not write the bit vector file')
+    parser.add_argument('--no_keep', action='store_true',
+                        help='Do not keep the bit vectors in memory')
+    parser.add_argument('--keep_files', help='Write the inputs to this dir')
+    parser.add_argument('--out', help='Write the JSON results to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:  # A timed pass
+        child_args = json.loads(args.child)
+        if 'parse_file' in child_args:
+            print(json.dumps(Run_ParsePass(child_args['parse_file'])))
+        else:
+            print(json.dumps(Run_Pass(**child_args)))
+        sys.exit(0)
+
+    params = {'read_len': args.read_len, 'mut_rate': args.mut_rate,
+              'del_rate': args.del_rate, 'ins_rate': args.ins_rate,
+              'clip_rate': args.clip_rate, 'low_qual': args.low_qual,
+              'overlap': args.overlap, 'dup_frac': args.dup_frac}
+    paired = not args.single
+    end = args.end if args.end else args.ref_len
+    ref = 'bench_ref'
+
+    work_dir = args.keep_files if args.keep_files else tempfile.mkdtemp()
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    try:
+        ref_seq = Make_Ref(args.ref_len, args.seed)
+        sam_file = os.path.join(work_dir, 'bench.sam')
+        start_time = time.perf_counter()
+        Make_SamFile(sam_file, ref, ref_seq, args.n_reads, paired, params,
+                     args.seed)
+        gen_seconds = time.perf_counter() - start_time
+        sam_bytes = os.path.getsize(sam_file)
+        bam_written = False
+        if args.bam:
+            bam_written = Make_BamFile(sam_file,
+                                       os.path.join(work_dir, 'bench.bam'))
+            if not bam_written:
+                print('[warning] Neither samtools nor pysam found: no BAM')
+
+        bv_file = '' if args.no_write else \
+            os.path.join(work_dir, 'bench_bitvectors.txt')
+        pass_args = {'sam_file': sam_file, 'ref_seq': ref_seq, 'ref': ref,
+                     'start': args.start, 'end': end, 'paired': paired,
+                     'bv_file': bv_file, 'keep': not args.no_keep}
+        end_to_end = Run_Child(dict(pass_args, instrument=False))
+        stages = Run_Child(dict(pass_args, instrument=True))
+        parse = Run_Child({'parse_file': sam_file})
+    finally:
+        if not args.keep_files:
+            shutil.rmtree(work_dir)
+
+    results = {'params': dict(params, n_reads=args.n_reads, paired=paired,
+                              ref_len=args.ref_len, start=args.start,
+                              end=end, seed=args.seed,
+                              write=not args.no_write,
+                              keep=not args.no_keep),
+               'sam_bytes': sam_bytes,
+               'generate_s': round(gen_seconds, 3),
+               'bam_written': bam_written,
+               'end_to_end': end_to_end,
+               'stages_s': stages['stages_s'],
+               'instrumented_s': stages['seconds'],
+               'parse': parse}
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    print(output)
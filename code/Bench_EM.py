@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+# Copyright (c) <2019> <The Whitehead Institute for Biomedical Research>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Ground-truth benchmark of the EM stage.
+
+A generator writes a bit vector file (same layout as the BitVector output)
+drawn from K planted mu profiles and proportions. As in the model behind
+the denominator of the EM, a read is drawn from cluster k with probability
+pi_k and only kept if no two of its mutations are closer than 4 bases
+(rejection sampling), so the planted pi are the real pi the EM estimates.
+Depth, width, coverage gaps, ambiguous bits and background noise are
+options.
+
+The runner loads the file like EM_Clustering, runs the EM for each K and
+reports wall time, iterations and peak memory, the correlation of the
+recovered mus with the planted ones, the pi error at the planted K and the
+K selected by the BIC test of EM_Clustering. It runs in a child process so
+that its peak RSS is its own.
+
+Usage: python Bench_EM.py [--K 2] [--N 20000] [--D 200] [--out res.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import itertools
+import subprocess
+import numpy as np
+import EM_Functions
+
+
+def Planted_Mus(rng, K, D, base_rate, n_reactive, reactive_range):
+    """
+    K mu profiles: a low background rate with n_reactive reactive
+    positions, partly shared between the clusters
+    """
+    mus = np.full((K, D), base_rate)
+    shared = rng.choice(D, n_reactive // 2, replace=False)
+    for k in range(K):
+        own = rng.choice(D, n_reactive - len(shared), replace=False)
+        reactive = np.concatenate([shared, own])
+        mus[k, reactive] = rng.uniform(reactive_range[0], reactive_range[1],
+                                       len(reactive))
+    return mus
+
+
+def Sample_Reads(rng, mus, pi, N, noise):
+    """
+    Draw N bit vectors (as a code matrix) and their clusters, keeping only
+    the reads with no two mutations closer than 4 bases
+    """
+    K, D = mus.shape
+    kept_bits, kept_labels, n_kept = [], [], 0
+    while n_kept < N:
+        n_draw = max(2 * (N - n_kept), 1000)
+        labels = rng.choice(K, n_draw, p=pi)
+        probs = 1 - (1 - mus[labels]) * (1 - noise)  # Background noise
+        bits = (rng.random_sample((n_draw, D)) < probs).astype(np.uint8)
+        valid = EM_Functions.is_distmuts_valid(bits)
+        kept_bits.append(bits[valid])
+        kept_labels.append(labels[valid])
+        n_kept += np.count_nonzero(valid)
+    codes = np.concatenate(kept_bits)[:N]
+    labels = np.concatenate(kept_labels)[:N]
+    return codes, labels
+
+
+def Add_Gaps(rng, codes, gap_frac, gap_max, ambig_rate):
+    """
+    Coverage gaps ('.') at one end of a fraction gap_frac of the reads,
+    up to gap_max of the width, and ambiguous bits ('?') at a rate
+    ambig_rate among the non-mutated ones
+    """
+    N, D = codes.shape
+    max_len = int(gap_max * D)
+    if max_len > 0:
+        gapped = np.flatnonzero(rng.random_sample(N) < gap_frac)
+        gap_lens = rng.randint(1, max_len + 1, len(gapped))
+        from_start = rng.random_sample(len(gapped)) < 0.5
+        for n, gap_len, start_gap in zip(gapped, gap_lens, from_start):
+            if start_gap:
+                codes[n, :gap_len] = EM_Functions.miss_code
+            else:
+                codes[n, D - gap_len:] = EM_Functions.miss_code
+    ambig = (rng.random_sample(codes.shape) < ambig_rate) & \
+        (codes == EM_Functions.nomut_code)
+    codes[ambig] = EM_Functions.ambig_code
+    return codes
+
+
+def Write_BitVectorFile(bv_file, ref_file, ref, seq, start, codes):
+    """
+    Write a code matrix in the layout of the BitVector output
+    """
+    D = codes.shape[1]
+    n_muts = np.count_nonzero(codes == EM_Functions.mut_code, axis=1)
+    with open(bv_file, 'w') as bv_fileobj:
+        bv_fileobj.write('@ref\t{};{}\t{}\n'.format(ref_file, ref, seq))
+        bv_fileobj.write('@coordinates:length\t{},{}:{}\n'.format(
+            start, start + D - 1, D))
+        bv_fileobj.write('Query_name\tBit_vector\tN_Mutations\n')
+        for n, bit_string in enumerate(EM_Functions.codes_to_bits(codes)):
+            bv_fileobj.write('read{}\t{}\t{}\n'.format(n, bit_string,
+                                                       float(n_muts[n])))
+
+
+def Match_Clusters(true_mus, true_pi, mu, real_pi, positions):
+    """
+    Pair the recovered clusters with the planted ones (best mean
+    correlation of the mus over the EM positions). Returns the correlation
+    of each pair and the largest pi error.
+    """
+    K = len(true_pi)
+    corrs = np.array([[np.corrcoef(true_mus[i, positions], mu[j])[0, 1]
+                       for j in range(K)] for i in range(K)])
+    corrs = np.nan_to_num(corrs)
+    best = max(itertools.permutations(range(K)),
+               key=lambda perm: sum(corrs[i, perm[i]] for i in range(K)))
+    mu_corrs = [float(corrs[i, best[i]]) for i in range(K)]
+    pi_error = max(abs(float(real_pi[best[i]]) - true_pi[i])
+                   for i in range(K))
+    return mu_corrs, pi_error
+
+
+def Run_Bench(bv_file, out_dir, truth_file, max_K, num_runs, min_its,
+              conv_cutoff, cpus, exc_AC, em_seed):
+    """
+    Load the bit vectors and run the EM for each K. Runs in a child process.
+    """
+    import EM_Files
+    from EM_Algorithm import Run_EM
+
+    with open(truth_file) as f:
+        truth = json.load(f)
+    true_mus, true_pi = np.array(truth['mus']), truth['pi']
+    true_K = len(true_pi)
+    np.random.seed(em_seed)
+
+    start_time = time.time()
+    X = EM_Files.Load_BitVectors(bv_file, 1.0, 0.005, exc_AC, out_dir,
+                                 'True', out_dir + 'bench_control_stats.bin',
+                                 true_mus.shape[1])
+    load_seconds = time.time() - start_time
+
+    results, BICs = {}, []
+    for K in range(1, max(max_K, true_K) + 1):
+        runs = 1 if K == 1 else num_runs  # Same as EM_Clustering
+        its = 10 if K == 1 else min_its
+        K_runs = []
+        for run in range(runs):
+            start_time = time.time()
+            log_like_list, mu, obs_pi, real_pi, resps, BIC = Run_EM(
+                X, K, its, conv_cutoff, cpus)
+            K_runs.append({'seconds': time.time() - start_time,
+                           'iterations': len(log_like_list),
+                           'log_like': float(log_like_list[-1]),
+                           'BIC': float(BIC), 'mu': mu, 'real_pi': real_pi})
+        best = max(K_runs, key=lambda K_run: K_run['log_like'])
+        BICs.append(best['BIC'])
+        results[K] = {'seconds': round(sum(r['seconds'] for r in K_runs), 3),
+                      'iterations': [r['iterations'] for r in K_runs],
+                      'best_log_like': round(best['log_like'], 3),
+                      'BIC': round(best['BIC'], 3)}
+        if K == true_K:
+            mu_corrs, pi_error = Match_Clusters(true_mus, true_pi,
+                                                best['mu'], best['real_pi'],
+                                                X.positions)
+            results[K]['mu_corr'] = [round(c, 4) for c in mu_corrs]
+            results[K]['pi_error'] = round(pi_error, 4)
+
+    # BIC test of EM_Clustering: stop at the first K with a larger BIC
+    selected_K = len(BICs)
+    for K in range(2, len(BICs) + 1):
+        if BICs[K - 1] > BICs[K - 2]:
+            selected_K = K - 1
+            break
+
+    return {'load_s': round(load_seconds, 3),
+            'n_bitvectors': int(X.n_bitvectors),
+            'n_unique_bitvectors': int(X.n_unique_bitvectors),
+            'n_discard': int(X.n_discard),
+            'n_positions_em': len(X.positions),
+            'em_s': round(sum(results[K]['seconds'] for K in results), 3),
+            'per_K': {str(K): results[K] for K in results},
+            'true_K': true_K,
+            'selected_K': selected_K,
+            'mu_corr': results[true_K]['mu_corr'],
+            'pi_error': results[true_K]['pi_error'],
+            'peak_rss_mb': round(resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ground-truth benchmark ' +
+                                     'of the EM stage')
+    parser.add_argument('--K', type=int, default=2,
+                        help='Number of planted clusters')
+    parser.add_argument('--pi', help='Planted proportions, comma separated.' +
+                        ' Default: equal')
+    parser.add_argument('--N', type=int, default=20000,
+                        help='Depth: number of bit vectors')
+    parser.add_argument('--D', type=int, default=200,
+                        help='Width: length of the window')
+    parser.add_argument('--base_rate', type=float, default=0.005,
+                        help='Background mu of the planted profiles')
+    parser.add_argument('--reactive', type=float, default=0.2,
+                        help='Fraction of reactive positions per cluster')
+    parser.add_argument('--reactive_min', type=float, default=0.03)
+    parser.add_argument('--reactive_max', type=float, default=0.2)
+    parser.add_argument('--gap_frac', type=float, default=0.1,
+                        help='Fraction of reads with a coverage gap')
+    parser.add_argument('--gap_max', type=float, default=0.3,
+                        help='Max gap length, fraction of the width')
+    parser.add_argument('--ambig_rate', type=float, default=0.005,
+                        help="Rate of ambiguous ('?') bits")
+    parser.add_argument('--noise', type=float, default=0.0,
+                        help='Mutation rate added to all clusters')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the generator')
+    parser.add_argument('--em_seed', type=int, default=0,
+                        help='Seed of the EM initialization')
+    parser.add_argument('--max_K', type=int, default=3)
+    parser.add_argument('--num_runs', type=int, default=3,
+                        help='EM runs per K (K > 1)')
+    parser.add_argument('--min_its', type=int, default=50,
+                        help='Min iterations per EM run (K > 1)')
+    parser.add_argument('--conv_cutoff', type=float, default=0.5)
+    parser.add_argument('--cpus', type=int, default=1)
+    parser.add_argument('--exc_AC', action='store_true',
+                        help='Exclude As and Cs, as in the pipeline')
+    parser.add_argument('--keep_files', help='Write the inputs to this dir')
+    parser.add_argument('--out', help='Write the JSON results to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:  # The timed run
+        print(json.dumps(Run_Bench(**json.loads(args.child))))
+        sys.exit(0)
+
+    rng = np.random.RandomState(args.seed)
+    pi = [float(p) for p in args.pi.split(',')] if args.pi else \
+        [1.0 / args.K] * args.K
+    if len(pi) != args.K:
+        parser.error('--pi needs K proportions')
+    pi = list(np.array(pi) / np.sum(pi))
+    mus = Planted_Mus(rng, args.K, args.D, args.base_rate,
+                      int(args.reactive * args.D),
+                      (args.reactive_min, args.reactive_max))
+    codes, labels = Sample_Reads(rng, mus, pi, args.N, args.noise)
+    codes = Add_Gaps(rng, codes, args.gap_frac, args.gap_max,
+                     args.ambig_rate)
+    seq = ''.join(rng.choice(list('ACGT'), args.D))
+
+    work_dir = args.keep_files if args.keep_files else tempfile.mkdtemp()
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    work_dir = os.path.join(work_dir, '')
+    try:
+        bv_file = work_dir + 'bench_ref1_1_{}_bitvectors.txt'.format(args.D)
+        Write_BitVectorFile(bv_file, 'bench', 'ref1', seq, 1, codes)
+        truth_file = work_dir + 'truth.json'
+        with open(truth_file, 'w') as f:
+            json.dump({'mus': mus.tolist(), 'pi': pi,
+                       'labels_count': np.bincount(
+                           labels, minlength=args.K).tolist()}, f)
+        child_args = {'bv_file': bv_file, 'out_dir': work_dir,
+                      'truth_file': truth_file, 'max_K': args.max_K,
+                      'num_runs': args.num_runs, 'min_its': args.min_its,
+                      'conv_cutoff': args.conv_cutoff, 'cpus': args.cpus,
+                      'exc_AC': str(args.exc_AC), 'em_seed': args.em_seed}
+        cmd = [sys.executable, os.path.abspath(__file__), '--child',
+               json.dumps(child_args)]
+        output = subprocess.check_output(
+            cmd, cwd=os.path.dirname(os.path.abspath(__file__)))
+        results = json.loads(output.decode().strip().splitlines()[-1])
+    finally:
+        if not args.keep_files:
+            shutil.rmtree(work_dir)
+
+    results['params'] = {key: value for (key, value) in vars(args).items()
+                         if key not in ('child', 'keep_files', 'out')}
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    print(output)
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+# Copyright (c) <2019> <The Whitehead Institute for Biomedical Research>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Peak memory benchmark of the BitVector and EM stages.
+
+Both stages run on synthetic inputs over a grid of depths (N, bit vectors)
+and window widths (D), each point in a fresh process:
+    bitvector: Process_SamFile on a SAM file of N read pairs, with the bit
+               vectors kept in memory as Run_DREEM does
+    em: Load_BitVectors on a bit vector file of N bit vectors with planted
+        clusters, then Run_EM for K = 1..max_K
+Each point is run twice. The first run gives the peak of the current RSS
+during the stage, sampled from /proc/self/statm by a thread, minus the RSS
+of the process before it started (libraries such as plotly are imported
+before that). The second run is under tracemalloc, whose peak
+is exact and does not depend on the allocator, so the scaling of each
+stage is fitted on it as mem ~ N^a * D^b. The top allocators are listed
+for the largest point.
+
+The results are checked against Bench_Memory_baseline.json: the run fails
+if an exponent grew by more than exponent_slack, or if the memory at a grid
+point is over the baseline * headroom + slack (rss_slack_mb for the RSS,
+traced_slack_mb for the traced peak).
+
+Usage: python Bench_Memory.py [--N 5000,10000,20000] [--D 100,200] [--update]
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import importlib
+import resource
+import tempfile
+import threading
+import subprocess
+import numpy as np
+import Bench_BitVector
+import Bench_EM
+
+code_dir = os.path.dirname(os.path.abspath(__file__))
+baseline_file = os.path.join(code_dir, 'Bench_Memory_baseline.json')
+headroom = 1.3  # Allowed growth of the memory at a grid point
+rss_slack_mb = 20.0  # Plus this, for the noise of the RSS
+traced_slack_mb = 1.0
+exponent_slack = 0.2  # Allowed growth of a scaling exponent
+min_fit_mb = 1.0  # Floor of the memories in the fit (log scale)
+read_len = 50
+stages = ['bitvector', 'em']
+sample_interval = 0.002  # Seconds between two samples of the RSS
+# Imported inside the EM stage, but not part of its memory
+preloaded = ['plotly.offline', 'plotly.graph_objs', 'scipy.optimize',
+             'scipy.special', 'scipy.stats', 'statsmodels.stats.multitest']
+
+
+def Peak_RSS_MB():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def Current_RSS_MB():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+
+
+class RSS_Sampler():
+    """
+    Peak of the current RSS above its value at start, sampled by a thread.
+    ru_maxrss is a high-water mark of the whole process: a stage that stays
+    under the peak of the imports before it would show no memory at all.
+    """
+    def __init__(self):
+        self.base_mb = self.peak_mb = Current_RSS_MB()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.Sample, daemon=True)
+        self.thread.start()
+
+    def Sample(self):
+        while not self.done.wait(sample_interval):
+            self.peak_mb = max(self.peak_mb, Current_RSS_MB())
+
+    def Peak_MB(self):
+        self.peak_mb = max(self.peak_mb, Current_RSS_MB())
+        return self.peak_mb - self.base_mb
+
+    def Stop(self):
+        self.done.set()
+        self.thread.join()
+        return self.Peak_MB()
+
+
+def Start_Trace(trace):
+    if trace:
+        import tracemalloc
+        tracemalloc.start()
+
+
+def Stop_Trace(trace, top, result):
+    """
+    Traced peak and top allocators (of the memory still held at the end
+    of the stage) into result
+    """
+    if not trace:
+        return
+    import tracemalloc
+    snapshot = tracemalloc.take_snapshot() if top else None
+    result['traced_peak_mb'] = round(
+        tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+    tracemalloc.stop()
+    if not top:
+        return
+    result['top_allocators'] = [
+        {'line': '{}:{}'.format(os.path.basename(stat.traceback[0].filename),
+                                stat.traceback[0].lineno),
+         'mb': round(stat.size / 2 ** 20, 3), 'count': stat.count}
+        for stat in snapshot.statistics('lineno')[:top]]
+
+
+def Run_BitVector(sam_file, ref_seq, D, trace, top):
+    """
+    Process_SamFile with the bit vectors kept in memory. Runs in a child
+    process.
+    """
+    import BitVector
+    import BitVector_Functions
+
+    ref = 'ref1'
+    refs_seq = {ref: ref_seq}
+    phred_qscore = BitVector_Functions.Parse_PhredFile('phred_ascii.txt')
+    sampler = RSS_Sampler()
+    Start_Trace(trace)
+    mod_bases, mut_bases, delmut_bases, info_bases, cov_bases, num_reads = \
+        BitVector.Init_Counters(refs_seq, 1, D)
+    sinks = {ref: BitVector_Functions.BitVector_Sink(
+        None, 'bench', ref, ref_seq[:D], 1, D, True)}
+    BitVector.Process_SamFile(sam_file, True, refs_seq, 1, D, phred_qscore,
+                              20, 10, cov_bases, info_bases, mod_bases,
+                              mut_bases, delmut_bases, num_reads, sinks)
+    sinks[ref].close()
+    result = {'mem_mb': round(sampler.Stop(), 1),
+              'peak_rss_mb': round(Peak_RSS_MB(), 1),
+              'n_bitvectors': num_reads[ref]}
+    Stop_Trace(trace, top, result)
+    return result
+
+
+def Run_EM(bv_file, out_dir, D, max_K, trace, top):
+    """
+    Load_BitVectors and a short EM run for each K, with the E-step blocks
+    of EM_Clustering. Runs in a child process.
+    """
+    import EM_Files
+    import EM_Plan
+    from EM_Algorithm import Run_EM
+    for module_name in preloaded:
+        importlib.import_module(module_name)
+
+    np.random.seed(0)
+    sampler = RSS_Sampler()
+    Start_Trace(trace)
+    X = EM_Files.Load_BitVectors(bv_file, 1.0, 0.005, 'False', out_dir,
+                                 'True', out_dir + 'bench_control_stats.bin',
+                                 D)
+    load_mb = sampler.Peak_MB()
+    N = X.BV_Matrix.shape[0]
+    for K in range(1, max_K + 1):  # Memory does not need convergence
+        Run_EM(X, K, 3, float('inf'), 1,
+               EM_Plan.Default_Rows(N, len(X.positions), K, 1))
+    result = {'mem_mb': round(sampler.Stop(), 1),
+              'load_mem_mb': round(load_mb, 1),
+              'peak_rss_mb': round(Peak_RSS_MB(), 1),
+              'n_bitvectors': int(X.n_bitvectors),
+              'n_unique_bitvectors': int(X.n_unique_bitvectors)}
+    Stop_Trace(trace, top, result)
+    return result
+
+
+def Run_Child(stage, args):
+    """
+    Run a stage in a fresh process and get its JSON result
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '--child',
+           json.dumps({'stage': stage, 'args': args})]
+    output = subprocess.check_output(cmd, cwd=code_dir,
+                                     stderr=subprocess.DEVNULL)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def Make_Inputs(work_dir, N, D, seed):
+    """
+    SAM file of N read pairs over a window of width D, and a bit vector
+    file of N bit vectors of width D with 2 planted clusters
+    """
+    ref_len = max(D, 2 * read_len + 60)
+    ref_seq = Bench_BitVector.Make_Ref(ref_len, seed)
+    params = {'read_len': read_len, 'mut_rate': 0.01, 'del_rate': 0.002,
+              'ins_rate': 0.001, 'clip_rate': 0.1, 'low_qual': 0.05,
+              'overlap': 0.3, 'dup_frac': 0.1}
+    sam_file = os.path.join(work_dir, 'bench_{}_{}.sam'.format(N, D))
+    Bench_BitVector.Make_SamFile(sam_file, 'ref1', ref_seq, N, True, params,
+                                 seed)
+
+    rng = np.random.RandomState(seed)
+    mus = Bench_EM.Planted_Mus(rng, 2, D, 0.005, int(0.2 * D), (0.03, 0.2))
+    codes, labels = Bench_EM.Sample_Reads(rng, mus, [0.5, 0.5], N, 0.0)
+    codes = Bench_EM.Add_Gaps(rng, codes, 0.1, 0.3, 0.005)
+    bv_file = os.path.join(work_dir, 'bench_ref1_1_{}_{}_bitvectors.txt'.
+                           format(D, N))
+    Bench_EM.Write_BitVectorFile(bv_file, 'bench', 'ref1', ref_seq[:D], 1,
+                                 codes)
+    return sam_file, ref_seq, bv_file
+
+
+def Fit_Scaling(points):
+    """
+    Least squares fit of log(mem) = c + a log(N) + b log(D).
+    Returns the exponents of N and D (None if D or N was not varied).
+    """
+    Ns = np.log([point['N'] for point in points])
+    Ds = np.log([point['D'] for point in points])
+    mems = np.log([max(point['traced_peak_mb'], min_fit_mb)
+                   for point in points])
+    cols = [np.ones(len(points))]
+    varied = [len(set(Ns)) > 1, len(set(Ds)) > 1]
+    cols += [values for (values, v) in zip((Ns, Ds), varied) if v]
+    coefs = list(np.linalg.lstsq(np.array(cols).T, mems, rcond=None)[0][1:])
+    exponents = [round(float(coefs.pop(0)), 3) if v else None
+                 for v in varied]
+    return {'exponent_N': exponents[0], 'exponent_D': exponents[1]}
+
+
+def Run_Bench(Ns, Ds, max_K, top, seed):
+    """
+    Memory of each stage at each grid point, and its scaling
+    """
+    results = {stage: {'points': []} for stage in stages}
+    work_dir = tempfile.mkdtemp()
+    try:
+        for N in Ns:
+            for D in Ds:
+                sam_file, ref_seq, bv_file = Make_Inputs(work_dir, N, D, seed)
+                last = (N, D) == (Ns[-1], Ds[-1])  # Largest point
+                child_args = {
+                    'bitvector': {'sam_file': sam_file, 'ref_seq': ref_seq,
+                                  'D': D},
+                    'em': {'bv_file': bv_file,
+                           'out_dir': os.path.join(work_dir, ''),
+                           'D': D, 'max_K': max_K}}
+                for stage in stages:
+                    point = Run_Child(stage, dict(child_args[stage],
+                                                  trace=False, top=0))
+                    traced = Run_Child(stage, dict(child_args[stage],
+                                                   trace=True,
+                                                   top=top if last else 0))
+                    point['traced_peak_mb'] = traced['traced_peak_mb']
+                    point.update({'N': N, 'D': D})
+                    results[stage]['points'].append(point)
+                    if 'top_allocators' in traced:
+                        results[stage]['top_allocators'] = \
+                            traced['top_allocators']
+                    print('{} N={} D={}: {} MB RSS, {} MB traced'.format(
+                        stage, N, D, point['mem_mb'],
+                        point['traced_peak_mb']))
+                os.remove(sam_file)
+                os.remove(bv_file)
+    finally:
+        shutil.rmtree(work_dir)
+    for stage in stages:
+        results[stage].update(Fit_Scaling(results[stage]['points']))
+    return results
+
+
+def Point_Key(point):
+    return 'N={},D={}'.format(point['N'], point['D'])
+
+
+def Check_Baseline(results, baseline):
+    """
+    Regressions of the results against the baseline
+    """
+    regressions = []
+    for stage in stages:
+        if stage not in baseline:
+            continue
+        for exponent in ('exponent_N', 'exponent_D'):
+            new, old = results[stage][exponent], baseline[stage][exponent]
+            if new is not None and old is not None and \
+                    new > old + exponent_slack:
+                regressions.append('{} {}: {} > {} + {}'.format(
+                    stage, exponent, new, old, exponent_slack))
+        for point in results[stage]['points']:
+            for mem, slack in (('mem_mb', rss_slack_mb),
+                               ('traced_peak_mb', traced_slack_mb)):
+                old = baseline[stage][mem].get(Point_Key(point))
+                if old is not None and point[mem] > old * headroom + slack:
+                    regressions.append('{} {} {}: {} > {} * {} + {}'.format(
+                        stage, Point_Key(point), mem, point[mem], old,
+                        headroom, slack))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Peak memory benchmark of ' +
+                                     'the BitVector and EM stages')
+    parser.add_argument('--N', default='5000,10000,20000',
+                        help='Depths (bit vectors), comma separated')
+    parser.add_argument('--D', default='100,200',
+                        help='Window widths, comma separated')
+    parser.add_argument('--max_K', type=int, default=2,
+                        help='EM runs for K = 1..max_K')
+    parser.add_argument('--top', type=int, default=10,
+                        help='Top allocators (tracemalloc) at the largest ' +
+                        'point, 0 to skip')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--update', action='store_true',
+                        help='Write a new baseline from this run')
+    parser.add_argument('--out', help='Write the JSON results to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:  # A measured stage
+        child = json.loads(args.child)
+        func = Run_BitVector if child['stage'] == 'bitvector' else Run_EM
+        print(json.dumps(func(**child['args'])))
+        sys.exit(0)
+
+    Ns = sorted(int(N) for N in args.N.split(','))
+    Ds = sorted(int(D) for D in args.D.split(','))
+    results = Run_Bench(Ns, Ds, args.max_K, args.top, args.seed)
+
+    if args.update:
+        baseline = {stage: {'exponent_N': results[stage]['exponent_N'],
+                            'exponent_D': results[stage]['exponent_D'],
+                            'mem_mb': {Point_Key(point): point['mem_mb']
+                                       for point in
+                                       results[stage]['points']},
+                            'traced_peak_mb': {
+                                Point_Key(point): point['traced_peak_mb']
+                                for point in results[stage]['points']}}
+                    for stage in stages}
+        with open(baseline_file, 'w') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+            f.write('\n')
+        print('Baseline written to', baseline_file)
+
+    regressions = []
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            regressions = Check_Baseline(results, json.load(f))
+    results['regressions'] = regressions
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+    if regressions:
+        print('[error] Memory regressions: ' + '; '.join(regressions))
+        sys.exit(1)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+# Copyright (c) <2019> <The Whitehead Institute for Biomedical Research>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Startup benchmark of the DREEM entry points.
+
+Runs each entry point on a small synthetic sample, in a fresh interpreter,
+and measures the time from launch to its first piece of real work:
+the first read parsed by BitVector.py and the first EM iteration of
+EM_Clustering.py. The process exits at that point, so only the startup
+cost (interpreter, imports, input parsing) is measured. The medians are
+checked against the budget in Bench_Startup_budget.json.
+
+Usage: python Bench_Startup.py [--repeats 5] [--update]
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+
+code_dir = os.path.dirname(os.path.abspath(__file__))
+budget_file = os.path.join(code_dir, 'Bench_Startup_budget.json')
+headroom = 2.5  # Budget = measured time * headroom, with --update
+
+# Run in the child interpreter: stop the entry point at its first event
+child_code = '''
+import os, sys, time, runpy, importlib
+script, module, func = sys.argv[1:4]
+sys.argv = [script] + sys.argv[4:]
+sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+mod = importlib.import_module(module)
+def First_Event(*args, **kwargs):
+    print('BENCH_EVENT', time.time(), flush=True)
+    os._exit(0)
+setattr(mod, func, First_Event)
+runpy.run_path(script, run_name='__main__')
+print('BENCH_NO_EVENT', flush=True)
+'''
+
+
+def Make_Inputs(work_dir, sample_name, ref_name, ref, start, end):
+    """
+    Small synthetic sample: FASTA, paired-end SAM and bit vector file
+    """
+    random.seed(0)
+    ref_len = 400
+    ref_seq = ''.join(random.choice('ACGT') for i in range(ref_len))
+    # BitVector.py truncates the bit vector files: separate output dirs
+    input_dir = os.path.join(work_dir, 'input') + '/'
+    bv_output_dir = os.path.join(work_dir, 'output_bv') + '/'
+    em_output_dir = os.path.join(work_dir, 'output_em') + '/'
+    map_dir = bv_output_dir + 'Mapping_Files/'
+    bv_dir = em_output_dir + 'BitVector_Files/'
+    for dir_name in (input_dir, map_dir, bv_dir):
+        os.makedirs(dir_name)
+    with open(input_dir + ref_name + '.fasta', 'w') as fasta_file:
+        fasta_file.write('>' + ref + '\n' + ref_seq + '\n')
+
+    base_name = map_dir + sample_name + '_' + ref_name
+    open(base_name + '.bam', 'w').close()  # SAM file is used
+    with open(base_name + '.sam', 'w') as sam_file:
+        sam_file.write('@HD\tVN:1.0\n@SQ\tSN:{}\tLN:{}\n'.format(ref, ref_len))
+        sam_file.write('@PG\tID:bench\n')
+        for i in range(200):
+            pos1 = random.randint(1, 150)
+            pos2 = pos1 + random.randint(0, 50)
+            for pos, other, flag in ((pos1, pos2, '99'), (pos2, pos1, '147')):
+                seq = ref_seq[pos - 1:pos + 99]
+                sam_file.write('\t'.join([
+                    'read' + str(i), flag, ref, str(pos), '40', '100M', '=',
+                    str(other), '0', seq, 'I' * 100, 'MD:Z:100']) + '\n')
+
+    # Bit vectors with mutations spaced by at least 4 positions
+    D = end - start + 1
+    bv_name = '{}{}_{}_{}_{}_bitvectors.txt'.format(bv_dir, sample_name, ref,
+                                                    start, end)
+    with open(bv_name, 'w') as bv_file:
+        bv_file.write('@ref\t{};{}\t{}\n'.format(ref_name, ref,
+                                                 ref_seq[start - 1:end]))
+        bv_file.write('@coordinates:length\t{},{}:{}\n'.format(start, end, D))
+        bv_file.write('Query_name\tBit_vector\tN_Mutations\n')
+        for i in range(2000):
+            bits = ['0'] * D
+            for j in range(0, D, 8):
+                if random.random() < 0.05:
+                    bits[j] = '1'
+            bv_file.write('read{}\t{}\t{}\n'.format(i, ''.join(bits),
+                                                     float(bits.count('1'))))
+    return input_dir, bv_output_dir, em_output_dir
+
+
+def Time_Entry(script, module, func, args):
+    """
+    Seconds from launch of the script to its first event
+    """
+    cmd = [sys.executable, '-c', child_code, script, module, func] + args
+    start_time = time.time()
+    output = subprocess.check_output(cmd, cwd=code_dir,
+                                     stderr=subprocess.DEVNULL)
+    for line in output.decode().splitlines():
+        if line.startswith('BENCH_EVENT'):
+            return float(line.split()[1]) - start_time
+    raise RuntimeError(script + ' finished without reaching its first event')
+
+
+def Run_Bench(repeats):
+    """
+    Median startup time of each entry point
+    """
+    sample_name, ref_name, ref, start, end = 'bench', 'benchref', 'ref1', \
+        101, 180
+    results = {}
+    for i in range(repeats):
+        with tempfile.TemporaryDirectory() as work_dir:
+            input_dir, bv_output_dir, em_output_dir = Make_Inputs(
+                work_dir, sample_name, ref_name, ref, start, end)
+            bv_args = [sample_name, ref_name, str(start), str(end), '10',
+                       './phred_ascii.txt', '20', input_dir, bv_output_dir,
+                       'True', './picard.jar', 'True']
+            em_args = [sample_name, ref_name, str(start), str(end), '10',
+                       '1.0', '0.5', '1', '1', '1', '10', 'True', '0.005',
+                       'False', input_dir, em_output_dir, 'True']
+            entries = [
+                ('BitVector.py', 'first_read', 'BitVector_Functions',
+                 'Mate', bv_args),
+                ('EM_Clustering.py', 'first_iteration', 'EM_Algorithm',
+                 'Exp_Step', em_args)]
+            for script, event, module, func, args in entries:
+                secs = Time_Entry(script, module, func, args)
+                results.setdefault(script, {'event': event, 'times': []})
+                results[script]['times'].append(round(secs, 3))
+    for script in results:
+        times = sorted(results[script]['times'])
+        results[script]['median_s'] = times[len(times) // 2]
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Startup time of the ' +
+                                     'DREEM entry points')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='Runs of each entry point')
+    parser.add_argument('--update', action='store_true',
+                        help='Write a new budget from this run')
+    args = parser.parse_args()
+
+    results = Run_Bench(args.repeats)
+
+    if args.update:
+        budget = {script: {'event': results[script]['event'],
+                           'budget_s': round(results[script]['median_s'] *
+                                             headroom, 2)}
+                  for script in results}
+        with open(budget_file, 'w') as f:
+            json.dump(budget, f, indent=4, sort_keys=True)
+            f.write('\n')
+        print('Budget written to', budget_file)
+
+    with open(budget_file) as f:
+        budget = json.load(f)
+    over_budget = []
+    for script in sorted(results):
+        results[script]['budget_s'] = budget[script]['budget_s']
+        if results[script]['median_s'] > budget[script]['budget_s']:
+            over_budget.append(script)
+    print(json.dumps(results, indent=4, sort_keys=True))
+
+    if over_budget:
+        print('[error] Over the startup budget: ' + ', '.join(over_budget))
+        sys.exit(1)
@@ -16,8 +16,10 @@ Created on Tue Jul 30 2019
 Step 1 of the DREEM pipeline: Conversion of reads to bit vectors.
 
 Output: Text file containing all the bit vectors. One bit vector is created
-per read pair. This and other files, such as read coverage and pop avg plots,
-are created in separate output subdirectories.
+per read pair. The bit vectors can also be kept in memory and handed to EM
+clustering directly (see Run_DREEM.py), the text file being optional then.
+This and other files, such as read coverage and pop avg plots, are created
+in separate output subdirectories.
 IMPORTANT: Assumption of SAME start and end coords for each seq in ref genome.
 
 Calls Bit_Vector_Functions.py and Bit_Vector_Outputs_New.py.
@@ -25,161 +27,323 @@ Calls Bit_Vector_Functions.py and Bit_Vector_Outputs_New.py.
 import os
 import argparse
 import time
+import shutil
+import itertools
+import subprocess
 import BitVector_Functions
+import BitVector_Pairing
 import BitVector_Outputs
-
-
-def Bit_Vectors():
+import BitVector_Metrics
+import DREEM_Profile
+import DREEM_Metrics
+import DREEM_Status
+
+# Symbols to represent a read as a bit vector
+miss_info, ambig_info = '.', '?'
+nomut_bit, del_bit = '0', '1'
+bases = ['A', 'T', 'G', 'C', 'N']
+status_every = 10000  # Reads between two progress updates
+
+
+def Bit_Vectors(sample_name, ref_name, refs_seq, start, end, SUR_BASES,
+                qscore_file, QSCORE_CUTOFF, input_dir, output_dir, paired,
+                picard_path, fastq, bv_files=True, keep=False,
+                sam_stream=None, collapse=False):
     """
     Create bit vectors for a sample based on the ref seq
+    Args:
+        refs_seq (dict): Sequences of the ref genomes in the file
+        fastq (bool): Mapping was run
+        bv_files (bool): Write the bit vector text files
+        keep (bool): Keep the bit vectors in memory
+        sam_stream (file): SAM lines straight from the aligner
+            (Mapping.Map_Stream), read instead of the BAM file
+        collapse (bool): The reads were collapsed (Mapping_Collapse), the
+            ';size=N' suffix of a query name is its number of reads
+    Returns:
+        sinks (dict): Bit vectors of each ref. Empty if already run.
     """
     start_time = time.time()
 
+    # Input and output paths
+    bam_dir = output_dir + '/Mapping_Files/'
+    outfiles_dir = output_dir + '/BitVector_Files/'
+    outplots_dir = output_dir + '/BitVector_Plots/'
+    if not os.path.exists(outfiles_dir):
+        os.makedirs(outfiles_dir)
+    if not os.path.exists(outplots_dir):
+        os.makedirs(outplots_dir)
+
+    if not fastq and sam_stream is None:  # Mapping was not run
+        if not os.path.exists(bam_dir):  # Mapping_Files folder does not exist
+            os.makedirs(bam_dir)
+        inp_bamfile = input_dir + sample_name + '_' + ref_name + '.bam'
+        if not os.path.exists(inp_bamfile):  # BAM file does not exist
+            raise FileNotFoundError('Bam file {} does not exist'.format(
+                inp_bamfile))
+        shutil.copy(inp_bamfile, bam_dir)  # Copy it over
+
+    ref_file = input_dir + ref_name + '.fasta'
+    phred_qscore = BitVector_Functions.Parse_PhredFile(qscore_file)
+    bam_file = bam_dir + sample_name + '_' + ref_name + '.bam'
+    sam_file = bam_dir + sample_name + '_' + ref_name + '.sam'
+
     # Check if mapping has been done
-    if not os.path.exists(bam_file):
+    if not os.path.exists(bam_file) and sam_stream is None:
         print_msg = 'Bam file {} does not exist. Perform mapping first.'
-        print(print_msg.format(bam_file))
-        return
+        raise FileNotFoundError(print_msg.format(bam_file))
 
-    # Check if bitvector has already run
+    # Check if bitvector has already run. Without the bit vector files (a
+    # run with bv_files False), EM Clustering needs them computed again.
     log_file = outplots_dir + sample_name + '_' + ref_name + '_log.txt'
-    if os.path.exists(log_file):
+    bv_filenames = [outfiles_dir + sample_name + '_' + ref + '_' +
+                    str(start) + '_' + str(end) + '_bitvectors.txt'
+                    for ref in refs_seq]
+    if os.path.exists(log_file) and all(os.path.exists(bv_filename)
+                                        for bv_filename in bv_filenames):
         print('BitVector has already been run for {}_{}'.format(sample_name,
                                                                 ref_name))
-        return
+        return {}
 
-    # Convert the BAM file to a SAM file if it doesn't exist
-    if not os.path.exists(sam_file):
+    # The reads are streamed out of the BAM file by samtools. A SAM file
+    # already there is read as is, and Picard converts the BAM file to one
+    # if samtools is not installed. With sam_stream, no file is read.
+    if sam_stream is None and not os.path.exists(sam_file) and \
+            shutil.which('samtools') is None:
         print('Converting BAM file to SAM file format')
+        DREEM_Status.Set_Stage('bitvector_sam_convert')
         convert_cmd = 'java -jar {} SamFormatConverter I={} O={}'
         convert_cmd = convert_cmd.format(picard_path, bam_file, sam_file)
-        os.system(convert_cmd)
+        with DREEM_Profile.Stage('bitvector_sam_convert'):
+            subprocess.check_call(convert_cmd, shell=True)
+    input_file = None
+    if sam_stream is None:
+        input_file = sam_file if os.path.exists(sam_file) else bam_file
 
     # Initialize plotting variables
-    mod_bases, mut_bases, delmut_bases = {}, {}, {}
-    info_bases, cov_bases = {}, {}
-    files, num_reads = {}, {}
+    mod_bases, mut_bases, delmut_bases, info_bases, cov_bases, num_reads = \
+        Init_Counters(refs_seq, start, end)
+    metrics = BitVector_Metrics.Alignment_Metrics(phred_qscore)
+    sinks = {}
     for ref in refs_seq:  # Each seq in the ref genome file
         ref_seq = refs_seq[ref]
-        num_reads[ref] = 0
-        mod_bases[ref], mut_bases[ref], delmut_bases[ref] = {}, {}, {}
-        info_bases[ref], cov_bases[ref] = {}, {}
-        for base in bases:
-            mod_bases[ref][base] = {}
-            for pos in range(start, end + 1):
-                mod_bases[ref][base][pos] = 0
-        for pos in range(start, end + 1):
-            mut_bases[ref][pos], delmut_bases[ref][pos] = 0, 0
-            info_bases[ref][pos], cov_bases[ref][pos] = 0, 0
-        # Write header lines to output text file
-        file_base_name = sample_name + '_' + ref + '_' + str(start) + \
-            '_' + str(end)
-        output_txt_filename = outfiles_dir + file_base_name + \
-            '_bitvectors.txt'
-        files[ref] = open(output_txt_filename, 'w')
-        files[ref].write('@ref' + '\t' + ref_name + ';' + ref + '\t' +
-                         ref_seq[start - 1:end] + '\n')
-        files[ref].write('@coordinates:length' + '\t' + str(start) + ',' +
-                         str(end) + ':' + str(end - start + 1) + '\n')
-        files[ref].write('Query_name\tBit_vector\tN_Mutations\n')
+        # Output text file (with its header lines) and/or in memory
+        bv_fileobj = None
+        if bv_files:
+            file_base_name = sample_name + '_' + ref + '_' + str(start) + \
+                '_' + str(end)
+            output_txt_filename = outfiles_dir + file_base_name + \
+                '_bitvectors.txt'
+            bv_fileobj = open(output_txt_filename, 'w')
+        sinks[ref] = BitVector_Functions.BitVector_Sink(
+            bv_fileobj, ref_name, ref, ref_seq[start - 1:end], start, end,
+            keep, collapse)
 
     # Compute Bit Vectors
     print('Computing bit vectors...')
-    Process_SamFile(sam_file, paired, refs_seq, start, end,
-                    cov_bases, info_bases, mod_bases,
-                    mut_bases, delmut_bases, num_reads, files)
+    DREEM_Status.Set_Stage('bitvector_process_sam')
+    with DREEM_Profile.Stage('bitvector_process_sam'):
+        if input_file is None:  # Reads straight from the aligner
+            Process_SamFile(sam_stream, paired, refs_seq, start, end,
+                            phred_qscore, QSCORE_CUTOFF, SUR_BASES,
+                            cov_bases, info_bases, mod_bases, mut_bases,
+                            delmut_bases, num_reads, sinks, metrics)
+        elif input_file == sam_file:
+            Process_SamFile(sam_file, paired, refs_seq, start, end,
+                            phred_qscore, QSCORE_CUTOFF, SUR_BASES,
+                            cov_bases, info_bases, mod_bases, mut_bases,
+                            delmut_bases, num_reads, sinks, metrics)
+        else:
+            view_cmd = ['samtools', 'view', '-h', bam_file]
+            view = subprocess.Popen(view_cmd, stdout=subprocess.PIPE,
+                                    universal_newlines=True)
+            Process_SamFile(view.stdout, paired, refs_seq, start, end,
+                            phred_qscore, QSCORE_CUTOFF, SUR_BASES,
+                            cov_bases, info_bases, mod_bases, mut_bases,
+                            delmut_bases, num_reads, sinks, metrics)
+            if view.wait() != 0:
+                raise subprocess.CalledProcessError(view.returncode,
+                                                    ' '.join(view_cmd))
 
     print('Writing to the output file and creating plots...')
+    DREEM_Status.Set_Stage('bitvector_outputs')
 
     for ref in refs_seq:
-        files[ref].close()
+        sinks[ref].close()
 
     end_time = time.time()
     time_taken = str(round((end_time - start_time) / 60, 2))
 
     # Write to output file
-    BitVector_Outputs.writeOutputFiles(sample_name, ref_name, num_reads,
-                                       outfiles_dir, outplots_dir,
-                                       refs_seq, start, end, mod_bases,
-                                       mut_bases, delmut_bases,
-                                       info_bases, cov_bases,
-                                       ref_file, SUR_BASES,
-                                       qscore_file, QSCORE_CUTOFF,
-                                       time_taken)
+    n_muts = {ref: sinks[ref].nmut_counts for ref in refs_seq}
+    mismatch_rates = BitVector_Metrics.Mismatch_Rates(refs_seq, start, end,
+                                                      mod_bases, info_bases)
+    alignment = BitVector_Metrics.Summary(metrics, mismatch_rates)
+    with DREEM_Profile.Stage('bitvector_outputs'):
+        BitVector_Metrics.Write_Metrics(alignment, sample_name, ref_name,
+                                        outplots_dir)
+        BitVector_Outputs.writeOutputFiles(sample_name, ref_name, num_reads,
+                                           n_muts, outplots_dir,
+                                           refs_seq, start, end, mod_bases,
+                                           mut_bases, delmut_bases,
+                                           info_bases, cov_bases,
+                                           ref_file, SUR_BASES,
+                                           qscore_file, QSCORE_CUTOFF,
+                                           time_taken)
+
+    for ref in refs_seq:
+        file_base_name = sample_name + '_' + ref + '_' + str(start) + \
+            '_' + str(end)
+        DREEM_Metrics.Record(output_dir, 'bitvector', sample_name, {
+            'ref_name': ref_name, 'ref': ref, 'start': start, 'end': end,
+            'time_s': round(time.time() - start_time, 2),
+            'input_bytes': DREEM_Metrics.File_Bytes([input_file] if
+                                                    input_file else []),
+            'n_bitvectors': num_reads[ref],
+            'alignment': BitVector_Metrics.Short_Summary(alignment),
+            'output_bytes': DREEM_Metrics.Dir_Bytes(outfiles_dir,
+                                                    file_base_name) +
+            DREEM_Metrics.Dir_Bytes(outplots_dir, file_base_name)})
 
     print('Finished creating bit vectors.')
+    return sinks
+
+
+def Init_Counters(refs_seq, start, end):
+    """
+    Zeroed counters of the plotting variables for each ref
+    """
+    mod_bases, mut_bases, delmut_bases = {}, {}, {}
+    info_bases, cov_bases, num_reads = {}, {}, {}
+    for ref in refs_seq:  # Each seq in the ref genome file
+        num_reads[ref] = 0
+        mod_bases[ref], mut_bases[ref], delmut_bases[ref] = {}, {}, {}
+        info_bases[ref], cov_bases[ref] = {}, {}
+        for base in bases:
+            mod_bases[ref][base] = {}
+            for pos in range(start, end + 1):
+                mod_bases[ref][base][pos] = 0
+        for pos in range(start, end + 1):
+            mut_bases[ref][pos], delmut_bases[ref][pos] = 0, 0
+            info_bases[ref][pos], cov_bases[ref][pos] = 0, 0
+    return mod_bases, mut_bases, delmut_bases, info_bases, cov_bases, \
+        num_reads
 
 
-def Process_SamFile(sam_file, paired, refs_seq, start, end,
-                    cov_bases, info_bases, mod_bases,
-                    mut_bases, delmut_bases, num_reads, files):
+def Process_SamFile(sam_file, paired, refs_seq, start, end, phred_qscore,
+                    QSCORE_CUTOFF, SUR_BASES, cov_bases, info_bases,
+                    mod_bases, mut_bases, delmut_bases, num_reads, sinks,
+                    metrics=None):
     """
     Read SAM file and generate bit vectors.
+    Args:
+        sam_file (string/file): Path of the SAM file, or a stream of its
+            lines (e.g. samtools view output)
+        metrics (Alignment_Metrics): Also add the mates to these metrics
+    The mates of a pair are on consecutive lines, unless the header says
+    the file is sorted by coordinate: they are paired by BitVector_Pairing.
     """
-    ignore_lines = len(refs_seq.keys()) + 2
-    sam_fileobj = open(sam_file, 'r')
-    for line_index in range(ignore_lines):  # Ignore header lines
-        sam_fileobj.readline()
+    if isinstance(sam_file, str):
+        sam_size = os.path.getsize(sam_file)
+        sam_fileobj = open(sam_file, 'r')
+    else:  # No size, no ETA
+        sam_size, sam_fileobj = None, sam_file
+    header_lines = []
+    line = sam_fileobj.readline()
+    while line.startswith('@'):  # Ignore header lines
+        header_lines.append(line)
+        line = sam_fileobj.readline()
+    records = itertools.chain([line] if line else [], sam_fileobj)
+    pairs, pair_counts = None, {}
+    if paired and BitVector_Pairing.Is_CoordinateSorted(header_lines):
+        pairs = BitVector_Pairing.Pair_Mates(records, pair_counts)
+    n_records = 0
     while True:
+        n_records += 1
+        if n_records % status_every == 0:  # Progress by bytes read
+            DREEM_Status.Update(n_records, sam_fileobj.buffer.tell()
+                                if sam_size else None, sam_size)
         try:
             if paired:
-                line1, line2 = next(sam_fileobj), next(sam_fileobj)
-                line1, line2 = line1.strip().split(), line2.strip().split()
+                if pairs is not None:
+                    line1, line2 = next(pairs)
+                else:
+                    line1 = BitVector_Functions.Split_Record(next(records))
+                    line2 = BitVector_Functions.Split_Record(next(records))
                 mate1 = BitVector_Functions.Mate(line1)
                 mate2 = BitVector_Functions.Mate(line2)
-                assert mate1.PNEXT == mate2.POS and \
-                    mate1.RNAME == mate2.RNAME and mate1.RNEXT == "="
-                assert mate1.QNAME == mate2.QNAME and mate1.MAPQ == mate2.MAPQ
-                GenerateBitVector_Paired(mate1, mate2, refs_seq,
-                                         phred_qscore, cov_bases, info_bases,
+                if pairs is None:  # Consecutive lines of the aligner output
+                    assert mate1.PNEXT == mate2.POS and \
+                        mate1.RNAME == mate2.RNAME and mate1.RNEXT == "="
+                    assert mate1.MAPQ == mate2.MAPQ
+                # Paired by BitVector_Pairing: the MAPQs can differ
+                assert mate1.QNAME == mate2.QNAME
+                if metrics is not None:
+                    metrics.add_pair(mate1, mate2)
+                GenerateBitVector_Paired(mate1, mate2, refs_seq, start, end,
+                                         phred_qscore, QSCORE_CUTOFF,
+                                         SUR_BASES, cov_bases, info_bases,
                                          mod_bases, mut_bases, delmut_bases,
-                                         num_reads, files)
+                                         num_reads, sinks)
             else:
-                line = next(sam_fileobj)
-                line = line.strip().split()
+                line = BitVector_Functions.Split_Record(next(records))
                 mate = BitVector_Functions.Mate(line)
-                GenerateBitVector_Single(mate, refs_seq, phred_qscore,
-                                         cov_bases, info_bases, mod_bases,
-                                         mut_bases, delmut_bases, num_reads,
-                                         files)
+                if metrics is not None:
+                    metrics.add_mate(mate)
+                GenerateBitVector_Single(mate, refs_seq, start, end,
+                                         phred_qscore, QSCORE_CUTOFF,
+                                         SUR_BASES, cov_bases, info_bases,
+                                         mod_bases, mut_bases, delmut_bases,
+                                         num_reads, sinks)
         except StopIteration:
             break
     sam_fileobj.close()
+    if pair_counts:
+        print('Mate pairing: {pairs} pairs, {orphans} mates without their '
+              'mate, {skipped} unmapped or secondary records skipped, '
+              '{spilled} mates spilled to disk'.format(**pair_counts))
 
 
-def GenerateBitVector_Paired(mate1, mate2, refs_seq, phred_qscore,
+def GenerateBitVector_Paired(mate1, mate2, refs_seq, start, end,
+                             phred_qscore, QSCORE_CUTOFF, SUR_BASES,
                              cov_bases, info_bases, mod_bases, mut_bases,
-                             delmut_bases, num_reads, files):
+                             delmut_bases, num_reads, sinks):
     """
     Create a bitvector for paired end sequencing.
     """
-    bitvector_mate1 = Convert_Read(mate1, refs_seq, phred_qscore)
-    bitvector_mate2 = Convert_Read(mate2, refs_seq, phred_qscore)
+    bitvector_mate1 = Convert_Read(mate1, refs_seq, phred_qscore,
+                                   QSCORE_CUTOFF, SUR_BASES)
+    bitvector_mate2 = Convert_Read(mate2, refs_seq, phred_qscore,
+                                   QSCORE_CUTOFF, SUR_BASES)
     bit_vector = Combine_Mates(bitvector_mate1, bitvector_mate2)
     Plotting_Variables(mate1.QNAME, mate1.RNAME, bit_vector, start, end,
                        cov_bases, info_bases, mod_bases, mut_bases,
-                       delmut_bases, num_reads, files)
+                       delmut_bases, num_reads, sinks)
 
 
-def GenerateBitVector_Single(mate, refs_seq, phred_qscore,
-                             cov_bases, info_bases, mod_bases,
-                             mut_bases, delmut_bases, num_reads, files):
+def GenerateBitVector_Single(mate, refs_seq, start, end, phred_qscore,
+                             QSCORE_CUTOFF, SUR_BASES, cov_bases, info_bases,
+                             mod_bases, mut_bases, delmut_bases, num_reads,
+                             sinks):
     """
     Create a bitvector for single end sequencing.
     """
-    bit_vector = Convert_Read(mate, refs_seq, phred_qscore)
+    bit_vector = Convert_Read(mate, refs_seq, phred_qscore, QSCORE_CUTOFF,
+                              SUR_BASES)
     Plotting_Variables(mate.QNAME, mate.RNAME, bit_vector, start, end,
                        cov_bases, info_bases, mod_bases, mut_bases,
-                       delmut_bases, num_reads, files)
+                       delmut_bases, num_reads, sinks)
 
 
-def Convert_Read(mate, refs_seq, phred_qscore):
+def Convert_Read(mate, refs_seq, phred_qscore, QSCORE_CUTOFF, SUR_BASES):
     """
     Convert a read's sequence to a bit vector of 0s & 1s and substituted bases
     Args:
         mate (Mate): Read
         refs_seq (dict): Sequences of the ref genomes in the file
         phred_qscore (dict): Qual score - ASCII symbol mapping
+        QSCORE_CUTOFF (int): Qscore cutoff for a valid base
+        SUR_BASES (int): Bases surrounding a deletion
     Returns:
         bitvector_mate (dict): Bitvector. Format: d[pos] = bit
     """
@@ -192,8 +356,7 @@ def Convert_Read(mate, refs_seq, phred_qscore):
     CIGAR_Ops = BitVector_Functions.Parse_CIGAR(mate.CIGAR)
     op_index = 0
     while op_index < len(CIGAR_Ops):  # Each CIGAR operation
-        op = CIGAR_Ops[op_index]
-        desc, length = op[1], int(op[0])
+        length, desc = CIGAR_Ops[op_index]
 
         if desc == 'M':  # Match or mismatch
             for k in range(length):  # Each base
@@ -268,7 +431,7 @@ def Combine_Mates(bitvector_mate1, bitvector_mate2):
 
 def Plotting_Variables(q_name, ref, bit_vector, start, end, cov_bases,
                        info_bases, mod_bases, mut_bases, delmut_bases,
-                       num_reads, files):
+                       num_reads, sinks):
     """
     Create final bit vector in relevant coordinates and all the
     variables needed for plotting
@@ -278,28 +441,29 @@ def Plotting_Variables(q_name, ref, bit_vector, start, end, cov_bases,
         bit_vector (dict): Bit vector from the mate/mates
     """
     # Create bit vector in relevant coordinates
-    num_reads[ref] += 1  # Add a read to the count
+    weight = BitVector_Functions.Read_Weight(q_name) \
+        if sinks[ref].collapsed else 1  # Collapsed reads
+    num_reads[ref] += weight  # Add the reads to the count
     bit_string = ''
     for pos in range(start, end + 1):  # Each pos in coords of interest
         if pos not in bit_vector:  # Pos not covered by the read
             read_bit = miss_info
         else:
             read_bit = bit_vector[pos]
-            cov_bases[ref][pos] += 1
+            cov_bases[ref][pos] += weight
             if read_bit != ambig_info:
-                info_bases[ref][pos] += 1
+                info_bases[ref][pos] += weight
             if read_bit in bases:  # Mutation
-                mod_bases[ref][read_bit][pos] += 1
-                mut_bases[ref][pos] += 1
-                delmut_bases[ref][pos] += 1
+                mod_bases[ref][read_bit][pos] += weight
+                mut_bases[ref][pos] += weight
+                delmut_bases[ref][pos] += weight
             elif read_bit == del_bit:  # Deletion
-                delmut_bases[ref][pos] += 1
+                delmut_bases[ref][pos] += weight
         bit_string += read_bit
-    # Write bit vector to output text file
-    n_mutations = str(float(sum(bit.isalpha() for bit in bit_string)))
+    # Write bit vector to output text file and/or keep it
+    n_mutations = float(sum(bit.isalpha() for bit in bit_string))
     if not bit_string.count('.') == len(bit_string):  # Not all '.'
-        files[ref].write(q_name + '\t' + bit_string + '\t' + n_mutations + '\n')
-
+        sinks[ref].add(q_name, bit_string, n_mutations, weight)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Creation of bit vectors')
@@ -315,6 +479,14 @@ if __name__ == '__main__':
     parser.add_argument('paired', help='Paired-end sequencing?')
     parser.add_argument('picard_path', help='Path to Picard jar file')
     parser.add_argument('fastq', help='Mapping was run?')
+    parser.add_argument('--profile', nargs='?', const='timers',
+                        choices=DREEM_Profile.modes,
+                        help='Profile the stages (default mode: timers)')
+    parser.add_argument('--status_port', type=int,
+                        help='Serve the job status on 127.0.0.1:PORT')
+    parser.add_argument('--collapse', action='store_true',
+                        help='The reads were collapsed: count a read N ' +
+                        'times for a ;size=N suffix of its name')
     args = parser.parse_args()
     sample_name = args.sample_name
     ref_name = args.ref_name
@@ -330,35 +502,23 @@ if __name__ == '__main__':
     fastq = args.fastq
 
     paired = True if paired == 'True' else False
-
-    # Symbols to represent a read as a bit vector
-    miss_info, ambig_info = '.', '?'
-    nomut_bit, del_bit = '0', '1'
-    bases = ['A', 'T', 'G', 'C', 'N']
-
-    # Input and output paths
-    bam_dir = output_dir + '/Mapping_Files/'
-    outfiles_dir = output_dir + '/BitVector_Files/'
-    outplots_dir = output_dir + '/BitVector_Plots/'
-    if not os.path.exists(outfiles_dir):
-        os.makedirs(outfiles_dir)
-    if not os.path.exists(outplots_dir):
-        os.makedirs(outplots_dir)
-
-    if fastq == 'False':  # Mapping was not run
-        if not os.path.exists(bam_dir):  # Mapping_Files folder does not exist
-            os.makedirs(bam_dir)
-        inp_bamfile = input_dir + sample_name + '_' + ref_name + '.bam'
-        if not os.path.exists(inp_bamfile):  # BAM file does not exist
-            print('Bam file {} does not exist'.format(inp_bamfile))
-        copy_cmd = 'cp {} {}'.format(inp_bamfile, bam_dir)  # Copy it over
-        os.system(copy_cmd)
+    fastq = True if fastq == 'True' else False
 
     # Generate input variables from input file
     ref_file = input_dir + ref_name + '.fasta'
     refs_seq = BitVector_Functions.Parse_FastaFile(ref_file)  # Ref seqs
-    phred_qscore = BitVector_Functions.Parse_PhredFile(qscore_file)
-    bam_file = bam_dir + sample_name + '_' + ref_name + '.bam'
-    sam_file = bam_dir + sample_name + '_' + ref_name + '.sam'
 
-    Bit_Vectors()
+    DREEM_Status.Enable(output_dir, sample_name, args.status_port)
+    if args.profile:
+        DREEM_Profile.Enable(args.profile)
+    try:
+        Bit_Vectors(sample_name, ref_name, refs_seq, start, end, SUR_BASES,
+                    qscore_file, QSCORE_CUTOFF, input_dir, output_dir, paired,
+                    picard_path, fastq, collapse=args.collapse)
+    except BaseException:
+        DREEM_Status.Finish('failed')
+        raise
+    else:
+        DREEM_Status.Finish('done')
+    finally:
+        DREEM_Profile.Write(output_dir)
@@ -13,8 +13,17 @@ Created on Tue Jul 30 2019
 
 @author: harish
 
-Contains functions and a class used by Bit_Vector.py
+Contains functions and classes used by Bit_Vector.py
 """
+import re
+import numpy as np
+import EM_Functions
+import Mapping_Collapse
+
+chunk_reads = 100000  # Bit vectors converted to codes at a time
+cigar_pattern = re.compile(r'(\d+)([A-Z]{1})')
+max_cigars = 100000  # Parsed CIGAR strings kept
+cigar_cache = {}
 
 
 def Calc_Ambig_Reads(ref_seq, i, length, num_surBases):
@@ -47,18 +56,32 @@ def Calc_Ambig_Reads(ref_seq, i, length, num_surBases):
 
 def Parse_CIGAR(cigar_string):
     """
-    Parse a CIGAR string
+    Parse a CIGAR string. Most reads share a few CIGAR strings, so the
+    parsed ones are cached.
     Args:
         cigar_string (string): CIGAR string
     Returns:
-        ops (list): List of operations. Each op is of type
-        (length, description) such as ('37', 'M'), ('10', 'I'), (24, 'D'), etc.
+        ops (tuple): Operations. Each op is of type (length, description)
+        such as (37, 'M'), (10, 'I'), (24, 'D'), etc.
     """
-    import re
-    ops = re.findall(r'(\d+)([A-Z]{1})', cigar_string)
+    ops = cigar_cache.get(cigar_string)
+    if ops is None:
+        if len(cigar_cache) >= max_cigars:
+            cigar_cache.clear()
+        ops = tuple((int(length), desc) for (length, desc) in
+                    cigar_pattern.findall(cigar_string))
+        cigar_cache[cigar_string] = ops
     return ops
 
 
+def Split_Record(line):
+    """
+    Fields of a SAM line. The optional fields are left in one string, the
+    12th field, as Bit Vector does not use them.
+    """
+    return line.rstrip().split('\t', 11)
+
+
 def Parse_PhredFile(qscore_filename):
     """
     Parse a file containing Phred Q Score info
@@ -86,11 +109,19 @@ def Parse_FastaFile(fasta_file):
     Returns:
         refs_seq (dict): Sequences of the ref genomes in the file
     """
-    from Bio import SeqIO
-    refs_seq = {}
-    with open(fasta_file, 'rU') as handle:
-        for record in SeqIO.parse(handle, 'fasta'):
-            refs_seq[record.id] = str(record.seq)
+    refs_seq, ref, seq_lines = {}, None, []
+    with open(fasta_file) as handle:
+        for line in handle:
+            line = line.strip()
+            if line.startswith('>'):  # Header line of a new record
+                if ref is not None:
+                    refs_seq[ref] = ''.join(seq_lines)
+                ref_split = line[1:].split()
+                ref, seq_lines = ref_split[0] if ref_split else '', []
+            elif ref is not None:
+                seq_lines.append(line)
+    if ref is not None:
+        refs_seq[ref] = ''.join(seq_lines)
     return refs_seq
 
 
@@ -108,24 +139,91 @@ def Create_FastaFile(filename, ref_name, seq):
     outfile.close()
 
 
+def Read_Weight(q_name):
+    """
+    Number of identical reads a collapsed read stands for: N of the
+    ';size=N' suffix added to its name by Mapping_Collapse, else 1
+    """
+    match = Mapping_Collapse.weight_pattern.search(q_name)
+    return int(match.group(1)) if match else 1
+
+
 class Mate():
     """
     Attributes of a mate in a read pair. Be careful about the order!
+    The optional fields are kept as they are in TAGS.
     """
+    __slots__ = ('QNAME', 'FLAG', 'RNAME', 'POS', 'MAPQ', 'CIGAR', 'RNEXT',
+                 'PNEXT', 'TLEN', 'SEQ', 'QUAL', 'TAGS')
+
     def __init__(self, line_split):
-        self.QNAME = line_split[0]
-        self.FLAG = line_split[1]
-        self.RNAME = line_split[2]
-        self.POS = int(line_split[3])
-        self.MAPQ = int(line_split[4])
-        self.CIGAR = line_split[5]
-        self.RNEXT = line_split[6]
-        self.PNEXT = int(line_split[7])
-        self.TLEN = line_split[8]
-        self.SEQ = line_split[9]
-        self.QUAL = line_split[10]
-        self.MDSTRING = line_split[11].split(":")[2]
+        self.QNAME, self.FLAG, self.RNAME, pos, mapq, self.CIGAR, \
+            self.RNEXT, pnext, self.TLEN, self.SEQ, self.QUAL = \
+            line_split[:11]
+        self.POS, self.MAPQ, self.PNEXT = int(pos), int(mapq), int(pnext)
+        self.TAGS = line_split[11] if len(line_split) > 11 else ''
+
+    @property
+    def MDSTRING(self):
+        for tag in self.TAGS.split('\t'):
+            if tag.startswith('MD:Z:'):
+                return tag[5:]
+        return ''
 
     def __repr__(self):
         return self.QNAME + "-" + self.RNAME + "-" + str(self.POS)+"-" + \
             self.CIGAR+"-"+self.MDSTRING
+
+
+class BitVector_Sink():
+    """
+    Destination of the bit vectors of a ref: the bit vector text file and/or
+    an in-memory code matrix, built in chunks like when reading the file.
+    The histogram of the number of mutations of the bit vectors is always
+    kept, in reads (nmut_counts[n] reads with n mutations). collapsed: the
+    query names carry the weights of collapsed reads (Mapping_Collapse),
+    which the file header records.
+    """
+    def __init__(self, fileobj, ref_file, ref, seq, start, end, keep,
+                 collapsed=False):
+        indices = str(start) + ',' + str(end)
+        self.fileobj = fileobj
+        self.header = (ref_file, ref, seq, indices)
+        self.D = end - start + 1
+        self.keep = keep
+        self.collapsed = collapsed
+        self.chunks = []  # (codes, n_muts, weights) of each chunk
+        self.bit_strings, self.n_muts, self.weights = [], [], []
+        self.nmut_counts = [0] * (self.D + 1)
+        if fileobj is not None:
+            fileobj.write('@ref' + '\t' + ref_file + ';' + ref + '\t' +
+                          seq + '\n')
+            fileobj.write('@coordinates:length' + '\t' + indices + ':' +
+                          str(self.D) +
+                          ('\t' + Mapping_Collapse.header_flag if collapsed
+                           else '') + '\n')
+            fileobj.write('Query_name\tBit_vector\tN_Mutations\n')
+
+    def add(self, q_name, bit_string, n_mutations, weight=1):
+        if self.fileobj is not None:
+            self.fileobj.write(q_name + '\t' + bit_string + '\t' +
+                               str(n_mutations) + '\n')
+        self.nmut_counts[int(n_mutations)] += weight
+        if self.keep:
+            self.bit_strings.append(bit_string.encode())
+            self.n_muts.append(n_mutations)
+            self.weights.append(weight)
+            if len(self.bit_strings) >= chunk_reads:
+                self.flush()
+
+    def flush(self):
+        if self.bit_strings:
+            codes = EM_Functions.bits_to_codes(self.bit_strings, self.D)
+            self.chunks.append((codes, np.array(self.n_muts),
+                                np.array(self.weights, dtype=np.int64)))
+        self.bit_strings, self.n_muts, self.weights = [], [], []
+
+    def close(self):
+        self.flush()
+        if self.fileobj is not None:
+            self.fileobj.close()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+# Copyright (c) <2019> <The Whitehead Institute for Biomedical Research>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Alignment QC metrics of a sample, accumulated during the bit vector pass.
+
+Every mate read by Process_SamFile is added to Alignment_Metrics (as many
+times as the reads it stands for), which keeps streaming histograms only:
+insert sizes, base qualities per sequencing cycle (counted in numpy by
+batches of QUAL strings) and the count of each distinct CIGAR string
+(parsed once at the end). Mismatch rates by ref base come for free from
+the counters of the bit vector pass, so they cover the positions of
+interest (start to end) only.
+
+Written as <sample>_<ref_name>_alignment_metrics.json and .html in the
+BitVector_Plots dir.
+"""
+import json
+import numpy as np
+import BitVector_Functions
+
+qual_batch = 20000  # QUAL strings added to the histograms at once
+pad_char = ' '  # Pads the shorter QUAL strings of a batch, below '!'
+cigar_ops = 'MIDNSHP=X'
+bases = ['A', 'T', 'G', 'C', 'N']
+
+
+class Alignment_Metrics():
+    """
+    Streaming histograms of the mates of a SAM file
+    """
+    def __init__(self, phred_qscore):
+        self.scores = np.full(128, -1, dtype=np.int64)  # ASCII -> Q score
+        for symbol, score in phred_qscore.items():
+            self.scores[ord(symbol)] = score
+        self.insert_sizes = {}
+        self.cigars = {}
+        self.quals, self.qual_weights = [], []
+        self.qual_counts = np.zeros((0, 128), dtype=np.int64)  # [cycle, chr]
+        self.n_mates, self.n_pairs = 0, 0
+
+    def add_mate(self, mate):
+        weight = BitVector_Functions.Read_Weight(mate.QNAME)
+        self.n_mates += weight
+        self.cigars[mate.CIGAR] = self.cigars.get(mate.CIGAR, 0) + weight
+        if int(mate.FLAG) & 16:  # Reverse strand: back to cycle order
+            self.quals.append(mate.QUAL[::-1])
+        else:
+            self.quals.append(mate.QUAL)
+        self.qual_weights.append(weight)
+        if len(self.quals) >= qual_batch:
+            self.add_quals()
+
+    def add_pair(self, mate1, mate2):
+        weight = BitVector_Functions.Read_Weight(mate1.QNAME)
+        self.n_pairs += weight
+        tlen = abs(int(mate1.TLEN))
+        self.insert_sizes[tlen] = self.insert_sizes.get(tlen, 0) + weight
+        self.add_mate(mate1)
+        self.add_mate(mate2)
+
+    def add_quals(self):
+        """
+        Add the batch of QUAL strings to the per cycle histograms
+        """
+        if not self.quals:
+            return
+        length = max(len(qual) for qual in self.quals)
+        batch = ''.join(qual.ljust(length, pad_char) for qual in self.quals)
+        codes = np.frombuffer(batch.encode('ascii'), dtype=np.uint8)
+        codes = codes.reshape(len(self.quals), length).astype(np.int64)
+        codes += np.arange(length) * 128  # One bin per cycle and symbol
+        weights = np.array(self.qual_weights, dtype=np.int64)
+        if np.all(weights == 1):
+            counts = np.bincount(codes.ravel(), minlength=length * 128)
+        else:  # Collapsed reads
+            counts = np.bincount(codes.ravel(), np.repeat(weights, length),
+                                 minlength=length * 128).astype(np.int64)
+        counts = counts.reshape(length, 128)
+        counts[:, ord(pad_char)] = 0
+        if length > len(self.qual_counts):
+            grown = np.zeros((length, 128), dtype=np.int64)
+            grown[:len(self.qual_counts)] = self.qual_counts
+            self.qual_counts = grown
+        self.qual_counts[:length] += counts
+        self.quals, self.qual_weights = [], []
+
+    def cigar_summary(self):
+        """
+        Bases in each CIGAR op, and mates with soft clips and indels
+        """
+        op_bases = {op: 0 for op in cigar_ops}
+        clipped, with_ins, with_del = 0, 0, 0
+        for cigar, count in self.cigars.items():
+            ops = BitVector_Functions.Parse_CIGAR(cigar)
+            descs = set(desc for (length, desc) in ops)
+            for length, desc in ops:
+                op_bases[desc] = op_bases.get(desc, 0) + int(length) * count
+            clipped += count if 'S' in descs else 0
+            with_ins += count if 'I' in descs else 0
+            with_del += count if 'D' in descs else 0
+        read_bases = op_bases['M'] + op_bases['I'] + op_bases['S'] + \
+            op_bases['='] + op_bases['X']
+        aligned_bases = op_bases['M'] + op_bases['='] + op_bases['X']
+        return {'op_bases': {op: n for (op, n) in op_bases.items() if n},
+                'soft_clip_rate': Ratio(op_bases['S'], read_bases),
+                'insertion_rate': Ratio(op_bases['I'], aligned_bases),
+                'deletion_rate': Ratio(op_bases['D'], aligned_bases),
+                'mates_soft_clipped': Ratio(clipped, self.n_mates),
+                'mates_with_insertion': Ratio(with_ins, self.n_mates),
+                'mates_with_deletion': Ratio(with_del, self.n_mates)}
+
+    def quality_summary(self):
+        """
+        Mean Q score per cycle and the quality yield
+        """
+        self.add_quals()
+        counts = self.qual_counts[:, self.scores >= 0]
+        scores = self.scores[self.scores >= 0]
+        per_cycle = counts.sum(axis=1)
+        total = int(per_cycle.sum())
+        mean_cycle = [Ratio(int(n_scores), int(n)) for (n_scores, n) in
+                      zip(counts.dot(scores), per_cycle)]
+        return {'total_bases': total,
+                'q20_bases': int(counts[:, scores >= 20].sum()),
+                'q30_bases': int(counts[:, scores >= 30].sum()),
+                'q30_fraction': Ratio(int(counts[:, scores >= 30].sum()),
+                                      total),
+                'mean_quality': Ratio(int(counts.dot(scores).sum()), total),
+                'mean_quality_per_cycle': mean_cycle}
+
+    def insert_size_summary(self):
+        """
+        Histogram of insert sizes (TLEN of mate 1), with its median
+        """
+        if not self.insert_sizes:
+            return {}
+        sizes = sorted(self.insert_sizes)
+        half, seen = self.n_pairs / 2.0, 0
+        for size in sizes:
+            seen += self.insert_sizes[size]
+            if seen >= half:
+                break
+        return {'median': size,
+                'mean': Ratio(sum(s * n for (s, n) in
+                                  self.insert_sizes.items()), self.n_pairs),
+                'histogram': {str(s): self.insert_sizes[s] for s in sizes}}
+
+
+def Ratio(num, den):
+    return round(num / den, 6) if den else 0.0
+
+
+def Mismatch_Rates(refs_seq, start, end, mod_bases, info_bases):
+    """
+    Mismatch rate of each ref base, and the bases it was mutated to, from
+    the counters of the bit vector pass
+    Args:
+        mod_bases (dict): Number of times a base was modified to at a pos
+        info_bases (dict): Number of data points with info at a pos
+    Returns:
+        rates (dict): rates[ref][ref_base] = {'bases', 'mismatches',
+            'rate', 'to'}
+    """
+    rates = {}
+    for ref in refs_seq:
+        rates[ref] = {}
+        ref_end = min(end, len(refs_seq[ref]))  # Window past the ref end
+        for ref_base in bases:
+            positions = [pos for pos in range(start, ref_end + 1)
+                         if refs_seq[ref][pos - 1] == ref_base]
+            n_info = sum(info_bases[ref][pos] for pos in positions)
+            to = {base: sum(mod_bases[ref][base][pos] for pos in positions)
+                  for base in bases if base != ref_base}
+            n_mismatch = sum(to.values())
+            if positions:
+                rates[ref][ref_base] = {'bases': n_info,
+                                        'mismatches': n_mismatch,
+                                        'rate': Ratio(n_mismatch, n_info),
+                                        'to': to}
+    return rates
+
+
+def Summary(metrics, mismatch_rates):
+    """
+    All the metrics, as written to the JSON file
+    """
+    return {'mates': metrics.n_mates,
+            'pairs': metrics.n_pairs,
+            'insert_size': metrics.insert_size_summary(),
+            'quality': metrics.quality_summary(),
+            'cigar': metrics.cigar_summary(),
+            'mismatch_rates': mismatch_rates}
+
+
+def Short_Summary(summary):
+    """
+    A few values of the summary, for the metrics record of the stage
+    """
+    return {'median_insert_size': summary['insert_size'].get('median'),
+            'mean_quality': summary['quality']['mean_quality'],
+            'q30_fraction': summary['quality']['q30_fraction'],
+            'soft_clip_rate': summary['cigar']['soft_clip_rate'],
+            'insertion_rate': summary['cigar']['insertion_rate'],
+            'deletion_rate': summary['cigar']['deletion_rate']}
+
+
+def Write_Metrics(summary, sample_name, ref_name, outplots_dir):
+    """
+    Write the metrics to a JSON file and plot them
+    """
+    import plotly
+    import plotly.graph_objs as go
+    from plotly import tools
+
+    file_base_name = outplots_dir + sample_name + '_' + ref_name + \
+        '_alignment_metrics'
+    with open(file_base_name + '.json', 'w') as f:
+        json.dump(summary, f, indent=4, sort_keys=True)
+
+    titles = ('Insert size', 'Mean quality per cycle',
+              'Mismatch rate by ref base', 'Soft clip and indel rates')
+    fig = tools.make_subplots(rows=2, cols=2, subplot_titles=titles)
+    histogram = summary['insert_size'].get('histogram', {})
+    fig.append_trace(go.Bar(x=[int(size) for size in histogram],
+                            y=list(histogram.values()),
+                            name='Insert size'), 1, 1)
+    mean_cycle = summary['quality']['mean_quality_per_cycle']
+    fig.append_trace(go.Scatter(x=list(range(1, len(mean_cycle) + 1)),
+                                y=mean_cycle, name='Mean quality'), 1, 2)
+    for ref, rates in summary['mismatch_rates'].items():
+        fig.append_trace(go.Bar(x=list(rates.keys()),
+                                y=[rate['rate'] for rate in rates.values()],
+                                name=ref), 2, 1)
+    cigar_rates = ['soft_clip_rate', 'insertion_rate', 'deletion_rate']
+    fig.append_trace(go.Bar(x=cigar_rates,
+                            y=[summary['cigar'][rate] for rate in
+                               cigar_rates], name='Rates'), 2, 2)
+    fig['layout']['xaxis1'].update(title='Insert size')
+    fig['layout']['xaxis2'].update(title='Cycle')
+    fig['layout']['yaxis2'].update(title='Q score')
+    fig['layout']['yaxis3'].update(title='Mismatch rate')
+    fig['layout'].update(title='Alignment metrics: ' + sample_name,
+                         showlegend=False)
+    plotly.offline.plot(fig, filename=file_base_name + '.html',
+                        auto_open=False)
+
+
+def Check():
+    """
+    Mismatch rates of a window running past the end of a short ref
+    """
+    import BitVector
+    refs_seq = {'short': 'ACGTACGTAC', 'long': 'ACGTACGTACGTACGTACGT'}
+    mod_bases, mut_bases, delmut_bases, info_bases, cov_bases, \
+        num_reads = BitVector.Init_Counters(refs_seq, 1, 20)
+    for ref in refs_seq:
+        for pos in range(1, len(refs_seq[ref]) + 1):
+            info_bases[ref][pos] = 10
+    mod_bases['short']['T'][3] = 5  # G -> T at position 3
+    rates = Mismatch_Rates(refs_seq, 1, 20, mod_bases, info_bases)
+    assert rates['short']['G'] == {'bases': 20, 'mismatches': 5,
+                                   'rate': 0.25,
+                                   'to': {'A': 0, 'T': 5, 'C': 0, 'N': 0}}, \
+        rates['short']['G']
+    assert rates['long']['G']['bases'] == 50, rates['long']['G']
+    print('Alignment metrics check passed.')
+
+
+if __name__ == '__main__':
+    Check()
@@ -16,13 +16,9 @@ Created on Tue Jul 30 2019
 Create outputs of the bitvector step: text file, plots, etc.
 """
 import datetime
-import pandas as pd
-import plotly
-import plotly.graph_objs as go
-from plotly import tools
 
 
-def writeOutputFiles(sample_name, ref_name, num_reads, outfile_dir,
+def writeOutputFiles(sample_name, ref_name, num_reads, n_muts,
                      outplots_dir, refs_seq, start, end, mod_bases,
                      mut_bases, delmut_bases, info_bases, cov_bases,
                      ref_filename, sur_bases, qscore_filename,
@@ -34,7 +30,7 @@ def writeOutputFiles(sample_name, ref_name, num_reads, outfile_dir,
         sample_name (string): Name of sample
         ref_name (string): Name of the reference genome
         num_reads (dict): Number of reads per ref
-        outfile_dir (string): Path to output file directory
+        n_muts (dict): Number of reads with each number of mutations per ref
         outplots_dir (string): Path to output plots directory
         refs_seq (dict): Ref genome sequences
         start (int): Start position
@@ -50,6 +46,10 @@ def writeOutputFiles(sample_name, ref_name, num_reads, outfile_dir,
         qscore_cutoff (int): Cutoff for valid base
         time_taken (float): Time taken for creating the bit vectors
     """
+    import plotly
+    import plotly.graph_objs as go
+    from plotly import tools
+
     now = datetime.datetime.now()
     bases = ['A', 'T', 'G', 'C', 'N']
     cmap = {'A': 'red', 'T': 'green', 'G': 'orange', 'C': 'blue', 'N': 'gray'}  # Color map
@@ -68,15 +68,11 @@ def writeOutputFiles(sample_name, ref_name, num_reads, outfile_dir,
     log_file.write('Finished at: ' + now.strftime("%Y-%m-%d %H:%M") + '\n')
     log_file.close()
 
-    # Write bitvector txt file and create plots for each ref
+    # Create plots for each ref
     for ref in refs_seq:  # Each ref genome
         file_base_name = sample_name + '_' + ref + '_' + str(start) + \
             '_' + str(end) + '_'
         ref_seq = refs_seq[ref]
-        bv_filename = outfile_dir + file_base_name + 'bitvectors.txt'
-        n_muts = pd.read_csv(bv_filename, sep='\t', skiprows=2,
-                             usecols=['N_Mutations'], index_col=False)
-        n_muts = n_muts['N_Mutations']
 
         # Plot 1 - Read coverage
         xaxis_coordinates = [i for i in range(start, end + 1)]
@@ -126,7 +122,10 @@ def writeOutputFiles(sample_name, ref_name, num_reads, outfile_dir,
                             auto_open=False)
 
         # Plot 3 - Histogram of number of mutations per read
-        mut_hist_data = [go.Histogram(x=n_muts)]
+        nmut_values = [n for (n, count) in enumerate(n_muts[ref]) if count]
+        mut_hist_data = [go.Histogram(x=nmut_values,
+                                      y=[n_muts[ref][n] for n in nmut_values],
+                                      histfunc='sum')]
         mut_hist_layout = go.Layout(
             title='Mutations: ' + sample_name,
             xaxis=dict(title='Number of mutations per read'),
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+# Copyright (c) <2019> <The Whitehead Institute for Biomedical Research>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Pairing of the mates of a coordinate-sorted SAM stream, for Bit Vector.
+
+Name-sorted input (and the output of the aligner) has the two mates of a
+pair on consecutive lines. In a coordinate-sorted file they can be far
+apart: a mate is kept in a buffer (by QNAME) until its mate comes, which
+is by the time the stream reaches its PNEXT, so the buffer holds about
+fragment length x coverage mates whatever the size of the file. A mate
+still there once the stream has passed its PNEXT has lost its mate.
+
+Above max_buffered mates (very deep coverage), the buffer is spilled to
+temp files partitioned by a hash of QNAME, and so are the later mates
+whose mate is not in memory. The pairs in the spilled mates are found at
+the end, one partition at a time. The temp files are in TMPDIR.
+"""
+import os
+import heapq
+import shutil
+import zlib
+import BitVector_Functions
+
+max_buffered = 500000  # Mates in memory before spilling to disk
+n_partitions = 64  # Temp files of the spilled mates
+skip_flags = 0x4 | 0x8 | 0x100 | 0x800  # Unmapped (mate), not primary
+first_flag = 0x40  # First mate of the pair
+
+
+def Is_CoordinateSorted(header_lines):
+    """
+    Whether the @HD header line says the file is sorted by coordinate
+    """
+    for line in header_lines:
+        if line.startswith('@HD'):
+            return 'SO:coordinate' in line.split()
+    return False
+
+
+class Mate_Spill():
+    """
+    Mates spilled to disk, in temp files partitioned by QNAME
+    """
+    def __init__(self):
+        import tempfile  # Only needed when spilling
+        self.tmp_dir = tempfile.mkdtemp(prefix='dreem_mates_')
+        self.files = [open(os.path.join(self.tmp_dir, str(i)), 'w')
+                      for i in range(n_partitions)]
+
+    def add(self, fields):
+        i = zlib.crc32(fields[0].encode()) % n_partitions
+        self.files[i].write('\t'.join(fields) + '\n')
+
+    def pairs(self, counts):
+        """
+        Pairs of the spilled mates, one partition at a time
+        """
+        for spill_file in self.files:
+            spill_file.close()
+        for spill_file in self.files:
+            buffer = {}
+            with open(spill_file.name) as f:
+                for line in f:
+                    fields = BitVector_Functions.Split_Record(line)
+                    mate = buffer.pop(fields[0], None)
+                    if mate is None:
+                        buffer[fields[0]] = fields
+                    else:
+                        yield Ordered_Pair(mate, fields)
+            counts['orphans'] += len(buffer)
+
+    def remove(self):
+        for spill_file in self.files:
+            spill_file.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+def Ordered_Pair(mate_a, mate_b):
+    """
+    The 2 mates, first mate first (as the aligner writes them)
+    """
+    if int(mate_a[1]) & first_flag:
+        return mate_a, mate_b
+    return mate_b, mate_a
+
+
+def Pair_Mates(records, counts):
+    """
+    Pair the mates of coordinate-sorted SAM records
+    Args:
+        records (iter): SAM lines, without the header lines
+        counts (dict): Incremented: 'pairs', 'orphans' (mates whose mate
+            is missing, unmapped or on another ref), 'skipped' (unmapped
+            and not primary records), 'spilled' (mates spilled to disk)
+    Yields:
+        (list, list): Split lines of the first and second mates
+    """
+    for key in ('pairs', 'orphans', 'skipped', 'spilled'):
+        counts.setdefault(key, 0)
+    buffer = {}  # QNAME: split line of the mate waiting for its mate
+    heap = []  # (PNEXT, QNAME) of the buffered mates
+    spill = None
+    cur_ref, cur_pos = None, 0
+
+    def Lost(fields):  # Mate not in memory: on disk, or no mate
+        if spill is not None:
+            spill.add(fields)
+            counts['spilled'] += 1
+        else:
+            counts['orphans'] += 1
+
+    try:
+        for line in records:
+            fields = BitVector_Functions.Split_Record(line)
+            if int(fields[1]) & skip_flags:
+                counts['skipped'] += 1
+                continue
+            q_name, ref, pos, pnext = fields[0], fields[2], int(fields[3]), \
+                int(fields[7])
+            if ref != cur_ref:  # Mates of the previous ref can not come now
+                for buffered in buffer.values():
+                    Lost(buffered)
+                buffer.clear()
+                del heap[:]
+                cur_ref, cur_pos = ref, 0
+            elif pos < cur_pos:
+                raise ValueError('SAM file is not sorted by coordinate: ' +
+                                 q_name + ' at ' + ref + ':' + str(pos))
+            cur_pos = pos
+            while heap and heap[0][0] < pos:  # Stream passed their mates
+                q_name_lost = heapq.heappop(heap)[1]
+                if q_name_lost in buffer:
+                    Lost(buffer.pop(q_name_lost))
+
+            if fields[6] != '=':  # Mate on another ref
+                counts['orphans'] += 1
+                continue
+            mate = buffer.pop(q_name, None)
+            if mate is not None:
+                counts['pairs'] += 1
+                yield Ordered_Pair(mate, fields)
+            elif pnext < pos:  # Its mate was before it
+                Lost(fields)
+            else:
+                buffer[q_name] = fields
+                heapq.heappush(heap, (pnext, q_name))
+                if len(buffer) > max_buffered:
+                    if spill is None:
+                        spill = Mate_Spill()
+                    for buffered in buffer.values():
+                        spill.add(buffered)
+                    counts['spilled'] += len(buffer)
+                    buffer.clear()
+                    del heap[:]
+
+        for buffered in buffer.values():
+            Lost(buffered)
+        if spill is not None:
+            for pair in spill.pairs(counts):
+                counts['pairs'] += 1
+                yield pair
+    finally:  # Also when the reader stops early
+        if spill is not None:
+            spill.remove()
+
+
+def Check():
+    """
+    Bit vectors of a small coordinate-sorted SAM file whose mates have
+    different MAPQs, with and without spilling to disk
+    """
+    import io
+    import BitVector
+    import BitVector_Pairing  # Also when run as __main__
+    ref_seq = 'ACGTTGCAAGCTTCGATCGGATCCAGTACGTTAGCCTAGGACTTGCAACGTAGCTAGGT'
+    refs_seq = {'chk': ref_seq}
+    # QNAME, FLAG, POS, MAPQ, PNEXT: interleaved pairs, an orphan and a
+    # secondary alignment
+    records = [('p1', 99, 1, 42, 11), ('p2', 99, 5, 0, 30),
+               ('orphan', 99, 8, 42, 25), ('p1', 147, 11, 3, 1),
+               ('p1', 355, 12, 1, 1), ('p2', 147, 30, 40, 5)]
+    lines = ['@HD\tVN:1.0\tSO:coordinate\n',
+             '@SQ\tSN:chk\tLN:{}\n'.format(len(ref_seq))]
+    for q_name, flag, pos, mapq, pnext in records:
+        lines.append('\t'.join([
+            q_name, str(flag), 'chk', str(pos), str(mapq), '20M', '=',
+            str(pnext), '0', ref_seq[pos - 1:pos + 19], 'I' * 20,
+            'MD:Z:20']) + '\n')
+    phred_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'phred_ascii.txt')
+    phred_qscore = BitVector_Functions.Parse_PhredFile(phred_file)
+
+    default_max = BitVector_Pairing.max_buffered
+    try:
+        for BitVector_Pairing.max_buffered in (default_max, 1):
+            mod_bases, mut_bases, delmut_bases, info_bases, cov_bases, \
+                num_reads = BitVector.Init_Counters(refs_seq, 1, 50)
+            sinks = {'chk': BitVector_Functions.BitVector_Sink(
+                None, 'chk', 'chk', ref_seq[:50], 1, 50, True)}
+            BitVector.Process_SamFile(io.StringIO(''.join(lines)), True,
+                                      refs_seq, 1, 50, phred_qscore, 20, 10,
+                                      cov_bases, info_bases, mod_bases,
+                                      mut_bases, delmut_bases, num_reads,
+                                      sinks)
+            sinks['chk'].close()
+            assert num_reads['chk'] == 2, num_reads
+    finally:
+        BitVector_Pairing.max_buffered = default_max
+    print('Mate pairing check passed.')
+
+
+if __name__ == '__main__':
+    Check()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+# Copyright (c) <2019> <The Whitehead Institute for Biomedical Research>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Machine-readable metrics of the pipeline stages.
+
+Each stage (mapping, bit vectors, bit vector filtering, EM clustering)
+appends one JSON record per ref to metrics.jsonl in the output dir of the
+job: input sizes, read and bit vector counts, filter counts, iterations and
+time of the EM runs, peak memory and output bytes. The log.txt files are
+still written for people; these are for scripts.
+
+Merge the records of a results tree into one table:
+    python DREEM_Metrics.py results_dir --out metrics.tsv
+"""
+import os
+import sys
+import json
+import argparse
+import datetime
+import resource
+
+metrics_name = 'metrics.jsonl'
+# Columns put first in the table, the others are sorted
+first_cols = ['time', 'stage', 'sample', 'ref', 'start', 'end', 'time_s',
+              'peak_rss_mb']
+
+
+def Peak_Memory_MB(children=False):
+    """
+    Peak RSS of this process (or of its largest child process) so far
+    """
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    max_rss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':  # Bytes on macOS, KB on Linux
+        max_rss /= 1024
+    return round(max_rss / 1024, 1)
+
+
+def File_Bytes(file_names):
+    """
+    Total size of the files that exist
+    """
+    return sum(os.path.getsize(file_name) for file_name in file_names
+               if os.path.isfile(file_name))
+
+
+def Dir_Bytes(dir_name, prefix=''):
+    """
+    Total size of the files under a dir whose names start with prefix
+    """
+    total = 0
+    for root, dirs, files in os.walk(dir_name):
+        total += File_Bytes([os.path.join(root, file_name) for file_name in
+                             files if file_name.startswith(prefix)])
+    return total
+
+
+def Record(output_dir, stage, sample_name, metrics):
+    """
+    Append the metrics of a stage to the metrics file of the job
+    """
+    record = {'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+              'stage': stage,
+              'sample': sample_name,
+              'host': os.uname().nodename,
+              'pid': os.getpid(),
+              'peak_rss_mb': Peak_Memory_MB()}
+    record.update(metrics)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    # One write of a whole line, so concurrent jobs don't mix their records
+    line = json.dumps(record, sort_keys=True) + '\n'
+    with open(os.path.join(output_dir, metrics_name), 'a') as metrics_file:
+        metrics_file.write(line)
+
+
+def Read_Records(results_dir):
+    """
+    All the metrics records under a results dir
+    """
+    records = []
+    for root, dirs, files in sorted(os.walk(results_dir)):
+        dirs.sort()
+        if metrics_name not in files:
+            continue
+        with open(os.path.join(root, metrics_name)) as metrics_file:
+            for line in metrics_file:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:  # Line cut by a killed job
+                    continue
+                record['metrics_dir'] = root
+                records.append(record)
+    return records
+
+
+def Flatten(record, prefix=''):
+    """
+    One level of columns: nested dicts become a.b, lists are JSON strings
+    """
+    row = {}
+    for key, value in record.items():
+        if isinstance(value, dict):
+            row.update(Flatten(value, prefix + key + '.'))
+        elif isinstance(value, list):
+            row[prefix + key] = json.dumps(value, sort_keys=True)
+        else:
+            row[prefix + key] = value
+    return row
+
+
+def Aggregate(results_dir, out_fileobj, stage=None):
+    """
+    Write the records of a results tree as a tab separated table
+    """
+    rows = [Flatten(record) for record in Read_Records(results_dir)
+            if stage is None or record['stage'] == stage]
+    all_cols = set(col for row in rows for col in row)
+    cols = [col for col in first_cols if col in all_cols] + \
+        sorted(all_cols.difference(first_cols))
+    out_fileobj.write('\t'.join(cols) + '\n')
+    for row in rows:
+        out_fileobj.write('\t'.join('' if row.get(col) is None else
+                                    str(row[col]) for col in cols) + '\n')
+    return len(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge the metrics records ' +
+                                     'of a results tree into one table')
+    parser.add_argument('results_dir', help='Directory with DREEM results')
+    parser.add_argument('--out', help='Output TSV file (default: stdout)')
+    parser.add_argument('--stage', help='Only the records of this stage')
+    args = parser.parse_args()
+
+    if args.out:
+        with open(args.out, 'w') as out_fileobj:
+            n_rows = Aggregate(args.results_dir, out_fileobj, args.stage)
+        print('{} records written to {}'.format(n_rows, args.out))
+    else:
+        Aggregate(args.results_dir, sys.stdout, args.stage)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+# Copyright (c) <2019> <The Whitehead Institute for Biomedical Research>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Per-stage profiling of a DREEM job (--profile option).
+
+The named stages of the pipeline are wrapped in Stage(), which does
+nothing unless profiling was enabled. When it is, each stage records its
+wall time, CPU time and number of calls (times are inclusive of the stages
+nested in it), and a few hot functions are wrapped the same way. Those are
+only patched when profiling is on, so a normal run pays nothing for them.
+
+Modes:
+    timers: stage timers only
+    cprofile: timers + cProfile of the main thread, dumped to profile.pstats
+    sample: timers + a sampling profiler of the main thread, written as
+            folded stacks to profile_samples.txt (flame graph input)
+Everything is written to profile.json in the output dir of the job.
+"""
+import os
+import sys
+import json
+import time
+import threading
+import importlib
+
+modes = ['timers', 'cprofile', 'sample']
+sample_interval = 0.005  # Seconds between two samples
+
+# Hot functions timed in profiling mode: module, function, stage name
+hot_functions = [('BitVector_Functions', 'Mate', 'sam_parse'),
+                 ('BitVector', 'Convert_Read', 'convert_read'),
+                 ('BitVector_Functions', 'Calc_Ambig_Reads',
+                  'calc_ambig_reads'),
+                 ('BitVector', 'Combine_Mates', 'combine_mates'),
+                 ('BitVector', 'Plotting_Variables', 'plotting_variables'),
+                 ('EM_Algorithm', 'Exp_Step', 'em_exp_step'),
+                 ('EM_Algorithm', 'Max_Step', 'em_max_step'),
+                 ('scipy.optimize', 'newton_krylov', 'em_newton_krylov')]
+
+enabled = False
+mode = None
+stages = {}  # stages[name] = [wall_s, cpu_s, count]
+stages_lock = threading.Lock()
+start_times = None
+profiler, sampler = None, None
+
+
+class Stage():
+    """
+    Timer of a named stage: with DREEM_Profile.Stage('name'): ...
+    """
+    __slots__ = ('name', 'wall', 'cpu')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if enabled:
+            self.wall, self.cpu = time.time(), time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if enabled:
+            Add_Time(self.name, time.time() - self.wall,
+                     time.process_time() - self.cpu)
+        return False
+
+
+def Add_Time(name, wall, cpu):
+    with stages_lock:
+        stage = stages.setdefault(name, [0.0, 0.0, 0])
+        stage[0] += wall
+        stage[1] += cpu
+        stage[2] += 1
+
+
+def Timed(func, name):
+    """
+    func wrapped in a Stage
+    """
+    def Timed_Func(*args, **kwargs):
+        with Stage(name):
+            return func(*args, **kwargs)
+    Timed_Func.__wrapped__ = func
+    return Timed_Func
+
+
+def Patch_HotFunctions():
+    """
+    Wrap the hot functions in timers, also in the script run as __main__
+    """
+    main_module = sys.modules.get('__main__')
+    main_name = os.path.splitext(os.path.basename(
+        getattr(main_module, '__file__', '') or ''))[0]
+    for module_name, func_name, name in hot_functions:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        modules = [module]
+        if main_name == module_name:
+            modules.append(main_module)
+        for mod in modules:
+            func = getattr(mod, func_name, None)
+            if func is not None and not hasattr(func, '__wrapped__'):
+                setattr(mod, func_name, Timed(func, name))
+
+
+class Sampler(threading.Thread):
+    """
+    Sampling profiler: counts the stacks of a thread at regular intervals
+    """
+    def __init__(self, thread_id, interval):
+        threading.Thread.__init__(self, daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.running = True
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(
+                    os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                folded = ';'.join(reversed(stack))
+                self.stacks[folded] = self.stacks.get(folded, 0) + 1
+            time.sleep(self.interval)
+
+
+def Enable(profile_mode):
+    """
+    Turn profiling on for the rest of the process
+    """
+    global enabled, mode, start_times, profiler, sampler
+    if profile_mode not in modes:
+        raise ValueError('Unknown profile mode: ' + str(profile_mode))
+    enabled, mode = True, profile_mode
+    start_times = (time.time(), time.process_time())
+    Patch_HotFunctions()
+    if mode == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif mode == 'sample':
+        sampler = Sampler(threading.get_ident(), sample_interval)
+        sampler.start()
+
+
+def Write(output_dir):
+    """
+    Write profile.json (and the pstats dump or the samples) to output_dir
+    """
+    if not enabled:
+        return
+    if profiler is not None:
+        profiler.disable()
+    if sampler is not None:
+        sampler.running = False
+        sampler.join()
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    output_dir = os.path.join(output_dir, '')
+
+    profile = {'mode': mode,
+               'command': ' '.join(sys.argv),
+               'wall_s': round(time.time() - start_times[0], 4),
+               'cpu_s': round(time.process_time() - start_times[1], 4),
+               'stages': {name: {'wall_s': round(wall, 4),
+                                 'cpu_s': round(cpu, 4),
+                                 'count': count}
+                          for (name, (wall, cpu, count)) in
+                          sorted(stages.items())}}
+    if profiler is not None:
+        profiler.dump_stats(output_dir + 'profile.pstats')
+        profile['pstats'] = output_dir + 'profile.pstats'
+    if sampler is not None:
+        with open(output_dir + 'profile_samples.txt', 'w') as f:
+            for folded, count in sorted(sampler.stacks.items()):
+                f.write('{} {}\n'.format(folded, count))
+        profile['samples'] = output_dir + 'profile_samples.txt'
+        profile['n_samples'] = sum(sampler.stacks.values())
+
+    with open(output_dir + 'profile.json', 'w') as f:
+        json.dump(profile, f, indent=4)
+    print('Profile written to', output_dir + 'profile.json')
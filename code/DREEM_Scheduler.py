@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+# Copyright (c) <2019> <The Whitehead Institute for Biomedical Research>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Dependency-aware scheduling of DREEM jobs.
+
+Control and experimental samples are analysed window by window. For each
+window, the control group stats are computed first (or reused if the
+control store already has them) and the experimental screening and EM for
+that window start as soon as they are ready. Jobs are started when the task
+they depend on finishes, so no job sits idle waiting for a file.
+"""
+import os
+import sys
+import argparse
+import queue
+import subprocess
+import threading
+import time
+from functools import partial
+import BitVector_Functions
+import EM_ControlStore
+
+
+class Task():
+    """
+    A step of the pipeline. It is started once all the tasks it depends on
+    are done. func returns False (or raises) on failure.
+    """
+    def __init__(self, name, func, deps=(), cpus=1, done=False):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.cpus = cpus
+        self.status = 'done' if done else 'waiting'
+        self.start_time, self.end_time = None, None
+
+
+def Run_Tasks(tasks, max_cpus, backfill=True):
+    """
+    Run a graph of tasks in threads. A task starts as soon as its
+    dependencies are done and its CPUs fit in the budget. Finished tasks
+    are reported through a queue. Returns True if all the tasks succeeded.
+    Ready tasks are started in the order of the list; without backfill,
+    a ready task that does not fit keeps the CPUs for itself, so the tasks
+    after it can not start until it has.
+    """
+    done_queue = queue.Queue()
+    pending = [task for task in tasks if task.status != 'done']
+    cpus_used, n_running = 0, 0
+
+    def Worker(task):
+        try:
+            ok = task.func() is not False
+        except Exception as e:
+            print('[error] Task {} failed: {}'.format(task.name, e))
+            ok = False
+        task.end_time = time.time()
+        done_queue.put((task, ok))
+
+    while pending or n_running:
+        for task in list(pending):  # Dependency failed
+            if any(dep.status in ('failed', 'skipped') for dep in task.deps):
+                task.status = 'skipped'
+                pending.remove(task)
+                print('[error] Task {} skipped.'.format(task.name))
+        for task in list(pending):  # Start the tasks that are ready
+            if all(dep.status == 'done' for dep in task.deps):
+                task.cpus = min(task.cpus, max_cpus)
+                if cpus_used + task.cpus > max_cpus:
+                    if backfill:
+                        continue
+                    break
+                cpus_used += task.cpus
+                n_running += 1
+                task.status = 'running'
+                task.start_time = time.time()
+                pending.remove(task)
+                threading.Thread(target=Worker, args=(task,),
+                                 daemon=True).start()
+        if not n_running:
+            for task in pending:  # Nothing can ever start these
+                task.status = 'skipped'
+                print('[error] Task {} skipped.'.format(task.name))
+            break
+        task, ok = done_queue.get()  # Wait for a task to finish
+        task.status = 'done' if ok else 'failed'
+        cpus_used -= task.cpus
+        n_running -= 1
+        print('[INFO] Task {} {}.'.format(task.name, task.status))
+
+    return all(task.status == 'done' for task in tasks)
+
+
+def Window_Dir(output_dir, sample_name, start, end):
+    """
+    Output directory of a sample for a window of the region
+    """
+    return os.path.join(output_dir, sample_name,
+                        '{}_{}_{}'.format(sample_name, start, end)) + '/'
+
+
+def Run_DREEM_Task(input_dir, out_dir, sample_name, ref_name, start, end,
+                   flags, log_name):
+    """
+    Run Run_DREEM.py for a window and check that it succeeded
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    cmd = [sys.executable, 'Run_DREEM.py', input_dir, out_dir, sample_name,
+           ref_name, str(start), str(end)] + flags
+    with open(out_dir + log_name, 'w') as log_file:
+        returncode = subprocess.call(cmd, stdout=log_file,
+                                     stderr=subprocess.STDOUT)
+    return returncode == 0
+
+
+def Run_CtrlStats_Task(input_dir, out_dir, sample_name, ref_name, start, end,
+                       flags, ctrl_store, refs):
+    """
+    Record the control group stats of a window
+    """
+    flags = flags + ['--ctrl', '--stats_only', '--ctrl_store', ctrl_store]
+    return Run_DREEM_Task(input_dir, out_dir, sample_name, ref_name, start,
+                          end, flags, 'Run_DREEM_stats.log') and \
+        Stats_Done(ctrl_store, refs, start, end)
+
+
+def Stats_Done(ctrl_store, refs, start, end):
+    """
+    Whether the control store has the stats of a window for all the refs
+    """
+    return all(EM_ControlStore.Is_Covered(ctrl_store, ref, start, end)
+               for ref in refs)
+
+
+def Pair_Tasks(ctrl_input_dir, exp_input_dir, output_dir, ctrl_name,
+               exp_name, ref_name, START, END, chunk_size, flags, ctrl_em):
+    """
+    Tasks for control/experiment pairs of every window of the region
+    """
+    # One control store for all the windows of the control sample
+    ctrl_store = EM_ControlStore.Default_Store(
+        Window_Dir(output_dir, ctrl_name, START, END), ctrl_name)
+    ref_file = os.path.join(ctrl_input_dir, ref_name + '.fasta')
+    refs = BitVector_Functions.Parse_FastaFile(ref_file)
+
+    # With --fastq, each sample is mapped once for all its windows
+    ctrl_flags, exp_flags = flags, flags
+    if '--fastq' in flags:
+        ctrl_flags = flags + ['--shared_dir', os.path.join(
+            output_dir, ctrl_name, 'shared')]
+        exp_flags = flags + ['--shared_dir', os.path.join(
+            output_dir, exp_name, 'shared')]
+
+    tasks = []
+    for start in range(START, END + 1, chunk_size):
+        end = min(start + chunk_size - 1, END)
+        ctrl_dir = Window_Dir(output_dir, ctrl_name, start, end)
+        exp_dir = Window_Dir(output_dir, exp_name, start, end)
+
+        # Control group stats of the window, reused if already computed
+        stats_done = Stats_Done(ctrl_store, refs, start, end)
+        ctrl_task = Task('{}_{}_{}_stats'.format(ctrl_name, start, end),
+                         partial(Run_CtrlStats_Task, ctrl_input_dir,
+                                 ctrl_dir, ctrl_name, ref_name, start, end,
+                                 ctrl_flags, ctrl_store, refs),
+                         done=stats_done)
+        tasks.append(ctrl_task)
+
+        # Screening and EM of the experimental sample
+        exp_task = Task('{}_{}_{}'.format(exp_name, start, end),
+                        partial(Run_DREEM_Task, exp_input_dir, exp_dir,
+                                exp_name, ref_name, start, end,
+                                exp_flags + ['--ctrl_store', ctrl_store],
+                                'Run_DREEM.log'),
+                        deps=[ctrl_task])
+        tasks.append(exp_task)
+
+        if ctrl_em:  # EM clustering of the control sample too
+            ctrl_em_task = Task('{}_{}_{}'.format(ctrl_name, start, end),
+                                partial(Run_DREEM_Task, ctrl_input_dir,
+                                        ctrl_dir, ctrl_name, ref_name, start,
+                                        end, ctrl_flags + ['--ctrl',
+                                                           '--ctrl_store',
+                                                           ctrl_store],
+                                        'Run_DREEM.log'),
+                                deps=[ctrl_task])
+            tasks.append(ctrl_em_task)
+    return tasks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run control/experiment ' +
+                                     'pairs of DREEM window by window')
+    parser.add_argument('ctrl_input_dir', help='Input dir of control sample')
+    parser.add_argument('exp_input_dir', help='Input dir of exp sample')
+    parser.add_argument('output_dir', help='Path to output directory')
+    parser.add_argument('ctrl_name', help='Name of control sample')
+    parser.add_argument('exp_name', help='Name of experimental sample')
+    parser.add_argument('ref_name', help='Name of reference genome')
+    parser.add_argument('START', help='Start pos in ref genome (1-based)')
+    parser.add_argument('END', help='End pos in ref genome (1-based)')
+    parser.add_argument('--chunk_size', type=int, default=100,
+                        help='Size of each window')
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='Number of jobs to run at the same time')
+    parser.add_argument('--ctrl_em', action='store_true',
+                        help='Also run EM clustering on the control sample')
+    parser.add_argument('--single', help='Single-end sequencing',
+                        action='store_true')
+    parser.add_argument('--struct', help='Sec structure prediction',
+                        action='store_true')
+    parser.add_argument('--fastq', help='No BAM file',
+                        action='store_true')
+    args = parser.parse_args()
+
+    flags = [flag for flag in ('single', 'struct', 'fastq')
+             if getattr(args, flag)]
+    flags = ['--' + flag for flag in flags]
+    tasks = Pair_Tasks(args.ctrl_input_dir, args.exp_input_dir,
+                       args.output_dir, args.ctrl_name, args.exp_name,
+                       args.ref_name, int(args.START), int(args.END),
+                       args.chunk_size, flags, args.ctrl_em)
+    if not Run_Tasks(tasks, args.jobs):
+        sys.exit(1)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+# Copyright (c) <2019> <The Whitehead Institute for Biomedical Research>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Artifacts shared by the window tasks of a sample: the Bowtie2 index of the
+ref genome and the alignment of the sample.
+
+Each is built by the first task that needs it, under an exclusive lock
+(fcntl.lockf, which also works across the nodes of a cluster on NFS),
+while the other tasks wait for the lock. A completion marker is written
+last, atomically, with what the artifact was built from; a task reuses the
+artifact only if the marker is there and matches its own inputs.
+"""
+import os
+import json
+import glob
+import fcntl
+import hashlib
+import subprocess
+from contextlib import contextmanager
+
+index_lock_ext, index_marker_ext = '.bt2.lock', '.bt2.sha256'
+
+
+@contextmanager
+def File_Lock(lock_filename):
+    """
+    Exclusive lock on a file, created if needed
+    """
+    with open(lock_filename, 'a') as lock_file:
+        fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+
+def Sha256(filename, block_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def File_Info(filename):
+    """
+    Path, size and mtime of a file, to tell if it changed
+    """
+    stat = os.stat(filename)
+    return [os.path.abspath(filename), stat.st_size, int(stat.st_mtime)]
+
+
+def Write_Atomic(filename, text):
+    with open(filename + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(filename + '.tmp', filename)
+
+
+def Is_Done(marker_file, inputs):
+    """
+    Whether marker_file was written for these inputs
+    """
+    if not os.path.exists(marker_file):
+        return False
+    with open(marker_file) as f:
+        try:
+            return json.load(f) == inputs
+        except ValueError:
+            return False
+
+
+def Mark_Done(marker_file, inputs):
+    Write_Atomic(marker_file, json.dumps(inputs, sort_keys=True))
+
+
+def Build_Index(ref_fasta, index_basename):
+    """
+    Build the Bowtie2 index of a ref genome unless a complete index of the
+    same fasta file is there. Returns the checksum of the fasta file.
+    """
+    checksum = Sha256(ref_fasta)
+    marker_file = index_basename + index_marker_ext
+    with File_Lock(index_basename + index_lock_ext):
+        if os.path.exists(index_basename + '.4.bt2') and \
+                os.path.exists(marker_file) and \
+                open(marker_file).read().strip() == checksum:
+            return checksum
+        print('Building the Bowtie2 index of', ref_fasta)
+        tmp_basename = index_basename + '_tmp'
+        subprocess.check_call(['bowtie2-build', ref_fasta, tmp_basename],
+                              stdout=subprocess.DEVNULL)
+        for tmp_file in glob.glob(tmp_basename + '.*.bt2*'):
+            os.replace(tmp_file, index_basename + tmp_file[len(tmp_basename):])
+        Write_Atomic(marker_file, checksum + '\n')
+    return checksum
+
+
+def Link_File(target, link_name):
+    """
+    Symlink link_name to target, replacing any file at link_name
+    """
+    if not os.path.exists(os.path.dirname(link_name)):
+        os.makedirs(os.path.dirname(link_name))
+    tmp_link = link_name + '.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.abspath(target), tmp_link)
+    os.replace(tmp_link, link_name)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+# Copyright (c) <2019> <The Whitehead Institute for Biomedical Research>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Live status of a running DREEM job.
+
+The job keeps status.json in its output dir up to date: the current stage,
+the records processed with their rate, the progress and ETA when the size
+of the input is known (bytes of the SAM file read by BitVector), and the
+current K, run, iteration and log likelihood of the EM. The file is
+replaced atomically, at most once every update_interval seconds.
+
+With --status_port, the same status is served as JSON on
+http://127.0.0.1:<port>/status (read-only) for dashboards.
+
+Print the status of the jobs under a results dir:
+    python DREEM_Status.py results_dir
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import threading
+
+status_name = 'status.json'
+update_interval = 1.0  # Min seconds between two writes of the status file
+
+enabled = False
+status_file = None
+status = {}
+status_lock = threading.Lock()
+write_lock = threading.Lock()  # Threads of a job share the temp file
+last_write = 0.0
+stage_start = 0.0
+server = None
+
+
+def Enable(output_dir, sample_name, port=None):
+    """
+    Keep a status file in output_dir, and serve it on port if given
+    """
+    global enabled, status_file
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    status_file = os.path.join(output_dir, status_name)
+    now = time.time()
+    with status_lock:
+        status.clear()
+        status.update({'sample': sample_name,
+                       'state': 'running',
+                       'host': os.uname().nodename,
+                       'pid': os.getpid(),
+                       'command': ' '.join(sys.argv),
+                       'started': Time_String(now),
+                       'stage': None})
+    enabled = True
+    if port:
+        Serve(port)
+    Write_Status()
+
+
+def Time_String(secs):
+    return datetime.datetime.fromtimestamp(secs).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def Set_Stage(stage, **fields):
+    """
+    Start a new stage. fields describe it (ref, K, run...)
+    """
+    global stage_start
+    if not enabled:
+        return
+    stage_start = time.time()
+    with status_lock:
+        for key in ('processed', 'rate_per_s', 'done', 'total', 'percent',
+                    'eta_s', 'iteration', 'log_like'):
+            status.pop(key, None)
+        status['stage'] = stage
+        status['stage_started'] = Time_String(stage_start)
+        status.update(fields)
+    Write_Status()
+
+
+def Update(processed=None, done=None, total=None, **fields):
+    """
+    Progress of the current stage: records processed, and done out of total
+    (in any unit, e.g. bytes) for the ETA. Writes at most every
+    update_interval seconds.
+    """
+    if not enabled:
+        return
+    now = time.time()
+    elapsed = max(now - stage_start, 1e-6)
+    with status_lock:
+        if processed is not None:
+            status['processed'] = processed
+            status['rate_per_s'] = round(processed / elapsed, 1)
+        if total:
+            status['done'], status['total'] = done, total
+            status['percent'] = round(100.0 * done / total, 1)
+            status['eta_s'] = round(elapsed * (total - done) / done, 1) \
+                if done else None
+        status.update(fields)
+    if now - last_write >= update_interval:
+        Write_Status()
+
+
+def Finish(state):
+    """
+    End of the job: state is 'done' or 'failed'
+    """
+    if not enabled:
+        return
+    with status_lock:
+        status['state'] = state
+        status['finished'] = Time_String(time.time())
+    Write_Status()
+
+
+def Current_Status():
+    with status_lock:
+        current = dict(status)
+    current['updated'] = Time_String(time.time())
+    return current
+
+
+def Write_Status():
+    """
+    Replace the status file atomically
+    """
+    global last_write
+    with write_lock:
+        last_write = time.time()
+        tmp_file = '{}.{}.tmp'.format(status_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(Current_Status(), f, indent=4, sort_keys=True)
+        os.replace(tmp_file, status_file)
+
+
+def Serve(port):
+    """
+    Serve the status on 127.0.0.1:port in a background thread. GET /status
+    (or /): the status as JSON. Nothing else is served.
+    """
+    global server
+    # Only needed with a port: not imported by every job
+    import socketserver
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+    class Status_Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/status'):
+                self.send_error(404)
+                return
+            body = json.dumps(Current_Status(), sort_keys=True).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # Keep the job output clean
+            pass
+
+    class Status_Server(socketserver.ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Status_Server(('127.0.0.1', port), Status_Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('Status served on http://127.0.0.1:{}/status'.format(port))
+
+
+def Status_Line(job_status):
+    """
+    One line summary of the status of a job
+    """
+    fields = [job_status.get('sample'), job_status.get('state'),
+              job_status.get('stage')]
+    for key in ('ref', 'K', 'run', 'iteration', 'log_like', 'processed',
+                'rate_per_s', 'percent', 'eta_s'):
+        if job_status.get(key) is not None:
+            fields.append('{}={}'.format(key, job_status[key]))
+    fields.append('updated ' + str(job_status.get('updated')))
+    return ' '.join(str(field) for field in fields)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Status of the DREEM jobs ' +
+                                     'under a results dir')
+    parser.add_argument('results_dir', help='Directory with DREEM results')
+    args = parser.parse_args()
+
+    for root, dirs, files in sorted(os.walk(args.results_dir)):
+        dirs.sort()
+        if status_name in files:
+            with open(os.path.join(root, status_name)) as f:
+                print(root + ': ' + Status_Line(json.load(f)))
@@ -13,26 +13,27 @@ Created on Tue Jul 30 2019
 
 @author: harish
 """
+from math import log
 import numpy as np
-import scipy.special
-from scipy.optimize import newton_krylov
 from multiprocessing.dummy import Pool as ThreadPool
 import EM_Functions
+import DREEM_Status
 import sys
 sys.setrecursionlimit(10000)
 
-def Run_EM(X, K, MIN_ITS, CONV_CUTOFF, CPUS):
+def Run_EM(X, K, MIN_ITS, CONV_CUTOFF, CPUS, block_rows=None):
     """
     Run the EM algorithm on the bit vector data contained in X.
+    block_rows: rows per block of the E-step (see EM_Plan)
     """
     conv_string = 'Log like converged after {:d} iterations'
     N, D = X.BV_Matrix.shape[0], X.BV_Matrix.shape[1]
 
     # Start and end coordinates of matrix for each thread
-    calc_inds = EM_Functions.calc_matrixIndices(N, K, CPUS)
+    calc_inds = EM_Functions.calc_matrixIndices(N, K, CPUS, block_rows)
     
     avg_mut_rates = np.array([X.mut_popavg[d] for d in range(D)])
-    mean_rate = np.mean(avg_mut_rates)
+    mean_rate = X.mut_popavg.sum() / X.n_positions  # Dropped columns are 0
     perturbation_scale = mean_rate * 1.00  # Perturbation scale
 
     mu = np.asarray([avg_mut_rates for k in range(K)])
@@ -67,6 +68,7 @@ def Run_EM(X, K, MIN_ITS, CONV_CUTOFF, CPUS):
         mu = np.clip(mu, 0, 1) # Ensure mu is in valid range
 
         log_like_list.append(log_like)
+        DREEM_Status.Update(iteration=iteration, log_like=float(log_like))
         mu_list.append(mu)
         obs_pi_list.append(obs_pi)
         real_pi_list.append(real_pi)
@@ -84,48 +86,35 @@ def Run_EM(X, K, MIN_ITS, CONV_CUTOFF, CPUS):
     final_mu = mu_list[-1]
     final_obs_pi, final_real_pi = obs_pi_list[-1], real_pi_list[-1]
 
-    BIC = EM_Functions.calc_BIC(N, D, K, log_like_list[-1])
+    # Dropped positions still count in the BIC, as when they were all 0
+    BIC = EM_Functions.calc_BIC(N, X.n_positions, K, log_like_list[-1])
     return (log_like_list, final_mu, final_obs_pi, final_real_pi, resps, BIC)
 
 
 def Exp_Step(X, K, mu, pi, calc_inds, CPUS):
     """
     """
-    N, D = X.BV_Matrix.shape[0], X.BV_Matrix.shape[1]
+    N = X.BV_Matrix.shape[0]
     log_pi = np.log(pi)
-    log_pmf = np.zeros((N, D, K))
-    denom = [EM_Functions.calc_denom(0, mu[k], {}, {}) for k in range(K)]
-
-    input_array1 = [[X, mu, ind, k] for ind in calc_inds for k in range(K)]
-    pool1 = ThreadPool(CPUS)
-    logpmf_results1 = pool1.starmap(EM_Functions.logpmf_function1,
-                                    input_array1)
-    pool1.close()
-    pool1.join()
-    for i in range(len(logpmf_results1)):
-        ind, k = input_array1[i][2], input_array1[i][3]
-        start, end = ind[0], ind[1]
-        log_pmf[start:end + 1, :, k] = logpmf_results1[i]
-
-    min_log_pmf = -20  # Avoid underflow
-    log_pmf = np.maximum(log_pmf, min_log_pmf)
-
-    log_pmf = np.sum(log_pmf, axis=1)  # Sum of log - like taking product
-
-    input_array2 = [[log_pmf, denom, ind, k] for ind in calc_inds
-                    for k in range(K)]
-    pool2 = ThreadPool(CPUS)
-    logpmf_results2 = pool2.starmap(EM_Functions.logpmf_function2,
-                                    input_array2)
-    pool2.close()
-    pool2.join()
-    for i in range(len(logpmf_results2)):
-        ind, k = input_array2[i][2], input_array2[i][3]
-        start, end = ind[0], ind[1]
-        log_pmf[start:end + 1, k] = logpmf_results2[i]
+    log_pmf = np.zeros((N, K))
+    full_mu = [EM_Functions.expand_mu(mu[k], X.positions, X.n_positions)
+               for k in range(K)]  # Mus in window coordinates
+    denom = [EM_Functions.calc_denom(0, full_mu[k], {}, {}) for k in range(K)]
+
+    # Row blocks in threads: only CPUS blocks of N x D x K are in memory
+    input_array = [[X, mu, ind, K] for ind in calc_inds]
+    pool = ThreadPool(CPUS)
+    logpmf_results = pool.starmap(EM_Functions.logpmf_block, input_array)
+    pool.close()
+    pool.join()
+    for ind, logpmf_result in zip(calc_inds, logpmf_results):
+        log_pmf[ind[0]:ind[1] + 1] = logpmf_result
+
+    log_pmf -= np.array([log(denom[k][0]) for k in range(K)])
 
     log_resps_numer = np.add(log_pi, log_pmf)
-    log_resps_denom = scipy.special.logsumexp(log_resps_numer, axis=1)
+    from scipy.special import logsumexp
+    log_resps_denom = logsumexp(log_resps_numer, axis=1)
     log_resps = np.subtract(log_resps_numer.T, log_resps_denom).T
     resps = np.exp(log_resps)
 
@@ -136,14 +125,15 @@ def Exp_Step(X, K, mu, pi, calc_inds, CPUS):
 def Max_Step(X, K, mu, resps, denom):
     """
     """
+    from scipy.optimize import newton_krylov
     D = X.BV_Matrix.shape[1]
     mu, obs_pi, real_pi = np.zeros((K, D)), np.zeros(K), np.zeros(K)
     for k in range(K):
         N_k = np.sum(resps[:, k] * X.BV_Abundance)
         x_bar_k = np.sum((resps[:, k] * X.BV_Abundance *
                           X.BV_Matrix.T).T, axis=0) / N_k
-        upd_mu = newton_krylov(lambda mu_k: EM_Functions.mu_der(mu_k, x_bar_k),
-                               mu[k])
+        upd_mu = newton_krylov(lambda mu_k: EM_Functions.mu_der(
+            mu_k, x_bar_k, X.positions, X.n_positions), mu[k])
         mu[k] = upd_mu  # Mu with denom correction
         obs_pi[k] = N_k / X.n_bitvectors
     real_pi = [obs_pi[k] / denom[k][0] for k in range(K)]
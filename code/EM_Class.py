@@ -13,40 +13,62 @@ Created on Tue Jul 30 2019
 
 @author: harish
 
-Class for a Bit Vector matrix
+Class for a Bit Vector matrix and for the result of an EM run
 """
 import numpy as np
-import random
 
 
 class BV_Object():
     """
+    Unique bit vectors restricted to the positions used by the EM. The
+    positions are indices in the window of the bit vector file, whose
+    width is n_positions (seq is shorter if the window runs past the ref
+    end). weights is the number of reads of each row of bits (collapsed
+    reads), 1 if None.
     """
-    def __init__(self, bit_vectors, mut_popavg, n_discard, ref_file,
-                 ref, seq, infiles_dir, indices):
-        BV_Matrix, BV_Abundance, n_occur = [], [], {}
-        for bit_vector in bit_vectors:
-            bit_vector = tuple(bit_vector)  # Change to a tuple
-            if bit_vector in n_occur:
-                n_occur[bit_vector] += 1
-            else:
-                n_occur[bit_vector] = 1
-        for bit_vector in n_occur:
-            bv = np.array(list(map(float, bit_vector)))  # Convert to float
-            BV_Matrix.append(bv)
-            BV_Abundance.append(n_occur[bit_vector])
-
-        BV_Matrix = np.array(BV_Matrix)
-        BV_Abundance = np.array(BV_Abundance)
+    def __init__(self, bits, positions, n_positions, mut_popavg, n_discard,
+                 ref_file, ref, seq, infiles_dir, indices, filter_counts=None,
+                 weights=None):
+        if weights is None:
+            BV_Matrix, first_index, BV_Abundance = np.unique(
+                bits, axis=0, return_index=True, return_counts=True)
+        else:  # Abundance in reads
+            BV_Matrix, first_index, inverse = np.unique(
+                bits, axis=0, return_index=True, return_inverse=True)
+            BV_Abundance = np.bincount(inverse.ravel(), weights,
+                                       minlength=len(BV_Matrix))
+            BV_Abundance = BV_Abundance.astype(np.int64)
+        order = np.argsort(first_index)  # Order of first occurrence
+        BV_Matrix = BV_Matrix[order].astype(float)
+        BV_Abundance = BV_Abundance[order]
         self.BV_Matrix = BV_Matrix  # Only unique bit vectors
         self.BV_Abundance = BV_Abundance  # Abundance of each bit vector
-        self.n_occur = n_occur
-        self.n_bitvectors = len(bit_vectors)
-        self.n_unique_bitvectors = len(n_occur.keys())
+        self.positions = positions  # Window index of each column
+        self.n_positions = n_positions  # Width of the window
+        self.n_bitvectors = int(BV_Abundance.sum())
+        self.n_unique_bitvectors = len(BV_Matrix)
         self.n_discard = n_discard
+        self.filter_counts = filter_counts  # Bit vectors removed by filter
         self.mut_popavg = mut_popavg
         self.ref = ref
         self.ref_file = ref_file
         self.seq = seq
         self.infiles_dir = infiles_dir
         self.indices = indices
+
+
+class EM_Run():
+    """
+    Result of a single EM run, kept in memory for picking the best run
+    """
+    def __init__(self, K, run, log_like_list, mu, obs_pi, real_pi, BIC,
+                 run_dir):
+        self.K = K
+        self.run = run
+        self.log_like_list = log_like_list
+        self.log_like = log_like_list[-1]  # Largest log likelihood
+        self.mu = mu
+        self.obs_pi = obs_pi
+        self.real_pi = real_pi
+        self.BIC = BIC
+        self.run_dir = run_dir
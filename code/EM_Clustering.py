@@ -23,14 +23,30 @@ import EM_Plots
 import EM_CombineRuns
 import Run_EMJobs
 import EM_Files
+import EM_ControlStore
+import DREEM_Profile
+import DREEM_Metrics
+import DREEM_Status
+import EM_Plan
 import sys
 sys.setrecursionlimit(10000)
 
-def EM_Clustering():
+def EM_Clustering(sample_name, refs_seq, START, END, MIN_ITS, INFO_THRESH,
+                  CONV_CUTOFF, NUM_RUNS, MAX_K, CPUS, NORM_PERC_BASES, exc_AC,
+                  SIG_THRESH, struct, input_dir, output_dir, ctrl, ctrl_store,
+                  stats_only=False, sinks=None, mem_cap_mb=0):
     """
+    sinks: bit vectors kept in memory by BitVector, per ref. The bit vector
+    files are read for the refs not in there.
+    mem_cap_mb: memory cap of the job, the EM runs are planned to fit in it
+    (see EM_Plan). 0 for no cap.
     """
     print('Starting EM clustering...')
 
+    outfiles_dir = output_dir + '/EM_Clustering/'
+    if not os.path.exists(outfiles_dir):
+        os.makedirs(outfiles_dir)
+
     for ref in refs_seq:  # Each seq in the ref genome
 
         start_time = time.time()
@@ -47,35 +63,99 @@ def EM_Clustering():
         wind_size = int(END) - int(START)
         norm_bases = int((wind_size * NORM_PERC_BASES) / 100)
 
-        # Read the bit vector file and do the filtering
-        input_file = output_dir + '/BitVector_Files/' + bvfile_basename + \
-            '_bitvectors.txt'
-        X = EM_Files.Load_BitVectors(input_file, INFO_THRESH, SIG_THRESH,
-                                     exc_AC, output_dir, ctrl)
+        # Read the bit vectors and do the filtering
+        input_bytes = 0
+        DREEM_Status.Set_Stage('em_load_bitvectors', ref=ref)
+        with DREEM_Profile.Stage('em_load_bitvectors'):
+            if sinks and ref in sinks:
+                X = EM_Files.Create_BVObject(sinks[ref].header,
+                                             sinks[ref].chunks, INFO_THRESH,
+                                             SIG_THRESH, exc_AC, output_dir,
+                                             ctrl, ctrl_store,
+                                             len(refs_seq[ref]))
+            else:
+                input_file = output_dir + '/BitVector_Files/' + \
+                    bvfile_basename + '_bitvectors.txt'
+                input_bytes = DREEM_Metrics.File_Bytes([input_file])
+                X = EM_Files.Load_BitVectors(input_file, INFO_THRESH,
+                                             SIG_THRESH, exc_AC, output_dir,
+                                             ctrl, ctrl_store,
+                                             len(refs_seq[ref]))
+        DREEM_Metrics.Record(output_dir, 'em_load', sample_name, {
+            'ref': ref, 'start': START, 'end': END, 'ctrl': ctrl,
+            'time_s': round(time.time() - start_time, 2),
+            'input_bytes': input_bytes,
+            'removed': X.filter_counts,
+            'n_bitvectors': X.n_bitvectors,
+            'n_unique_bitvectors': X.n_unique_bitvectors,
+            'n_positions': len(X.positions)})
+        if stats_only:  # Only the control group stats were needed
+            print('Control group stats done for', bvfile_basename)
+            continue
+
+        # Memory and run time of the EM runs, and how to do them
+        plan = EM_Plan.Plan_EM(X.n_unique_bitvectors, len(X.positions),
+                               MAX_K, NUM_RUNS, MIN_ITS, CPUS, mem_cap_mb)
+        EM_Plan.Print_Plan(plan)
+        DREEM_Metrics.Record(output_dir, 'em_plan', sample_name,
+                             dict(plan, ref=ref, start=START, end=END))
 
         K = 1  # Number of clusters
         cur_BIC = float('inf')  # Initialize BIC
         BIC_failed = False  # While test is not passed
+        runs_metrics = []  # Iterations and time of each run
         while not BIC_failed and K <= MAX_K:
             print('Working on K =', K)
 
             RUNS = NUM_RUNS if K != 1 else 1  # Only 1 Run for K=1
             ITS = MIN_ITS if K != 1 else 10  # Only 10 iters for K=1
+            K_plan = plan['per_K'][K]
+
+            timed_runs = []  # EM runs and their time
+            if K_plan['workers'] > 1:  # Restarts in parallel
+                print('Runs 1 to {} in {} processes'.format(
+                    RUNS, K_plan['workers']))
+                DREEM_Status.Set_Stage('em_run', ref=ref, K=K, runs=RUNS,
+                                       workers=K_plan['workers'],
+                                       max_K=MAX_K)
+                timed_runs = Run_EMJobs.Run_EMJobs_Parallel(
+                    X, bvfile_basename, ITS, INFO_THRESH, CONV_CUTOFF,
+                    SIG_THRESH, outplot_dir, K, K_plan['threads'],
+                    list(range(1, RUNS + 1)), K_plan['block_rows'],
+                    K_plan['workers'])
+            else:
+                for run in range(1, RUNS + 1):
+                    print('Run number:', run)
+                    DREEM_Status.Set_Stage('em_run', ref=ref, K=K, run=run,
+                                           runs=RUNS, max_K=MAX_K)
+                    run_start = time.time()
+                    em_run = Run_EMJobs.Run_EMJob(X, bvfile_basename, ITS,
+                                                  INFO_THRESH, CONV_CUTOFF,
+                                                  SIG_THRESH, outplot_dir, K,
+                                                  CPUS, run,
+                                                  K_plan['block_rows'])
+                    timed_runs.append((em_run, time.time() - run_start))
 
-            for run in range(1, RUNS + 1):
-                print('Run number:', run)
-                Run_EMJobs.Run_EMJob(X, bvfile_basename, ITS, INFO_THRESH,
-                                     CONV_CUTOFF, SIG_THRESH,
-                                     outplot_dir, K, CPUS, run)
+            em_runs = []
+            for em_run, run_seconds in timed_runs:
+                em_runs.append(em_run)
+                runs_metrics.append({
+                    'K': K, 'run': em_run.run,
+                    'iterations': len(em_run.log_like_list),
+                    'time_s': round(run_seconds, 2),
+                    'log_like': float(em_run.log_like),
+                    'BIC': float(em_run.BIC)})
 
             # Processing of results from the EM runs
-            EM_CombineRuns.Post_Process(bvfile_basename, K, RUNS,
-                                        cur_BIC, norm_bases, struct,
-                                        input_dir, outplot_dir)
+            DREEM_Status.Set_Stage('em_post_process', ref=ref, K=K)
+            with DREEM_Profile.Stage('em_post_process'):
+                best_run = EM_CombineRuns.Post_Process(bvfile_basename, K,
+                                                       em_runs, norm_bases,
+                                                       struct, input_dir,
+                                                       outplot_dir, CPUS)
 
             # Check BIC
-            latest_BIC = EM_CombineRuns.Collect_BestBIC(bvfile_basename, K,
-                                                        outplot_dir)
+            latest_BIC = best_run.BIC
             if latest_BIC > cur_BIC:  # BIC test has failed
                 BIC_failed = True
             cur_BIC = latest_BIC  # Update BIC
@@ -91,6 +171,15 @@ def EM_Clustering():
                           CONV_CUTOFF, INFO_THRESH, SIG_THRESH, exc_AC,
                           norm_bases, K - 2, time_taken, outplot_dir)
 
+        DREEM_Metrics.Record(output_dir, 'em_clustering', sample_name, {
+            'ref': ref, 'start': START, 'end': END,
+            'time_s': round(end_time - start_time, 2),
+            'K': K - 2,
+            'iterations': sum(run['iterations'] for run in runs_metrics),
+            'runs': runs_metrics,
+            'output_bytes': DREEM_Metrics.Dir_Bytes(outplot_dir)})
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='EM Clustering')
     parser.add_argument('sample_name', help='Name of sample')
@@ -110,6 +199,17 @@ if __name__ == '__main__':
     parser.add_argument('input_dir', help='Directory with input files')
     parser.add_argument('output_dir', help='Directory with output files')
     parser.add_argument('ctrl', help='Control sample')
+    parser.add_argument('--ctrl_store', default='',
+                        help='Control group stats store')
+    parser.add_argument('--stats_only', action='store_true',
+                        help='Only record control group stats, no EM')
+    parser.add_argument('--profile', nargs='?', const='timers',
+                        choices=DREEM_Profile.modes,
+                        help='Profile the stages (default mode: timers)')
+    parser.add_argument('--status_port', type=int,
+                        help='Serve the job status on 127.0.0.1:PORT')
+    parser.add_argument('--mem_cap_mb', type=float, default=0,
+                        help='Memory cap of the job in MB, to plan the EM')
     args = parser.parse_args()
     sample_name = args.sample_name
     ref_name = args.ref_name
@@ -128,12 +228,30 @@ if __name__ == '__main__':
     input_dir = args.input_dir
     output_dir = args.output_dir
     ctrl = args.ctrl
+    ctrl_store = args.ctrl_store
+    stats_only = args.stats_only
 
     ref_file = input_dir + ref_name + '.fasta'
     refs_seq = BitVector_Functions.Parse_FastaFile(ref_file)  # Ref seqs
 
-    outfiles_dir = output_dir + '/EM_Clustering/'
-    if not os.path.exists(outfiles_dir):
-        os.makedirs(outfiles_dir)
+    if not ctrl_store:
+        if ctrl != 'True':
+            parser.error('--ctrl_store is needed for an experimental sample')
+        ctrl_store = EM_ControlStore.Default_Store(output_dir, sample_name)
 
-    EM_Clustering()
+    DREEM_Status.Enable(output_dir, sample_name, args.status_port)
+    if args.profile:
+        DREEM_Profile.Enable(args.profile)
+    try:
+        EM_Clustering(sample_name, refs_seq, START, END, MIN_ITS,
+                      INFO_THRESH, CONV_CUTOFF, NUM_RUNS, MAX_K, CPUS,
+                      NORM_PERC_BASES, exc_AC, SIG_THRESH, struct, input_dir,
+                      output_dir, ctrl, ctrl_store, stats_only,
+                      mem_cap_mb=args.mem_cap_mb)
+    except BaseException:
+        DREEM_Status.Finish('failed')
+        raise
+    else:
+        DREEM_Status.Finish('done')
+    finally:
+        DREEM_Profile.Write(output_dir)
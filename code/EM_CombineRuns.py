@@ -13,78 +13,53 @@ Created on Tue Jul 30 2019
 
 @author: harish
 """
-import argparse
 import os
+import shutil
 import EM_Plots
-import EM_ExpandFold
-import EM_ScatterClusters
+import DREEM_Profile
 
 
-def Collect_BestBIC(sample_name, K, outfiles_dir):
+def Post_Process(sample_name, K, em_runs, norm_bases, struct, input_dir,
+                 outfiles_dir, CPUS=1):
     """
+    Pick the best of the EM runs for a K, record all of them and do the
+    downstream analysis on the best run. Returns the best run.
     """
-    K_dir = outfiles_dir + 'K_' + str(K) + '/'
-    loglikes_file_name = K_dir + 'log_likelihoods.txt'
-    loglikes_file = open(loglikes_file_name)
-    for line in loglikes_file:
-        line_split = line.strip().split()
-        run_info = line_split[0]
-        if run_info[-4:] == 'best':  # BIC from best run
-            BIC = float(line_split[2])
-            return BIC
-
-
-def Post_Process(sample_name, K, RUNS, cur_BIC, norm_bases,
-                 struct, input_dir, outfiles_dir):
-    """
-    """
-    largest_loglike, BICs, log_likes, best_run = float('-inf'), [], [], ''
-
-    for run in range(1, RUNS + 1):
-        run_dir = outfiles_dir + '/K_' + str(K) + '/' + \
-                      'run_' + str(run) + '/'
-
-        largest_loglikefilename = run_dir + 'Largest_LogLike.txt'
-        largest_loglikefile = open(largest_loglikefilename)
-        log_like = float(largest_loglikefile.readline())
-        largest_loglikefile.close()
-
-        BIC_filename = run_dir + 'BIC.txt'
-        BIC_file = open(BIC_filename)
-        BIC = float(BIC_file.readline())
-        BIC_file.close()
-
-        log_likes.append(log_like)
-        BICs.append(BIC)
-
-        if log_like > largest_loglike:
-            largest_loglike = log_like
-            best_run = run
-
-        os.system('rm ' + run_dir + 'Largest_LogLike.txt')
-        os.system('rm ' + run_dir + 'BIC.txt')
+    RUNS = len(em_runs)
+    log_likes = [em_run.log_like for em_run in em_runs]
+    BICs = [em_run.BIC for em_run in em_runs]
+    best = max(em_runs, key=lambda em_run: em_run.log_like)
 
     # Write to log likelihoods file
     EM_Plots.LogLikes_File(sample_name, K, RUNS, log_likes, BICs,
-                           best_run, outfiles_dir)
+                           best.run, outfiles_dir)
 
     # Rename directory of best run
-    orig_dir = outfiles_dir + 'K_' + str(K) + '/' + \
-        'run_' + str(best_run) + '/'
+    orig_dir = best.run_dir
     new_dir = outfiles_dir + 'K_' + str(K) + '/' + \
-        'run_' + str(best_run) + '-best/'
-    os.system('mv ' + orig_dir + ' ' + new_dir)
+        'run_' + str(best.run) + '-best/'
+    if os.path.exists(new_dir):  # Left over from an interrupted job
+        shutil.rmtree(new_dir)
+    os.rename(orig_dir, new_dir)
+    best.run_dir = new_dir
 
     clustmu_file = new_dir + 'Clusters_Mu.txt'
 
     # Folding with RNAstructure
     if struct == 'True':
+        import EM_ExpandFold
         # Num bases on each side of region for secondary structure prediction
         num_bases = [0, 50, 100, 150, 200]
-        for num_base in num_bases:
-            EM_ExpandFold.ConstraintFoldDraw(input_dir, clustmu_file,
-                                             num_base, num_base, norm_bases)
+        with DREEM_Profile.Stage('em_fold'):
+            EM_ExpandFold.ConstraintFoldDraw(
+                input_dir, clustmu_file,
+                [(num_base, num_base) for num_base in num_bases], norm_bases,
+                outfiles_dir + 'Fold_Cache/', CPUS)
 
     # Scatter plot of reactivities
     if K > 1:
-        EM_ScatterClusters.Scatter_Clusters(input_dir, clustmu_file)
+        import EM_ScatterClusters
+        with DREEM_Profile.Stage('em_scatter_plots'):
+            EM_ScatterClusters.Scatter_Clusters(input_dir, clustmu_file)
+
+    return best
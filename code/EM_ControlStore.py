@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+# Copyright (c) <2019> <The Whitehead Institute for Biomedical Research>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Store of the control group stats of a control sample.
+
+One store per control sample holds the number of mutated and informative
+bits at every position of the reference genomes, so experimental samples
+can take the stats of any window from it, however either sample was
+chunked. The store is a binary file of int64 rows (mut_count, info_count,
+covered), one row per genomic position, with an index file (store + '.idx')
+giving the first row and length of each reference. Writers take a lock on
+store + '.lock', readers don't need it.
+"""
+import os
+import json
+import fcntl
+import numpy as np
+from contextlib import contextmanager
+
+n_cols = 3  # mut_count, info_count, covered
+
+
+@contextmanager
+def Store_Lock(store_file):
+    """
+    Exclusive lock for writing to a store
+    """
+    with open(store_file + '.lock', 'a') as lock_file:
+        fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+
+def Read_Index(store_file):
+    """
+    Index of a store. Format: index[ref] = [first row, length]
+    """
+    if not os.path.exists(store_file + '.idx'):
+        return {}
+    with open(store_file + '.idx') as index_file:
+        return json.load(index_file)
+
+
+def Add_Ref(store_file, ref, ref_length):
+    """
+    Add a reference to a store, creating the store if needed. Needs the lock.
+    """
+    index = Read_Index(store_file)
+    if ref in index:
+        return index
+    n_rows = sum(length for (offset, length) in index.values())
+    with open(store_file, 'ab') as data_file:
+        data_file.truncate((n_rows + ref_length) * n_cols * 8)  # 0-filled
+    index[ref] = [n_rows, ref_length]
+    with open(store_file + '.idx.tmp', 'w') as index_file:
+        json.dump(index, index_file)
+    os.replace(store_file + '.idx.tmp', store_file + '.idx')
+    return index
+
+
+def Write_Window(store_file, ref, ref_length, start, mut_counts,
+                 info_counts):
+    """
+    Record the control group stats of a window starting at start (1-based)
+    """
+    with Store_Lock(store_file):
+        index = Add_Ref(store_file, ref, ref_length)
+        offset, length = index[ref]
+        n = max(0, min(len(mut_counts), length - start + 1))  # Within ref
+        rows = np.memmap(store_file, dtype=np.int64, mode='r+',
+                         shape=(offset + length, n_cols))
+        window = rows[offset + start - 1:offset + start - 1 + n]
+        window[:, 0] = mut_counts[:n]
+        window[:, 1] = info_counts[:n]
+        rows.flush()
+        window[:, 2] = 1  # Covered, once the counts are in
+        rows.flush()
+        del rows
+
+
+def Read_Window(store_file, ref, start, D):
+    """
+    Control group stats of the D positions of a window starting at start.
+    Positions beyond the end of the ref have no counts.
+    """
+    index = Read_Index(store_file)
+    if ref not in index:
+        raise KeyError('No control group stats for {} in {}'.format(
+            ref, store_file))
+    offset, length = index[ref]
+    n = max(0, min(D, length - start + 1))
+    rows = np.memmap(store_file, dtype=np.int64, mode='r',
+                     shape=(offset + length, n_cols))
+    window = np.array(rows[offset + start - 1:offset + start - 1 + n])
+    del rows
+    if not np.all(window[:, 2]):
+        raise KeyError('Control group stats of {} not recorded for all of '
+                       '{}-{} in {}'.format(ref, start, start + D - 1,
+                                            store_file))
+    mut_counts, info_counts = np.zeros(D, dtype=np.int64), \
+        np.zeros(D, dtype=np.int64)
+    mut_counts[:n], info_counts[:n] = window[:, 0], window[:, 1]
+    return mut_counts, info_counts
+
+
+def Is_Covered(store_file, ref, start, end):
+    """
+    Whether a store has the control group stats of a window
+    """
+    try:
+        Read_Window(store_file, ref, start, end - start + 1)
+    except (KeyError, OSError):
+        return False
+    return True
+
+
+def Default_Store(output_dir, sample_name):
+    """
+    Store of a sample, next to the output dirs of its windows
+    """
+    sample_dir = os.path.dirname(os.path.normpath(output_dir))
+    return os.path.join(sample_dir, sample_name + '_control_stats.bin')
@@ -16,15 +16,29 @@ Created on Tue Jul 30 2019
 Fold RNA sequence with RNAstructure using DMS contraints.
 """
 import os
+import json
+import shutil
+import hashlib
+import tempfile
+import subprocess
+from functools import partial
+from multiprocessing.pool import ThreadPool
 import pandas as pd
 import numpy as np
 from statistics import median as med
 import BitVector_Functions
-import json
+
+# Options of the RNAstructure commands, also part of the cache key
+fold_params = ['-m', '3', '-md', '350']
+ct2dot_params = ['ALL']
+draw_params = []
 
 
-def ConstraintFoldDraw(input_dir, clustMuFile, expUp, expDown, norm_bases):
+def Fold_Jobs(input_dir, clustMuFile, expUp, expDown, norm_bases):
     """
+    Write the normalized reactivities of the clusters for an expansion of
+    the region, and return the folding job of each cluster: trimmed
+    sequence and its title, DMS constraints and output files.
     """
     sample = clustMuFile.split('/')[-4]
     file_dir = os.path.dirname(clustMuFile)
@@ -46,10 +60,7 @@ def ConstraintFoldDraw(input_dir, clustMuFile, expUp, expDown, norm_bases):
     mod_start = max(1, start - expUp)
     mod_end = min(end + expDown, len(entire_seq))
     trim_seq = entire_seq[mod_start - 1:mod_end]
-    trimref_filename = file_dir + '/' + ref + '_trimUp_' + str(expUp) + \
-        '_trimDown_' + str(expDown) + '.fa'
     ref_name = ref + '_' + str(mod_start) + '_' + str(mod_end)
-    BitVector_Functions.Create_FastaFile(trimref_filename, ref_name, trim_seq)
 
     # Gather mus for every k and normalize them
     clusts_mus = pd.read_csv(clustMuFile, sep='\t', skiprows=2,
@@ -88,13 +99,12 @@ def ConstraintFoldDraw(input_dir, clustMuFile, expUp, expDown, norm_bases):
             with open(json_filename, 'w') as f:
                 json.dump(norm_data, f, indent=4)
 
-    # Drawing of structure for each k
+    # Constraints of each k
+    jobs = []
     for k in range(K):
         clust_name = file_dir + '/' + sample + '-K' + str(K) + '_Cluster' + str(k+1)
 
-        const_filename = clust_name + '_expUp_' + str(expUp) + '_expDown_' + \
-            str(expDown) + '_const.txt'
-        const_file = open(const_filename, 'w')
+        const_lines = []
         for i in range(len(clusts_mus)):
             pos = clusts_mus['Position'][i]
             mod_pos = pos - mod_start + 1  # Pos wrt trimmed seq
@@ -104,28 +114,106 @@ def ConstraintFoldDraw(input_dir, clustMuFile, expUp, expDown, norm_bases):
             if entire_seq[pos-1] == 'A' or entire_seq[pos-1] == 'C':
                 mu = '-999'
             if mod_pos > 0 and mod_start <= pos <= mod_end:  # Can be < 0 because its wrt trimmed seq
-                const_file.write(str(mod_pos) + '\t' + mu + '\n')
-        const_file.close()
-
-        # Folding using RNAstructure
-        ct_filename = clust_name + '_expUp_' + str(expUp) + '_expDown_' + \
-            str(expDown) + '.ct'
-        dot_filename = clust_name + '_expUp_' + str(expUp) + '_expDown_' + \
-            str(expDown) + '.dot'
-        pic_filename = clust_name + '_basesExpanded_' + str(expUp) + '.ps'
-        fold_command = 'Fold -m 3 ' + trimref_filename + ' -dms ' + \
-            const_filename + ' ' + ct_filename + ' -md 350'
-        ct2dot_command = 'ct2dot ' + ct_filename + ' ALL ' + \
-            dot_filename
-        draw_command = 'draw ' + dot_filename + ' ' + \
-            pic_filename + ' -S ' + const_filename
-        os.system(fold_command)
-        os.system(ct2dot_command)
-        os.system(draw_command)
-
-        # Delete unnecessary files
-        os.system('rm ' + const_filename)
-        # os.system('rm ' + ct_filename)
-        # os.system('rm ' + dot_filename)
-
-    os.system('rm ' + trimref_filename)
+                const_lines.append(str(mod_pos) + '\t' + mu + '\n')
+
+        job = {'title': ref_name, 'seq': trim_seq,
+               'const': ''.join(const_lines),
+               'ct': clust_name + '_expUp_' + str(expUp) + '_expDown_' +
+               str(expDown) + '.ct',
+               'dot': clust_name + '_expUp_' + str(expUp) + '_expDown_' +
+               str(expDown) + '.dot',
+               'ps': clust_name + '_basesExpanded_' + str(expUp) + '.ps'}
+        job['key'] = Fold_Key(job)
+        jobs.append(job)
+    return jobs
+
+
+def Fold_Key(job):
+    """
+    Hash of everything the structures of a job depend on
+    """
+    key = json.dumps([job['title'], job['seq'], job['const'], fold_params,
+                      ct2dot_params, draw_params])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def Cache_Files(cache_dir, key):
+    return [cache_dir + key + ext for ext in ('.ct', '.dot', '.ps')]
+
+
+def Fold_Structure(job, cache_dir):
+    """
+    Fold with RNAstructure (Fold, ct2dot, draw) in a temp dir, and move the
+    results to the cache. Returns whether all the commands succeeded.
+    """
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        fasta_file, const_file = tmp_dir + '/seq.fa', tmp_dir + '/const.txt'
+        ct_file, dot_file, ps_file = Cache_Files(tmp_dir + '/', 'fold')
+        BitVector_Functions.Create_FastaFile(fasta_file, job['title'],
+                                             job['seq'])
+        with open(const_file, 'w') as f:
+            f.write(job['const'])
+        commands = [['Fold', fasta_file, '-dms', const_file, ct_file] +
+                    fold_params,
+                    ['ct2dot', ct_file] + ct2dot_params + [dot_file],
+                    ['draw', dot_file, ps_file, '-S', const_file] +
+                    draw_params]
+        for command in commands:
+            try:
+                returncode = subprocess.call(command)
+            except OSError as e:  # Not installed
+                print('[warning] Folding failed:', ' '.join(command), e)
+                return False
+            if returncode != 0:
+                print('[warning] Folding failed:', ' '.join(command))
+                return False
+        # The ps file last: a complete entry has it
+        for tmp_file, cache_file in zip([ct_file, dot_file, ps_file],
+                                        Cache_Files(cache_dir, job['key'])):
+            os.replace(tmp_file, cache_file)
+        return True
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def ConstraintFoldDraw(input_dir, clustMuFile, expansions, norm_bases,
+                       cache_dir, CPUS=1):
+    """
+    Fold the clusters with the region expanded by each (expUp, expDown) of
+    expansions. All the jobs are built first and run CPUS at a time. The
+    structures are cached in cache_dir by Fold_Key, so identical clusters
+    and reruns are not folded again.
+    """
+    jobs = []
+    for expUp, expDown in expansions:
+        jobs += Fold_Jobs(input_dir, clustMuFile, expUp, expDown, norm_bases)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    to_fold = {}  # One job per key
+    for job in jobs:
+        if not os.path.exists(Cache_Files(cache_dir, job['key'])[-1]):
+            to_fold.setdefault(job['key'], job)
+    failed = set()
+    if to_fold:
+        # The work is done by RNAstructure processes: threads are enough
+        pool = ThreadPool(max(1, min(CPUS, len(to_fold))))
+        try:
+            results = pool.map(partial(Fold_Structure, cache_dir=cache_dir),
+                               list(to_fold.values()))
+        finally:
+            pool.close()
+            pool.join()
+        failed = set(key for (key, ok) in zip(to_fold, results) if not ok)
+
+    n_failed = 0
+    for job in jobs:
+        if job['key'] in failed:
+            n_failed += 1
+            continue
+        for cache_file, out_file in zip(Cache_Files(cache_dir, job['key']),
+                                        [job['ct'], job['dot'], job['ps']]):
+            shutil.copyfile(cache_file, out_file)
+    print('Folding: {} jobs, {} structures folded, {} jobs failed'.format(
+        len(jobs), len(to_fold) - len(failed), n_failed))
@@ -13,87 +13,159 @@ Created on Tue Jul 30 2019
 
 @author: harish
 
-Read the bitvector text file and create object X
+Read the bitvector text file (or take the bit vectors in memory) and create
+object X
 Read the FASTA file to get the ref genome sequence
 Filtering of the bit vectors is done here using various criteria
-Changing of . and ? to 0 is done here
+Changing of . and ? to 0 and dropping of masked positions is done here
 """
+import re
 import EM_Class
 import EM_Functions
+import EM_ControlStore
+import Mapping_Collapse
+import DREEM_Profile
 import numpy as np
-import json
-from scipy.stats import fisher_exact
-from statsmodels.stats.multitest import multipletests
-import os
-import time
-import plotly
-import plotly.graph_objs as go
 
 fold_change_thresh = 1.5
 q_value_thresh = 0.00001
 epsilon = 1e-8 # Additive constant to avoid division by zero
+chunk_bytes = 2 ** 24  # Bytes of bit vector file parsed at a time
+weight_pattern = re.compile(Mapping_Collapse.weight_pattern.pattern.encode())
 
-def Load_BitVectors(bv_file, INFO_THRESH, SIG_THRESH, exc_AC, output_dir, ctrl):
+
+def Read_BitVectorHeader(bv_fileobj):
     """
+    Read the header lines of a bit vector file (opened in binary mode).
+    collapsed: the query names carry the weights of collapsed reads.
     """
-    bases = ['A', 'T', 'G', 'C']
-    bit_strings, mut_popavg, n_discard = [], {}, 0
-    f, f1, f2, f3, f4 = 0, 0, 0, 0, 0
-
-    bv_fileobj = open(bv_file)
-    bvfile_contents = bv_fileobj.readlines()
-    bv_fileobj.close()
-
-    first_line = bvfile_contents[0]
+    first_line = bv_fileobj.readline().decode()
     first_line_split = first_line.strip().split()
     ref_info, seq = first_line_split[1], first_line_split[2]
     ref_file, ref = ref_info.split(';')[0], ref_info.split(';')[1]
 
-    second_line = bvfile_contents[1]
+    second_line = bv_fileobj.readline().decode()
     second_line_split = second_line.strip().split()
     indices = second_line_split[1].split(':')[0]
+    collapsed = Mapping_Collapse.header_flag in second_line_split[2:]
 
-    l = len(bvfile_contents[3].strip().split()[1])  # Len of 1st bit string
-    nmuts_min = int(round(0.1 * l))
-    nmuts_thresh = max(nmuts_min, EM_Functions.calc_nmuts_thresh(bv_file))
-    print('Mutations threshold:', nmuts_thresh)
-
-    for i in range(3, len(bvfile_contents)):
-        f += 1
-        line = bvfile_contents[i].strip().split()
-        bit_string = line[1]
-        n_mut = float(line[2])
+    bv_fileobj.readline()  # Column names
+    return ref_file, ref, seq, indices, collapsed
 
-        # Replace bases with 1
-        for base in bases:
-            bit_string = bit_string.replace(base, '1')
 
-        # Filter 1 - Number of mutations
-        if n_mut > nmuts_thresh:
-            n_discard += 1
-            f1 += 1
+def Read_BitVectorChunks(bv_fileobj, collapsed=False):
+    """
+    Parse the bit vectors of a file in chunks. Yields the code matrix, the
+    number of mutations and the weight (reads it stands for, from the
+    ';size=N' suffix of collapsed reads, else 1) of the bit vectors in
+    each chunk.
+    """
+    D = None
+    while True:
+        lines = bv_fileobj.readlines(chunk_bytes)
+        if not lines:
+            break
+        bit_strings, n_muts, weights = [], [], []
+        for line in lines:
+            line = line.split()
+            if not line:
+                continue
+            bit_strings.append(line[1])
+            n_muts.append(float(line[2]))
+            match = weight_pattern.search(line[0]) if collapsed else None
+            weights.append(int(match.group(1)) if match else 1)
+        if not bit_strings:
             continue
+        if D is None:
+            D = len(bit_strings[0])  # Len of 1st bit string
+        codes = EM_Functions.bits_to_codes(bit_strings, D)
+        yield codes, np.array(n_muts), np.array(weights, dtype=np.int64)
 
-        # Filter 2 - Fraction of informative bits
-        if (bit_string.count('.') + bit_string.count('?') +
-           bit_string.count('N')) >= INFO_THRESH * len(bit_string):
-            n_discard += 1
-            f2 += 1
-            continue
 
-        # Filter 3 - Distance between mutations
-        if not EM_Functions.is_distmuts_valid(bit_string):
-            n_discard += 1
-            f3 += 1
-            continue
+def Filter_BitVectors(chunks, INFO_THRESH):
+    """
+    Apply the 4 bit vector filters to the chunks of a code matrix.
+    Filters 2-4 are applied chunk by chunk and only the bit vectors passing
+    them are kept. Filter 1 needs the mutations threshold, which is computed
+    from the number of mutations of all bit vectors once they have been seen.
+    The counts of the filters are in reads, so bit vectors of collapsed
+    reads count as many times as their weight.
+    """
+    kept_codes, kept_nmuts, all_nmuts, fail_filter = [], [], [], []
+    kept_weights, all_weights = [], []
+    for codes, n_muts, weights in chunks:
+        failed = np.zeros(len(codes), dtype=np.uint8)  # First filter failed
+        valid = EM_Functions.is_info_valid(codes, INFO_THRESH)
+        failed[~valid] = 2
+        check = valid
+        valid = EM_Functions.is_distmuts_valid(codes[check])
+        failed[np.flatnonzero(check)[~valid]] = 3
+        check[check] = valid
+        valid = EM_Functions.is_surmuts_valid(codes[check])
+        failed[np.flatnonzero(check)[~valid]] = 4
+        check[check] = valid
+        kept_codes.append(codes[check])
+        kept_nmuts.append(n_muts[check])
+        kept_weights.append(weights[check])
+        all_nmuts.append(n_muts)
+        all_weights.append(weights)
+        fail_filter.append(failed)
+    D = kept_codes[0].shape[1]
+    kept_codes = np.concatenate(kept_codes)
+    kept_nmuts = np.concatenate(kept_nmuts)
+    kept_weights = np.concatenate(kept_weights)
+    all_nmuts = np.concatenate(all_nmuts)
+    all_weights = np.concatenate(all_weights)
+    fail_filter = np.concatenate(fail_filter)
+    collapsed = not np.all(all_weights == 1)
+
+    nmuts_min = int(round(0.1 * D))
+    nmuts_thresh = max(nmuts_min, EM_Functions.calc_nmuts_thresh(
+        all_nmuts, all_weights if collapsed else None))
+    print('Mutations threshold:', nmuts_thresh)
 
-        # Filter 4 - Bits surrounding mutations
-        if not EM_Functions.is_surmuts_valid(bit_string):
-            n_discard += 1
-            f4 += 1
-            continue
+    too_many = all_nmuts > nmuts_thresh
+    fail_filter[too_many] = 1
+    filter_counts = np.bincount(fail_filter, all_weights if collapsed else
+                                None, minlength=5).astype(np.int64)
+    f1, f2, f3, f4 = [int(n) for n in filter_counts[1:5]]
+    f = int(all_weights.sum())
+    kept = kept_nmuts <= nmuts_thresh
+    return kept_codes[kept], (f, f1, f2, f3, f4), \
+        kept_weights[kept] if collapsed else None
+
+
+def Load_BitVectors(bv_file, INFO_THRESH, SIG_THRESH, exc_AC, output_dir, ctrl,
+                    ctrl_store, ref_length):
+    """
+    Create X from a bit vector file
+    """
+    bv_fileobj = open(bv_file, 'rb')
+    ref_file, ref, seq, indices, collapsed = Read_BitVectorHeader(bv_fileobj)
+    chunks = Read_BitVectorChunks(bv_fileobj, collapsed)
+    X = Create_BVObject((ref_file, ref, seq, indices), chunks, INFO_THRESH, SIG_THRESH, exc_AC,
+                        output_dir, ctrl, ctrl_store, ref_length)
+    bv_fileobj.close()
+    return X
 
-        bit_strings.append(bit_string)
+
+def Create_BVObject(header, chunks, INFO_THRESH, SIG_THRESH, exc_AC,
+                    output_dir, ctrl, ctrl_store, ref_length):
+    """
+    Create X from the chunks of a code matrix, read from a bit vector file
+    or kept in memory by BitVector (see BitVector_Functions.BitVector_Sink).
+    A control sample records its stats for the window in the control store.
+    An experimental sample reads them from there: the control sample is
+    scheduled before the experimental one (see DREEM_Scheduler).
+    """
+    import plotly
+    import plotly.graph_objs as go
+
+    ref_file, ref, seq, indices = header
+    with DREEM_Profile.Stage('em_read_filter'):
+        codes, (f, f1, f2, f3, f4), weights = Filter_BitVectors(chunks,
+                                                               INFO_THRESH)
+    n_discard = f1 + f2 + f3 + f4
 
     print('Total bit vectors:', f)
     print('Bit vectors removed because of too many mutations: ', f1)
@@ -101,36 +173,20 @@ def Load_BitVectors(bv_file, INFO_THRESH, SIG_THRESH, exc_AC, output_dir, ctrl):
     print('Bit vectors removed because of mutations close by: ', f3)
     print('Bit vectors removed because of no info around mutations: ', f4)
 
-    D = len(bit_strings[0])
+    # Mutated and informative bits at each position of interest
+    D = codes.shape[1]
     thresh_pos = []  # Positions above or below signal threshold
-    for d in range(D):  # Each position of interest in the genome
-        bits_list = [bs[d] for bs in bit_strings]  # List of bits at that pos
-        noinfo_count = bits_list.count('.') + bits_list.count('?') + \
-            bits_list.count('N')
-        info_count = len(bits_list) - noinfo_count  # Num of informative bits
-        try:
-            mut_prob = bits_list.count('1') / info_count
-        except ZeroDivisionError:
-            mut_prob = 0
-        mut_popavg[d] = mut_prob
+    mut_counts, info_counts = EM_Functions.calc_pos_counts(codes, weights)
+    mut_popavg = EM_Functions.calc_ratio(mut_counts, info_counts)
 
     if ctrl == 'True':
         # ------------------- Recording of control group stats -------------------
-        control_stats = {}
-        for i in range(D):
-            bits_list = [bs[i] for bs in bit_strings]
-            noinfo_count = bits_list.count('.') + bits_list.count('?') + bits_list.count('N')
-            valid_count = len(bits_list) - noinfo_count
-            mut_count = bits_list.count('1')
-            control_stats[i] = {"mut_count": mut_count, "total_count": valid_count}
-        
-        control_stats_file = output_dir + 'control_group_stats.json'
-        with open(control_stats_file, 'w') as f:
-            json.dump(control_stats, f, indent=4)
-        print('Control group stats file saved to: ', control_stats_file)
+        start_pos = int(indices.split(',')[0])
+        EM_ControlStore.Write_Window(ctrl_store, ref, ref_length, start_pos,
+                                     mut_counts, info_counts)
+        print('Control group stats saved to: ', ctrl_store)
 
         base_color = {'A': 'red', 'T': 'green', 'G': 'orange', 'C': 'blue', 'N': 'gray'}
-        start_pos = int(indices.split(',')[0])
         xaxis = [start_pos + i for i in range(D)]
         yaxis = [mut_popavg[pos] for pos in range(D)]
         ref_bases = list(seq.strip())[:D]
@@ -150,60 +206,39 @@ def Load_BitVectors(bv_file, INFO_THRESH, SIG_THRESH, exc_AC, output_dir, ctrl):
         )
         fig = go.Figure(data=[trace], layout=layout)
         plot_filename = output_dir + "control_mut_pop_avg.html"
-        plotly.offline.plot(fig, filename=plot_filename, auto_open=False)
+        with DREEM_Profile.Stage('em_popavg_plot'):
+            plotly.offline.plot(fig, filename=plot_filename, auto_open=False)
         print('Control group mut_popavg plot saved to: ', plot_filename)
 
     else:
         # ------------------- Screening of signals in experimental group -------------------
-        control_stats_file = output_dir + 'control_group_stats.json'
-        while not os.path.exists(control_stats_file):
-            print('Warning: Control group stats file not found. Waiting for file import.')
-            time.sleep(10)
-        with open(control_stats_file, 'r') as f:
-            control_group_stats = json.load(f)
-
-        exp_stats = {}
-        for i in range(D):
-            bits_list = [bs[i] for bs in bit_strings]
-            noinfo_count = bits_list.count('.') + bits_list.count('?') + bits_list.count('N')
-            valid_count = len(bits_list) - noinfo_count
-            mut_count = bits_list.count('1')
-            exp_stats[i] = {"mut_count": mut_count, "total_count": valid_count}
-        
-        p_values = []
-        positions_tested = list(range(D))
-        for d in positions_tested:
-            control_mut = control_group_stats[str(d)]["mut_count"]
-            control_total = control_group_stats[str(d)]["total_count"]
-            exp_mut = exp_stats[d]["mut_count"]
-            exp_total = exp_stats[d]["total_count"]
-            table = [[exp_mut, exp_total - exp_mut],
-                     [control_mut, control_total - control_mut]]
-            _, p = fisher_exact(table, alternative='greater')
-            p_values.append(p)
-        
-        _, q_values, _, _ = multipletests(p_values, method='fdr_bh')
-        
-        thresh_pos = []
+        start_pos = int(indices.split(',')[0])
+        ctrl_muts, ctrl_totals = EM_ControlStore.Read_Window(ctrl_store, ref,
+                                                             start_pos, D)
 
-        for d, q in enumerate(q_values):
-            exp_total = exp_stats[d]["total_count"]
-            ctrl_total = control_group_stats[str(d)]["total_count"]
+        # One-sided Fisher's exact test at every position
+        with DREEM_Profile.Stage('em_screening'):
+            p_values = EM_Functions.fisher_exact_greater(
+                mut_counts, info_counts - mut_counts,
+                ctrl_muts, ctrl_totals - ctrl_muts)
+
+            from statsmodels.stats.multitest import multipletests
+            _, q_values, _, _ = multipletests(p_values, method='fdr_bh')
 
-            if exp_total == 0 or ctrl_total == 0:
-                fold_change = 0
-            else:
-                exp_rate = exp_stats[d]["mut_count"] / exp_total
-                ctrl_rate = control_group_stats[str(d)]["mut_count"] / ctrl_total
+        exp_rates = EM_Functions.calc_ratio(mut_counts, info_counts)
+        ctrl_rates = EM_Functions.calc_ratio(ctrl_muts, ctrl_totals)
+        fold_changes = (exp_rates + epsilon) / (ctrl_rates + epsilon)
+        fold_changes[(info_counts == 0) | (ctrl_totals == 0)] = 0
 
-                fold_change = (exp_rate + epsilon) / (ctrl_rate + epsilon)
-            
+        thresh_pos = []
+
+        for d, q in enumerate(q_values):
+            fold_change = fold_changes[d]
             if q >= q_value_thresh and fold_change < fold_change_thresh:
                 mut_popavg[d] = 0
                 thresh_pos.append(d)
         
         base_color = {'A': 'red', 'T': 'green', 'G': 'orange', 'C': 'blue', 'N': 'gray'}
-        start_pos = int(indices.split(',')[0])
         xaxis = [start_pos + i for i in range(D)]
         yaxis = [mut_popavg[pos] for pos in range(D)]
 
@@ -224,42 +259,35 @@ def Load_BitVectors(bv_file, INFO_THRESH, SIG_THRESH, exc_AC, output_dir, ctrl):
         )
         fig = go.Figure(data=[trace], layout=layout)
         plot_filename = output_dir + "experimental_mut_pop_avg.html"
-        plotly.offline.plot(fig, filename=plot_filename, auto_open=False)
+        with DREEM_Profile.Stage('em_popavg_plot'):
+            plotly.offline.plot(fig, filename=plot_filename, auto_open=False)
         print('Experimental group mut_popavg plot saved to: ', plot_filename)
 
-    for i in range(len(bit_strings)):  # Change . and ? to 0, noise to 0
-        bit_string = bit_strings[i]
-        bit_string = bit_string.replace('?', '0')
-        bit_string = bit_string.replace('.', '0')
-        bit_string = bit_string.replace('N', '0')
-
-        # Suppressing data from As and Cs
-        if exc_AC == 'True':
-            bit_string = list(bit_string)
-            j = 0
-            while j < len(bit_string):
-                if seq[j] == 'A' or seq[j] == 'C':
-                    bit_string[j] = '0'
-                j += 1
-            bit_string = ''.join(bit_string)
-
-        bit_string = np.array(list(bit_string))
-        bit_string[thresh_pos] = '0'
-        bit_string = ''.join(bit_string)
-
-        bit_strings[i] = bit_string
+    # Change . and ? to 0, drop noise positions and As and Cs
+    masked = np.zeros(D, dtype=bool)
+    if exc_AC == 'True':  # Suppressing data from As and Cs
+        masked[[j for j in range(D) if seq[j] == 'A' or seq[j] == 'C']] = True
+    masked[thresh_pos] = True
+    positions = np.flatnonzero(~masked)
+    bits = (codes[:, positions] == EM_Functions.mut_code).astype(np.uint8)
 
     # Update mutation population average for EM clustering
-    mut_popavg = {}
-    for d in range(D):
-        bits_list = [bs[d] for bs in bit_strings]
-        info_count = len(bits_list)
-        try:
-            mut_prob = bits_list.count('1') / info_count
-        except ZeroDivisionError:
-            mut_prob = 0
-        mut_popavg[d] = mut_prob
-
-    X = EM_Class.BV_Object(bit_strings, mut_popavg, n_discard, ref_file,
-                           ref, seq, output_dir, indices)
+    if weights is None:
+        mut_popavg = EM_Functions.calc_ratio(bits.sum(axis=0),
+                                             np.full(len(positions),
+                                                     len(bits)))
+    else:
+        mut_counts, info_counts = EM_Functions.calc_pos_counts(
+            codes[:, positions], weights)
+        mut_popavg = EM_Functions.calc_ratio(mut_counts, np.full(
+            len(positions), weights.sum()))
+
+    filter_counts = {'total': f, 'too_many_mutations': f1,
+                     'too_few_informative_bits': f2,
+                     'mutations_close_by': f3,
+                     'no_info_around_mutations': f4,
+                     'noise_positions': len(thresh_pos)}
+    X = EM_Class.BV_Object(bits, positions, D, mut_popavg, n_discard,
+                           ref_file, ref, seq, output_dir, indices,
+                           filter_counts, weights)
     return X
\ No newline at end of file
@@ -15,21 +15,34 @@ Created on Tue Jul 30 2019
 """
 from math import log
 import numpy as np
-import scipy.stats
-import pandas as pd
 import sys
 sys.setrecursionlimit(10000)
 
-def mu_der(mu_k, x_bar_k):
+min_log_pmf = -20  # Floor of the log pmf of a bit, avoids underflow
+
+def expand_mu(mu_k, positions, n_positions):
+    """
+    Put the mus of the EM positions back in window coordinates, with 0 at
+    the dropped positions
+    """
+    full_mu_k = np.zeros(n_positions)
+    full_mu_k[positions] = mu_k
+    return full_mu_k
+
+
+def mu_der(mu_k, x_bar_k, positions, n_positions):
     """
+    The denominator is calculated in window coordinates, so that the
+    distance between mutations is measured in the genome
     """
     epsilon = 1e-9
+    mu_k = expand_mu(mu_k, positions, n_positions)
     mu_k_rev = mu_k[::-1]
     denom_k = calc_denom(0, mu_k, {}, {})
     denom_k_epsilon = denom_k[0] + epsilon
     denom_k_rev = calc_denom(0, mu_k_rev, {}, {})
     upd_mu = [(mu_k[i] * denom_k[1][i] * denom_k_rev[1][len(mu_k) - i - 1] /
-              denom_k_epsilon) - x_bar_k[i] for i in range(len(mu_k))]
+              denom_k_epsilon) - x_bar_k[j] for j, i in enumerate(positions)]
     return np.array(upd_mu)
 
 
@@ -53,59 +66,158 @@ def calc_denom(i, mu, denom_probs, s2_probs):
         return (denom_probs[i], s2_probs)
 
 
-def is_distmuts_valid(bs):
+# Codes of the bit vector symbols in the code matrix of a bit vector file
+nomut_code, mut_code, miss_code, ambig_code, nbase_code = 0, 1, 2, 3, 4
+bit_table = np.full(256, 255, dtype=np.uint8)  # ASCII symbol -> code
+for symbol, code in (('0', nomut_code), ('1', mut_code), ('A', mut_code),
+                     ('T', mut_code), ('G', mut_code), ('C', mut_code),
+                     ('.', miss_code), ('?', ambig_code), ('N', nbase_code)):
+    bit_table[ord(symbol)] = code
+code_symbols = np.frombuffer(b'01.?N', dtype=np.uint8)  # Code -> symbol
+
+
+def bits_to_codes(bit_strings, D):
+    """
+    Convert bit strings (bytes) of length D to an N x D uint8 code matrix.
+    Substituted bases are coded as mutations, like a '1'.
+    """
+    codes = bit_table[np.frombuffer(b''.join(bit_strings), dtype=np.uint8)]
+    if len(codes) != len(bit_strings) * D:
+        raise ValueError('Bit vectors are not all of length ' + str(D))
+    if np.any(codes == 255):
+        raise ValueError('Unknown symbol in bit vectors')
+    return codes.reshape(len(bit_strings), D)
+
+
+def codes_to_bits(codes):
+    """
+    Convert a code matrix back to a list of bit strings
+    """
+    return [row.tobytes().decode() for row in code_symbols[codes]]
+
+
+def is_info_valid(codes, INFO_THRESH):
+    """
+    Rows of the code matrix with enough informative bits
+    """
+    n_noinfo = np.count_nonzero(codes >= miss_code, axis=1)
+    return n_noinfo < INFO_THRESH * codes.shape[1]
+
+
+def is_distmuts_valid(codes):
+    """
+    Rows of the code matrix with no two mutations closer than 4 bases
+    """
+    muts = codes == mut_code
+    valid = np.ones(len(codes), dtype=bool)
+    for dist in range(1, 4):
+        valid &= ~np.any(muts[:, :-dist] & muts[:, dist:], axis=1)
+    return valid
+
+
+def is_surmuts_valid(codes):
     """
+    Rows of the code matrix with no '.' or '?' right next to a mutation
     """
-    for i in range(len(bs)):
-        if bs[i] == '1':
-            try:
-                if i - latest_mutbit_index < 4:
-                    return False
-            except NameError:  # This happens the first time we see a '1'
-                None
-            latest_mutbit_index = i
-    return True
+    muts = codes == mut_code
+    noinfo = (codes == miss_code) | (codes == ambig_code)
+    invalid = np.any(muts[:, 1:] & noinfo[:, :-1], axis=1) | \
+        np.any(muts[:, :-1] & noinfo[:, 1:], axis=1)
+    return ~invalid
 
 
-def is_surmuts_valid(bs):
+def weighted_median(values, weights):
     """
+    Median of values, each repeated weights times
     """
-    invalid_set = ['.1', '?1', '1.', '1?']
-    for i in range(len(bs)):
-        if bs[i:i + 2] in invalid_set:
-            return False
-    return True
+    order = np.argsort(values, kind='stable')
+    values, cum_weights = values[order], np.cumsum(weights[order])
+    total = cum_weights[-1]
+    lower = values[np.searchsorted(cum_weights, (total - 1) // 2, 'right')]
+    upper = values[np.searchsorted(cum_weights, total // 2, 'right')]
+    return (lower + upper) / 2.0
 
 
-def calc_nmuts_thresh(bv_filename):
+def calc_nmuts_thresh(n_muts, weights=None):
     """
+    Median + 3 scaled MADs of the number of mutations per bit vector.
+    weights: number of reads of each bit vector (collapsed reads)
     """
-    n_muts = pd.read_csv(bv_filename, sep='\t', skiprows=2,
-                         usecols=['N_Mutations'], index_col=False)
-    n_muts = n_muts['N_Mutations']
-    mad = abs(n_muts - n_muts.median()).median()
-    nmuts_thresh = n_muts.median() + (3 * mad / 0.6745)
+    if weights is None:
+        median = np.median(n_muts)
+        mad = np.median(np.abs(n_muts - median))
+    else:
+        median = weighted_median(n_muts, weights)
+        mad = weighted_median(np.abs(n_muts - median), weights)
+    nmuts_thresh = median + (3 * mad / 0.6745)
     return int(round(nmuts_thresh))
 
 
-def logpmf_function1(X, mu, ind, k):
+def calc_pos_counts(codes, weights=None):
     """
+    Number of mutated and of informative bits at each position.
+    weights: number of reads of each bit vector (collapsed reads)
     """
-    start, end = ind[0], ind[1]
-    return scipy.stats.bernoulli.logpmf(X.BV_Matrix[start:end + 1], mu[k])
+    if weights is None:
+        mut_counts = np.count_nonzero(codes == mut_code, axis=0)
+        info_counts = np.count_nonzero(codes <= mut_code, axis=0)
+    else:  # One column at a time, no N x D array of weights
+        mut_counts = np.array([weights[codes[:, d] == mut_code].sum()
+                               for d in range(codes.shape[1])])
+        info_counts = np.array([weights[codes[:, d] <= mut_code].sum()
+                                for d in range(codes.shape[1])])
+    return mut_counts, info_counts
+
+
+def calc_ratio(numer, denom):
+    """
+    Element-wise numer / denom, with 0 where denom is 0
+    """
+    numer, denom = np.asarray(numer, dtype=float), np.asarray(denom)
+    ratio = np.zeros(len(numer))
+    np.divide(numer, denom, out=ratio, where=denom != 0)
+    return ratio
+
+
+def fisher_exact_greater(a, b, c, d):
+    """
+    P-values of one-sided (greater) Fisher's exact tests on the 2x2 tables
+    [[a, b], [c, d]], evaluated with the hypergeometric distribution for all
+    tables at once. Same as scipy.stats.fisher_exact, which gives p = 1 when
+    a row or column of the table sums to 0.
+    """
+    a, b, c, d = [np.asarray(x, dtype=np.int64) for x in (a, b, c, d)]
+    n1, n2 = a + b, c + d
+    from scipy.stats import hypergeom
+    p_values = hypergeom.sf(a - 1, n1 + n2, n1, a + c)
+    p_values = np.minimum(p_values, 1.0)
+    p_values[(n1 == 0) | (n2 == 0) | (a + c == 0) | (b + d == 0)] = 1.0
+    return p_values
 
 
-def logpmf_function2(log_pmf, denom, ind, k):
+def logpmf_block(X, mu, ind, K):
     """
+    Log pmf of a block of rows for each cluster, summed over the positions.
+    Only a block of rows x positions x clusters is held at a time.
     """
     start, end = ind[0], ind[1]
-    return log_pmf[start:end + 1, k] - log(denom[k][0])
+    from scipy.stats import bernoulli
+    rows = X.BV_Matrix[start:end + 1]
+    log_pmf = np.empty(rows.shape + (K,))
+    for k in range(K):
+        log_pmf[:, :, k] = bernoulli.logpmf(rows, mu[k])
+    np.maximum(log_pmf, min_log_pmf, out=log_pmf)  # Avoid underflow
+    return np.sum(log_pmf, axis=1)  # Sum of log - like taking product
 
 
-def calc_matrixIndices(N, K, cpus):
+def calc_matrixIndices(N, K, cpus, block_rows=None):
     """
+    Row blocks of the E-step: block_rows rows each, or by default about
+    N * K / cpus rows
     """
     calcsPerCPU = max(round(N * K / cpus), 1)
+    if block_rows:
+        calcsPerCPU = block_rows
     inds, start = [], 0
     while start < N:
         coord = (start, start + calcsPerCPU - 1)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+# Copyright (c) <2019> <The Whitehead Institute for Biomedical Research>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Memory and runtime planner of the EM stage.
+
+From the number of unique bit vectors N, the number of positions D and the
+number of CPUs, estimates the peak memory and the run time of the EM runs
+of each K. With a memory cap, it picks the number of EM runs done at the
+same time (worker processes, see Run_EMJobs.Run_EMJobs_Parallel) and the
+rows per block of the E-step so that the job fits in the cap. Without one,
+the runs are done one after the other with blocks of default_block_mb.
+
+The model, measured with tracemalloc:
+    E-step: threads blocks of block_rows x D x (K + logpmf_temps) floats
+    M-step: N x D floats
+    both: nk_arrays arrays of N x K floats, the N x D float matrix of X
+          and fixed_mb for the libraries
+Times are single thread seconds per unit of work (see --calibrate).
+
+Dry run, to size the memory request of a job:
+    python EM_Plan.py --bv_file sample_ref_1_100_bitvectors.txt
+                      --max_K 3 --num_runs 10 --cpus 4 --mem_cap_mb 8000
+"""
+import sys
+import json
+import math
+import time
+import argparse
+import numpy as np
+
+mb = 2 ** 20
+fixed_mb = 200.0  # Python, numpy, scipy, plotly and statsmodels
+load_fixed_mb = 60.0  # Plots and control stats of Load_BitVectors
+load_cell_bytes = 6  # Per bit vector x position while loading the file
+logpmf_temps = 9  # Temporaries of bernoulli.logpmf, blocks of rows x D
+nk_arrays = 8  # Arrays of N x K floats (log pmf, resps...)
+default_block_mb = 64.0  # E-step block without a memory cap
+min_block_rows = 256
+safety = 1.2  # Margin of the memory request over the estimate
+e_cell_s = 1.0e-7  # E-step, per bit vector x position x cluster
+m_position_s = 3.0e-3  # M-step (newton_krylov), per position x cluster
+its_factor = 1.2  # Iterations of a run, times its min iterations
+
+
+def Block_Bytes(block_rows, D, K):
+    """
+    Memory of an E-step block being computed
+    """
+    return block_rows * D * 8 * (K + logpmf_temps)
+
+
+def Run_Bytes(N, D, K, block_rows, threads):
+    """
+    Peak memory of an EM run, apart from X
+    """
+    nk_bytes = N * K * 8 * nk_arrays
+    n_blocks = min(threads, math.ceil(N / block_rows))  # At the same time
+    e_step = n_blocks * Block_Bytes(block_rows, D, K) + nk_bytes
+    m_step = N * D * 8 + nk_bytes
+    return max(e_step, m_step)
+
+
+def Default_Rows(N, D, K, threads):
+    """
+    Rows of a block of default_block_mb, at least one block per thread
+    but no less than min_block_rows
+    """
+    rows = int(default_block_mb * mb // (D * 8 * (K + logpmf_temps)))
+    return min(max(rows, min_block_rows),
+               max(math.ceil(N / threads), min_block_rows), N)
+
+
+def Rows_Fitting(N, D, K, threads, budget_bytes):
+    """
+    Block of rows (default size at most) such that a run fits in
+    budget_bytes, or 0
+    """
+    free = budget_bytes - N * K * 8 * nk_arrays
+    if free < N * D * 8:  # The M-step does not fit
+        return 0
+    rows = int(free // (threads * D * 8 * (K + logpmf_temps)))
+    if rows < min(min_block_rows, N):
+        return 0
+    return min(rows, Default_Rows(N, D, K, threads))
+
+
+def Plan_K(N, D, K, runs, its, CPUS, mem_cap_mb):
+    """
+    Workers, threads per worker and E-step block rows of the runs of a K,
+    with their memory and run time
+    """
+    data_bytes = N * D * 8  # X.BV_Matrix, shared with the workers by fork
+    fits = True
+    if not mem_cap_mb:  # Runs one after the other, blocks of default size
+        workers, threads = 1, CPUS
+        block_rows = Default_Rows(N, D, K, threads)
+    else:
+        avail = (mem_cap_mb / safety - fixed_mb) * mb - data_bytes
+        for workers in range(max(min(runs, CPUS), 1), 0, -1):
+            threads = max(CPUS // workers, 1)
+            block_rows = Rows_Fitting(N, D, K, threads, avail / workers)
+            if block_rows:
+                break
+        else:  # Does not fit: smallest footprint
+            workers, threads, fits = 1, 1, False
+            block_rows = min(min_block_rows, N)
+
+    mem_mb = fixed_mb + (data_bytes + workers *
+                         Run_Bytes(N, D, K, block_rows, threads)) / mb
+    iteration_s = e_cell_s * N * D * K / threads + m_position_s * D * K
+    run_s = its * its_factor * iteration_s
+    return {'K': K, 'runs': runs, 'workers': workers, 'threads': threads,
+            'block_rows': block_rows, 'fits': fits,
+            'mem_mb': round(mem_mb, 1),
+            'run_s': round(run_s, 1),
+            'seconds': round(math.ceil(runs / workers) * run_s, 1)}
+
+
+def Plan_EM(N, D, MAX_K, NUM_RUNS, MIN_ITS, CPUS, mem_cap_mb, N_total=None):
+    """
+    Plan of the EM runs of each K, as done by EM_Clustering. N_total (bit
+    vectors before the filters and dedup) adds the memory of the loading.
+    """
+    per_K = {}
+    for K in range(1, MAX_K + 1):
+        runs = NUM_RUNS if K != 1 else 1  # Only 1 Run for K=1
+        its = MIN_ITS if K != 1 else 10  # Only 10 iters for K=1
+        per_K[K] = Plan_K(N, D, K, runs, its, CPUS, mem_cap_mb)
+    peak_mb = max(per_K[K]['mem_mb'] for K in per_K)
+    if N_total:
+        load_mb = fixed_mb + load_fixed_mb + \
+            (N_total * D * load_cell_bytes + N * D * 8) / mb
+        peak_mb = max(peak_mb, load_mb)
+    return {'N': N, 'D': D, 'CPUS': CPUS, 'mem_cap_mb': mem_cap_mb,
+            'per_K': per_K,
+            'peak_mb': round(peak_mb, 1),
+            'mem_request_mb': int(math.ceil(peak_mb * safety)),
+            'fits': all(per_K[K]['fits'] for K in per_K),
+            'seconds': round(sum(per_K[K]['seconds'] for K in per_K), 1)}
+
+
+def Print_Plan(plan):
+    print('EM plan: N = {}, D = {}, peak memory ~{} MB, ~{} s'.format(
+        plan['N'], plan['D'], plan['peak_mb'], plan['seconds']))
+    for K in sorted(plan['per_K']):
+        K_plan = plan['per_K'][K]
+        print(('K = {}: {} runs, {} at a time with {} threads, E-step ' +
+               'blocks of {} rows, ~{} MB, ~{} s').format(
+                  K, K_plan['runs'], K_plan['workers'], K_plan['threads'],
+                  K_plan['block_rows'], K_plan['mem_mb'],
+                  K_plan['seconds']))
+    if not plan['fits']:
+        print('[WARNING] The EM does not fit in', plan['mem_cap_mb'], 'MB')
+
+
+def Count_BitVectors(bv_file):
+    """
+    Number of bit vectors, of unique bit vectors (before filtering) and
+    of positions of a bit vector file
+    """
+    import EM_Files
+    n_total, unique, D = 0, set(), 0
+    with open(bv_file, 'rb') as bv_fileobj:
+        collapsed = EM_Files.Read_BitVectorHeader(bv_fileobj)[-1]
+        for codes, n_muts, weights in EM_Files.Read_BitVectorChunks(
+                bv_fileobj, collapsed):
+            n_total += int(weights.sum())
+            D = codes.shape[1]
+            unique.update(hash(row.tobytes()) for row in codes)
+    return n_total, len(unique), D
+
+
+def Calibrate(D, K, N=4000):
+    """
+    Measure e_cell_s and m_position_s on random bit vectors, one thread
+    """
+    import EM_Class
+    import EM_Functions
+    from EM_Algorithm import Exp_Step, Max_Step
+
+    rng = np.random.RandomState(0)
+    bits = (rng.random_sample((N, D)) < 0.02).astype(np.uint8)
+    X = EM_Class.BV_Object(bits, np.arange(D), D, bits.mean(axis=0), 0,
+                           '', 'ref', 'A' * D, '', '')
+    N = X.BV_Matrix.shape[0]
+    mu = np.clip(rng.random_sample((K, D)) * 0.05, 1e-6, 1 - 1e-6)
+    pi = np.ones(K) / K
+    calc_inds = EM_Functions.calc_matrixIndices(N, K, 1)
+    Exp_Step(X, K, mu, pi, calc_inds[:1], 1)  # Imports, caches
+    start_time = time.time()
+    resps, log_like, denom = Exp_Step(X, K, mu, pi, calc_inds, 1)
+    e_step_s = time.time() - start_time
+    start_time = time.time()
+    Max_Step(X, K, mu, resps, denom)
+    m_step_s = time.time() - start_time
+    return {'e_cell_s': e_step_s / (N * D * K),
+            'm_position_s': m_step_s / (D * K)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Estimate the memory and ' +
+                                     'run time of the EM (dry run)')
+    parser.add_argument('--bv_file', help='Bit vector file (gives N and D)')
+    parser.add_argument('--N', type=int, help='Number of unique bit vectors')
+    parser.add_argument('--D', type=int, help='Number of positions')
+    parser.add_argument('--N_total', type=int,
+                        help='Number of bit vectors, for the loading')
+    parser.add_argument('--max_K', type=int, default=3)
+    parser.add_argument('--num_runs', type=int, default=10)
+    parser.add_argument('--min_its', type=int, default=300)
+    parser.add_argument('--cpus', type=int, default=1)
+    parser.add_argument('--mem_cap_mb', type=float, default=0,
+                        help='Memory cap of the job (0: no cap)')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='Measure the speed of this machine first')
+    args = parser.parse_args()
+
+    N, D, N_total = args.N, args.D, args.N_total
+    if args.bv_file:
+        N_total, N, D = Count_BitVectors(args.bv_file)
+    if not N or not D:
+        parser.error('--bv_file or --N and --D are needed')
+
+    if args.calibrate:
+        speeds = Calibrate(D, 2)
+        e_cell_s, m_position_s = speeds['e_cell_s'], speeds['m_position_s']
+    plan = Plan_EM(N, D, args.max_K, args.num_runs, args.min_its, args.cpus,
+                   args.mem_cap_mb, N_total)
+    plan['N_total'] = N_total
+    plan['speeds'] = {'e_cell_s': e_cell_s, 'm_position_s': m_position_s}
+    print(json.dumps(plan, indent=4, sort_keys=True))
+    if not plan['fits']:
+        sys.exit(1)
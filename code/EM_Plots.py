@@ -16,16 +16,19 @@ Created on Tue Jul 30 2019
 Does all the EM Clustering plots
 """
 import os
-import plotly
-import plotly.graph_objs as go
-from plotly import tools
+import numpy as np
 import datetime
+import EM_Functions
 
 
 def Run_Plots(sample_name, X, K, log_like_list, final_mu, final_obs_pi,
               final_real_pi, resps, BIC, outplots_dir, run):
     """
     """
+    import plotly
+    import plotly.graph_objs as go
+    from plotly import tools
+
     K_dir = outplots_dir + '/K_' + str(K) + '/'
     if not os.path.exists(K_dir):
         os.makedirs(K_dir)
@@ -37,6 +40,13 @@ def Run_Plots(sample_name, X, K, log_like_list, final_mu, final_obs_pi,
     start, end = int(indices[0]), int(indices[1])
     seq = X.seq
 
+    # Mus and bit vectors in window coordinates, 0 at the dropped positions
+    final_mu = [EM_Functions.expand_mu(mu, X.positions, X.n_positions)
+                for mu in final_mu]
+    full_bvs = np.zeros((len(X.BV_Matrix), X.n_positions), dtype=np.uint8)
+    full_bvs[:, X.positions] = X.BV_Matrix
+    full_bvs = EM_Functions.codes_to_bits(full_bvs)
+
     # File 1 - List of log likelihoods
     outfile_name1 = run_dir + 'Log_Likelihoods.txt'
     outfile1 = open(outfile_name1, 'w')
@@ -45,82 +55,65 @@ def Run_Plots(sample_name, X, K, log_like_list, final_mu, final_obs_pi,
         outfile1.write(str_loglike + '\n')
     outfile1.close()
 
-    # File 2 - Largest log likelihood
-    outfile_name2 = run_dir + 'Largest_LogLike.txt'
+    # File 2 - Cluster mus
+    outfile_name2 = run_dir + 'Clusters_Mu.txt'
     outfile2 = open(outfile_name2, 'w')
-    str_loglike = str(round(log_like_list[-1], 2))
-    outfile2.write(str_loglike + '\n')
-    outfile2.close()
-
-    # File 3 - BIC
-    outfile_name3 = run_dir + 'BIC.txt'
-    outfile3 = open(outfile_name3, 'w')
-    str_BIC = str(round(BIC, 2))
-    outfile3.write(str_BIC + '\n')
-    outfile3.close()
-
-    # File 4 - Cluster mus
-    outfile_name4 = run_dir + 'Clusters_Mu.txt'
-    outfile4 = open(outfile_name4, 'w')
-    outfile4.write('@ref' + '\t' + X.ref_file + ';' + X.ref + '\t' +
+    outfile2.write('@ref' + '\t' + X.ref_file + ';' + X.ref + '\t' +
                    seq[start - 1:end] + '\n')
-    outfile4.write('@coordinates:length' + '\t' + str(start) + ',' +
+    outfile2.write('@coordinates:length' + '\t' + str(start) + ',' +
                    str(end) + ':' + str(end - start + 1) + '\n')
-    outfile4.write('Position')
+    outfile2.write('Position')
     for i in range(len(final_mu)):
-        outfile4.write('\tCluster_' + str(i + 1))
-    outfile4.write('\n')
+        outfile2.write('\tCluster_' + str(i + 1))
+    outfile2.write('\n')
     for i in range(start, end + 1):
-        outfile4.write(str(i))
+        outfile2.write(str(i))
         for j in range(len(final_mu)):
-            outfile4.write('\t' + str(round(final_mu[j][i-start], 5)))
-        outfile4.write('\n')
-    outfile4.close()
+            outfile2.write('\t' + str(round(final_mu[j][i-start], 5)))
+        outfile2.write('\n')
+    outfile2.close()
 
-    # File 5 - responsibilities
-    outfile_name5 = run_dir + 'Responsibilities.txt'
-    outfile5 = open(outfile_name5, 'w')
-    outfile5.write('Number\t')
+    # File 3 - responsibilities
+    outfile_name3 = run_dir + 'Responsibilities.txt'
+    outfile3 = open(outfile_name3, 'w')
+    outfile3.write('Number\t')
     for k in range(K):
         k += 1
-        outfile5.write('Cluster_' + str(k) + '\t')
-    outfile5.write('N\tBit_vector\n')
+        outfile3.write('Cluster_' + str(k) + '\t')
+    outfile3.write('N\tBit_vector\n')
     index_num = 1
-    for bit_vect in X.n_occur:
-        bv = ''.join(bit_vect)
-        abundance = str(X.n_occur[bit_vect])
-        outfile5.write(str(index_num) + '\t')
+    for bv, abundance in zip(full_bvs, X.BV_Abundance):
+        abundance = str(abundance)
+        outfile3.write(str(index_num) + '\t')
         for k in range(K):
-            outfile5.write(str(round(resps[index_num-1][k], 3)) + '\t')
-        outfile5.write(abundance + '\t' + bv + '\n')
-        outfile5.write('\n')
+            outfile3.write(str(round(resps[index_num-1][k], 3)) + '\t')
+        outfile3.write(abundance + '\t' + bv + '\n')
+        outfile3.write('\n')
         index_num += 1
-    outfile5.close()
+    outfile3.close()
 
-    # File 6 - Cluster proportions
-    outfile_name6 = run_dir + 'Proportions.txt'
-    outfile6 = open(outfile_name6, 'w')
-    outfile6.write('Cluster, Obs Pi, Real pi \n')
+    # File 4 - Cluster proportions
+    outfile_name4 = run_dir + 'Proportions.txt'
+    outfile4 = open(outfile_name4, 'w')
+    outfile4.write('Cluster, Obs Pi, Real pi \n')
     for k in range(K):
         obs_prob = str(round(final_obs_pi[k], 2))
         real_prob = str(round(final_real_pi[k], 2))
-        outfile6.write(str(k+1) + ',' + obs_prob + ',' + real_prob + '\n')
-    outfile6.close()
+        outfile4.write(str(k+1) + ',' + obs_prob + ',' + real_prob + '\n')
+    outfile4.close()
 
-    # File 7 - Cluster proportions excluding all-zero bit vectors
-    outfile_name7 = run_dir + 'Proportions_Excluding_Zeros.txt'
-    outfile7 = open(outfile_name7, 'w')
-    outfile7.write('Cluster, Proportion\n')
+    # File 5 - Cluster proportions excluding all-zero bit vectors
+    outfile_name5 = run_dir + 'Proportions_Excluding_Zeros.txt'
+    outfile5 = open(outfile_name5, 'w')
+    outfile5.write('Cluster, Proportion\n')
     
     total_resp_by_cluster = [0] * K
     total_weight = 0
     
     index_num = 1
-    for bit_vect in X.n_occur:
-        bv = ''.join(bit_vect)
-        abundance = X.n_occur[bit_vect]
+    for bv, abundance in zip(full_bvs, X.BV_Abundance):
         
-        if all(b == '0' for b in bit_vect): # Exclude all-zero bit vectors
+        if all(b == '0' for b in bv): # Exclude all-zero bit vectors
             index_num += 1
             continue
             
@@ -131,8 +124,8 @@ def Run_Plots(sample_name, X, K, log_like_list, final_mu, final_obs_pi,
     
     for k in range(K):
         proportion = total_resp_by_cluster[k] / total_weight if total_weight > 0 else 0
-        outfile7.write(f"{k+1}, {round(proportion, 4)}\n")
-    outfile7.close()
+        outfile5.write(f"{k+1}, {round(proportion, 4)}\n")
+    outfile5.close()
 
     # Plot 1 - log likelihood vs iteration number
     loglike_trace = go.Scatter(
@@ -189,6 +182,8 @@ def Run_Plots(sample_name, X, K, log_like_list, final_mu, final_obs_pi,
     plotly.offline.plot(fig3, filename=run_dir +
                         'DMSModRate_Clusters.html', auto_open=False)
 
+    return run_dir
+
 
 def NumReads_File(sample_name, X, outplots_dir):
     """
@@ -16,144 +16,549 @@ Created on Tue Jul 30 2019
 Initial step of the DREEM pipeline: Align reads in a FASTQ file to a ref genome.
 This is done before Bit Vector if needed.
 
-Output: SAM file. This and other files, such as QC stats files,
+Output: BAM file. This and other files, such as QC stats files,
 are created in separate output subdirectories.
 
 There are 4 steps in this pipeline:
 Step 1: QC of FASTQ files using FASTQC
 Step 2: Adapter and quality trimming using TrimGalore (& another FASTQC check)
+Optional: Collapsing of identical reads (Mapping_Collapse.py)
 Step 3: Mapping using Bowtie2
-Step 4: Post-mapping QC using Picard
+Step 4: Bowtie2 output piped to a BAM file and to samtools stats (QC)
 
-Dependencies: FASTQC, TrimGalore, Bowtie2 and Picard.
+Dependencies: FASTQC, TrimGalore, Bowtie2 and samtools.
 Make sure you have installed all these tools and added them to your
 computer's PATH environment variable
 """
 import os
+import json
+import queue
+import shutil
 import argparse
 import time
 import datetime
+import subprocess
+import threading
+import DREEM_Profile
+import DREEM_Metrics
+import DREEM_Status
+import DREEM_Shared
+import Mapping_Collapse
 
+manifest_lock = threading.Lock()
 
-def Map():
+
+class Mapping_Job():
+    """
+    Files and settings of the mapping of a sample, shared by its steps.
+    The steps are run in order by Map, or as a task graph by Mapping_Queue.
+    """
+    def __init__(self, sample_name, ref_name, paired, p, L, X, input_dir,
+                 output_dir, collapse=False, QSCORE_CUTOFF=20):
+        self.start_time = time.time()
+        self.sample_name, self.ref_name, self.paired = sample_name, \
+            ref_name, paired
+        self.p, self.L, self.X = p, L, X
+        self.output_dir = output_dir
+        self.collapse, self.QSCORE_CUTOFF = collapse, QSCORE_CUTOFF
+
+        # Specify reference genome index files base name and fasta file
+        # Index files (in same folder as the fasta file) are built if needed
+        self.refgenome_basename = input_dir + ref_name
+        self.refgenome_fasta = self.refgenome_basename + '.fasta'
+
+        # Output directories
+        self.outfiles_dir = output_dir + '/Mapping_Files/'
+        self.outplots_dir = output_dir + '/Mapping_Plots/'
+        if not os.path.exists(self.outfiles_dir):
+            os.makedirs(self.outfiles_dir)
+        if not os.path.exists(self.outplots_dir):
+            os.makedirs(self.outplots_dir)
+
+        sample_input_path = input_dir + sample_name
+        sample_outfiles_path = self.outfiles_dir + sample_name + '_' + \
+            ref_name
+        self.sample_outplots_path = self.outplots_dir + sample_name + '_' + \
+            ref_name
+        self.bam_filename = sample_outfiles_path + '.bam'  # Bowtie2 as BAM
+
+        # Input FASTQ files and TrimGalore output files
+        self.mates = [sample_input_path + '_mate1.fastq',
+                      sample_input_path + '_mate2.fastq'] if paired else \
+            [sample_input_path + '.fastq']
+        self.trimmed_mates = [
+            self.outplots_dir + sample_name + '_mate1_val_1.fq',
+            self.outplots_dir + sample_name + '_mate2_val_2.fq'] if \
+            paired else [self.outplots_dir + sample_name + '_trimmed.fq']
+        self.collapsed_mates = [trimmed_mate[:-len('.fq')] + '_collapsed.fq'
+                                for trimmed_mate in self.trimmed_mates]
+
+        # Steps already done with the same inputs and params are skipped
+        self.manifest_file = sample_outfiles_path + '_manifest.json'
+        self.manifest = Read_Manifest(self.manifest_file)
+
+    def run_step(self, step, inputs, params, run):
+        Run_Step(self.manifest_file, self.manifest, step, inputs, params,
+                 run)
+
+
+def Check_Inputs(job):
+    for mate in job.mates:
+        if not os.path.exists(mate):
+            raise FileNotFoundError('FastQ file ' + mate + ' does not exist.')
+    if not os.path.exists(job.refgenome_fasta):
+        raise FileNotFoundError('Ref fasta file ' + job.refgenome_fasta +
+                                ' does not exist.')
+
+
+def FastQC(job, mate_index):
+    """
+    Step 1: QC of a FASTQ file using FASTQC
+    """
+    mate = job.mates[mate_index]
+    # Output dirs are left as {} and filled in by Run_InTempDir
+    fastqc_command = 'fastqc --extract {} --outdir={{}}'.format(mate)
+    step = 'fastqc_' + str(mate_index + 1)
+    DREEM_Status.Set_Stage('mapping_fastqc')
+    with DREEM_Profile.Stage('mapping_fastqc'):
+        job.run_step(step, [mate], {'cmd': 'fastqc --extract'},
+                     lambda: Run_InTempDir(fastqc_command, job.outplots_dir,
+                                           step))
+
+
+def Trim(job):
+    """
+    Step 2: Adapter and quality trimming using TrimGalore
+    """
+    # Assumption of ASCII+33 encoding of Phred quality scores
+    if job.paired:
+        trim_command = 'trim_galore --fastqc --paired {} {} -o {{}}'
+        trim_command = trim_command.format(job.mates[0], job.mates[1])
+    else:
+        trim_command = 'trim_galore --fastqc {} -o {{}}'
+        trim_command = trim_command.format(job.mates[0])
+    DREEM_Status.Set_Stage('mapping_trim')
+    with DREEM_Profile.Stage('mapping_trim'):
+        job.run_step('trim', job.mates,
+                     {'cmd': 'trim_galore --fastqc', 'paired': job.paired},
+                     lambda: Run_InTempDir(trim_command, job.outplots_dir,
+                                           'trim'))
+
+
+def Build_Index(job):
     """
-    Perform QC, trimming and mapping for a given sample
+    Bowtie2 index of the ref genome, built if needed. Returns the checksum
+    of the fasta file.
     """
+    DREEM_Status.Set_Stage('mapping_bowtie2_build')
+    with DREEM_Profile.Stage('mapping_bowtie2_build'):
+        return DREEM_Shared.Build_Index(job.refgenome_fasta,
+                                        job.refgenome_basename)
 
-    start_time = time.time()
-    sample_input_path = input_dir + sample_name
-    sample_outfiles_path = outfiles_dir + sample_name + '_' + ref_name
-    sample_outplots_path = outplots_dir + sample_name + '_' + ref_name
-    bam_filename = sample_outfiles_path + '.bam'  # Bowtie2 output
 
-    # ----------------  Step 1: QC using FASTQC ----------------------------- #
+def Collapse(job):
+    """
+    Optional: identical reads are collapsed into one, with their count in
+    the name (compared at QSCORE_CUTOFF)
+    """
+    def Collapse_Reads():
+        n_reads, n_distinct = Mapping_Collapse.Collapse_Reads(
+            job.trimmed_mates, job.collapsed_mates, job.QSCORE_CUTOFF)
+        print('Collapsed {} reads into {} distinct reads'.format(
+            n_reads, n_distinct))
+        return job.collapsed_mates
 
-    mate1 = sample_input_path + '_mate1.fastq' if paired else \
-        sample_input_path + '.fastq'
-    mate2 = sample_input_path + '_mate2.fastq' if paired else ''
-    if not os.path.exists(mate1):
-        print('FastQ file ' + mate1 + ' does not exist.')
-        return
-    if paired:
-        if not os.path.exists(mate2):
-            print('FastQ file ' + mate2 + ' does not exist.')
-            return
-    if paired:
-        fastqc_command = 'fastqc --extract {} {} --outdir={}'
-        fastqc_command = fastqc_command.format(mate1, mate2, outplots_dir)
-    else:
-        fastqc_command = 'fastqc --extract {} --outdir={}'
-        fastqc_command = fastqc_command.format(mate1, outplots_dir)
-    os.system(fastqc_command)
+    DREEM_Status.Set_Stage('mapping_collapse')
+    with DREEM_Profile.Stage('mapping_collapse'):
+        job.run_step('collapse', job.trimmed_mates,
+                     {'QSCORE_CUTOFF': job.QSCORE_CUTOFF}, Collapse_Reads)
 
-    # ---------------- Step 2: Trimming using Trimgalore -------------------- #
 
-    # Assumption of ASCII+33 encoding of Phred quality scores
-    if paired:
-        trim_command = 'trim_galore --fastqc --paired {} {} -o {}'
-        trim_command = trim_command.format(mate1, mate2, outplots_dir)
+def Map_Command(job):
+    """
+    Bowtie2 command of the sample (SAM output to stdout) and the reads it
+    aligns
+    """
+    mates = job.collapsed_mates if job.collapse else job.trimmed_mates
+    if job.paired:
+        map_cmd = 'bowtie2 --local --no-unal --no-discordant ' + \
+            '--no-mixed -X {} -L {} -p {} -x {} -1 {} -2 {}'
+        map_cmd = map_cmd.format(job.X, job.L, job.p, job.refgenome_basename,
+                                 mates[0], mates[1])
     else:
-        trim_command = 'trim_galore --fastqc {} -o {}'
-        trim_command = trim_command.format(mate1, outplots_dir)
-    os.system(trim_command)
+        map_cmd = 'bowtie2 --local --no-unal -L {} -p {} -x {} -U {}'
+        map_cmd = map_cmd.format(job.L, job.p, job.refgenome_basename,
+                                 mates[0])
+    return map_cmd, mates
 
-    # ----------------- Step 3: Mapping using Bowtie2 ----------------------- #
 
-    if not os.path.exists(refgenome_fasta):
-        print('Ref fasta file ' + refgenome_fasta + ' does not exist.')
-        return
-    if not os.path.exists(refgenome_basename + '.4.bt2'):
-        print('Bowtie2 indexing of ref genome has not been done yet.')
-        return
+def Align_Params(job, ref_checksum):
+    return {'paired': job.paired, 'L': str(job.L), 'X': str(job.X),
+            'ref_sha256': ref_checksum}
 
-    # TrimGalore output file names - supplied to Bowtie2
-    trimmed_mate1 = outplots_dir + sample_name + '_mate1_val_1.fq' if \
-        paired else outplots_dir + sample_name + '_trimmed.fq'
-    trimmed_mate2 = outplots_dir + sample_name + '_mate2_val_2.fq' if \
-        paired else ''
 
-    if paired:
-        map_cmd = 'bowtie2 --local --no-unal --no-discordant ' + \
-            '--no-mixed -X {} -L {} -p {} -x {} -1 {} -2 {} -S {}.sam'
-        map_cmd = map_cmd.format(X, L, p, refgenome_basename,
-                                 trimmed_mate1, trimmed_mate2,
-                                 sample_outfiles_path)
-    else:
-        map_cmd = 'bowtie2 --local --no-unal -L {} -p {} -x {} -U {} ' + \
-            '-S {}.sam'
-        map_cmd = map_cmd.format(L, p, refgenome_basename,
-                                 trimmed_mate1, sample_outfiles_path)
-    os.system(map_cmd)
-
-    # ------------- Step 4: Post-mapping QC using Picard -------------------- #
-
-    sam_filename = sample_outfiles_path + '.sam'  # Bowtie2 output
-    sortsam_filename = sample_outfiles_path + '_sorted.sam'  # Picard output
-
-    # Convert the SAM file to a BAM file
-    convert_command = 'java -jar {} SamFormatConverter I={} O={}'
-    convert_command = convert_command.format(picard_path, sam_filename,
-                                             bam_filename)
-    os.system(convert_command)
-
-    # Sort the sam file - for the sake of Picard
-    sort_command = 'java -jar {} SortSam I={} O={} SORT_ORDER=coordinate'
-    sort_command = sort_command.format(picard_path, sam_filename,
-                                       sortsam_filename)
-    os.system(sort_command)
-
-    # Collect various alignment metrics
-    metrics_cmd = 'java -jar {} CollectMultipleMetrics I={} O={} R={}'
-    metrics_cmd = metrics_cmd.format(picard_path, sortsam_filename,
-                                     sample_outplots_path, refgenome_fasta)
-    os.system(metrics_cmd)
-
-    # Collect quality yield metrics
-    qualyield_cmd = 'java -jar {} CollectQualityYieldMetrics I={} ' + \
-                    'O={}_qual_yield_metrics.txt'
-    qualyield_cmd = qualyield_cmd.format(picard_path, sortsam_filename,
-                                         sample_outplots_path)
-    os.system(qualyield_cmd)
-
-    # Delete the sorted SAM file
-    os.system('rm ' + sortsam_filename)
+def Align(job):
+    """
+    Steps 3 and 4: Mapping using Bowtie2. Its SAM output is never written
+    to disk: it is compressed into the BAM file and the alignment stats are
+    collected as it streams.
+    """
+    ref_checksum = Build_Index(job)  # Only checked if already built
+    map_cmd, mates = Map_Command(job)
+    stats_filename = job.sample_outplots_path + '_samtools_stats.txt'
+    DREEM_Status.Set_Stage('mapping_bowtie2')
+    with DREEM_Profile.Stage('mapping_bowtie2'):
+        job.run_step('bowtie2', mates, Align_Params(job, ref_checksum),
+                     lambda: Stream_Alignment(map_cmd, job.bam_filename,
+                                              stats_filename))
+
 
+def Write_Log(job):
+    """
+    Log file and metrics record of the mapping
+    """
     now = datetime.datetime.now()
     end_time = time.time()
-    time_taken = round((end_time - start_time) / 60, 2)
+    time_taken = round((end_time - job.start_time) / 60, 2)
 
     # Write input parameters to log file
-    log_file_name = sample_outplots_path + '_log.txt'
+    log_file_name = job.sample_outplots_path + '_log.txt'
     log_file = open(log_file_name, 'w')
-    log_file.write('Sample: ' + sample_name + '\n')
-    log_file.write('Reference genome: ' + refgenome_fasta + '\n')
+    log_file.write('Sample: ' + job.sample_name + '\n')
+    log_file.write('Reference genome: ' + job.refgenome_fasta + '\n')
     log_file.write('Time taken: ' + str(time_taken) + ' mins\n')
     log_file.write('Finished at: ' + now.strftime('%Y-%m-%d %H:%M') + '\n')
     log_file.close()
 
+    DREEM_Metrics.Record(job.output_dir, 'mapping', job.sample_name, {
+        'ref_name': job.ref_name,
+        'paired': job.paired,
+        'time_s': round(end_time - job.start_time, 2),
+        'input_bytes': DREEM_Metrics.File_Bytes(job.mates),
+        'bam_bytes': DREEM_Metrics.File_Bytes([job.bam_filename]),
+        'output_bytes': DREEM_Metrics.Dir_Bytes(job.outfiles_dir,
+                                                job.sample_name) +
+        DREEM_Metrics.Dir_Bytes(job.outplots_dir, job.sample_name),
+        'peak_rss_children_mb': DREEM_Metrics.Peak_Memory_MB(children=True)})
+
+
+def Map(sample_name, ref_name, paired, p, L, X, input_dir, output_dir,
+        collapse=False, QSCORE_CUTOFF=20):
+    """
+    Perform QC, trimming and mapping for a given sample. With collapse,
+    identical reads are aligned once (bases compared at QSCORE_CUTOFF).
+    """
+    job = Mapping_Job(sample_name, ref_name, paired, p, L, X, input_dir,
+                      output_dir, collapse, QSCORE_CUTOFF)
+    Check_Inputs(job)
+    for mate_index in range(len(job.mates)):
+        FastQC(job, mate_index)
+    Trim(job)
+    if collapse:
+        Collapse(job)
+    Align(job)
+    Write_Log(job)
     print('Finished mapping.')
 
 
+class SamQueue():
+    """
+    Bounded queue of the SAM output of the aligner, read as lines like a
+    file (the input of BitVector.Process_SamFile). The aligner waits when
+    the reader is max_chunks behind. The writer ends it with finish(), with
+    the error of the alignment if it failed; the reader stops the writer
+    with close().
+    """
+    def __init__(self, max_chunks=16):
+        self.chunks = queue.Queue(max_chunks)
+        self.lines = iter(())  # Lines of the chunk being read
+        self.rest = b''  # Start of a line cut by the end of a chunk
+        self.closed, self.done = False, False
+        self.error = None
+
+    def put(self, chunk):
+        """
+        Add a chunk (None: end). False if the reader is gone.
+        """
+        while not self.closed:
+            try:
+                self.chunks.put(chunk, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def finish(self, error=None):
+        self.error = error
+        self.put(None)
+
+    def close(self):
+        self.closed = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        for line in self.lines:
+            return line
+        while not self.done:
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.done = True
+                if self.error is not None:
+                    raise self.error
+                if self.rest:  # No newline at the end
+                    return self.rest.decode()
+                break
+            chunk = self.rest + chunk
+            cut = chunk.rfind(b'\n') + 1
+            self.rest = chunk[cut:]
+            if cut:
+                self.lines = iter(chunk[:cut].decode().splitlines(True))
+                return next(self.lines)
+        raise StopIteration
+
+    def readline(self):
+        return next(self, '')
+
+
+class Alignment_Stream(threading.Thread):
+    """
+    Alignment of a sample in a thread, its SAM output going to sam_queue
+    (and to the BAM file with keep_bam)
+    """
+    def __init__(self, job, keep_bam, ref_checksum):
+        threading.Thread.__init__(self, daemon=True)
+        self.job, self.keep_bam = job, keep_bam
+        self.ref_checksum = ref_checksum
+        self.sam_queue = SamQueue()
+        self.error = None
+
+    def run(self):
+        job = self.job
+        try:
+            map_cmd, mates = Map_Command(job)
+            stats_filename = job.sample_outplots_path + '_samtools_stats.txt'
+            DREEM_Status.Set_Stage('mapping_bowtie2')
+            with DREEM_Profile.Stage('mapping_bowtie2'):
+                outputs = Stream_Alignment(
+                    map_cmd, job.bam_filename if self.keep_bam else None,
+                    stats_filename, sam_queue=self.sam_queue)
+            if self.keep_bam:
+                with manifest_lock:
+                    Record_Step(job.manifest_file, job.manifest, 'bowtie2',
+                                [DREEM_Shared.File_Info(mate)
+                                 for mate in mates],
+                                Align_Params(job, self.ref_checksum),
+                                outputs)
+            Write_Log(job)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.sam_queue.finish(self.error)
+
+    def wait(self):
+        """
+        Wait for the end of the alignment. Its error is raised, unless the
+        reader stopped before the end of the stream.
+        """
+        self.sam_queue.close()
+        self.join()
+        if self.error is not None and self.sam_queue.done:
+            raise self.error
+
+
+def Map_Stream(sample_name, ref_name, paired, p, L, X, input_dir, output_dir,
+               keep_bam=False, collapse=False, QSCORE_CUTOFF=20):
+    """
+    Perform QC and trimming for a given sample, then start its alignment in
+    a thread and return it (an Alignment_Stream). Its SAM output is read
+    from sam_queue as the aligner writes it, and the BAM file is only
+    written with keep_bam.
+    """
+    job = Mapping_Job(sample_name, ref_name, paired, p, L, X, input_dir,
+                      output_dir, collapse, QSCORE_CUTOFF)
+    Check_Inputs(job)
+    for mate_index in range(len(job.mates)):
+        FastQC(job, mate_index)
+    Trim(job)
+    if collapse:
+        Collapse(job)
+    stream = Alignment_Stream(job, keep_bam, Build_Index(job))
+    stream.start()
+    return stream
+
+
+def Map_Shared(sample_name, ref_name, paired, p, L, X, input_dir, output_dir,
+               shared_dir, collapse=False, QSCORE_CUTOFF=20):
+    """
+    Map a sample once for all its window tasks. The first task maps it in
+    shared_dir under a lock and the others wait for it, then reuse the BAM
+    file, which is linked into the Mapping_Files dir of output_dir.
+    """
+    shared_dir = os.path.join(shared_dir, '')
+    if not os.path.exists(shared_dir):
+        os.makedirs(shared_dir)
+    file_name = sample_name + '_' + ref_name + '.bam'
+    shared_bam = shared_dir + 'Mapping_Files/' + file_name
+    fastq_files = [input_dir + sample_name + '_mate1.fastq',
+                   input_dir + sample_name + '_mate2.fastq'] if paired else \
+        [input_dir + sample_name + '.fastq']
+    for fastq_file in fastq_files:
+        if not os.path.exists(fastq_file):
+            raise FileNotFoundError('FastQ file ' + fastq_file +
+                                    ' does not exist.')
+    refgenome_basename = input_dir + ref_name
+    ref_checksum = DREEM_Shared.Build_Index(refgenome_basename + '.fasta',
+                                            refgenome_basename)
+    inputs = {'fastq': [DREEM_Shared.File_Info(fastq_file)
+                        for fastq_file in fastq_files],
+              'ref_sha256': ref_checksum,
+              'paired': paired, 'L': str(L), 'X': str(X),
+              'collapse': collapse, 'QSCORE_CUTOFF': QSCORE_CUTOFF}
+
+    marker_file = shared_dir + sample_name + '_' + ref_name + '_mapped.json'
+    with DREEM_Shared.File_Lock(shared_dir + sample_name + '_' + ref_name +
+                                '_mapping.lock'):
+        if DREEM_Shared.Is_Done(marker_file, inputs) and \
+                os.path.exists(shared_bam):
+            print('Reusing the alignment in', shared_bam)
+        else:
+            Map(sample_name, ref_name, paired, p, L, X, input_dir,
+                shared_dir, collapse, QSCORE_CUTOFF)
+            DREEM_Shared.Mark_Done(marker_file, inputs)
+    DREEM_Shared.Link_File(shared_bam, os.path.join(output_dir,
+                                                    'Mapping_Files',
+                                                    file_name))
+
+
+def Read_Manifest(manifest_file):
+    """
+    Steps done by earlier runs. Format: manifest[step] = {'inputs',
+    'params', 'outputs', 'finished'}, files as [path, size, mtime]
+    """
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        try:
+            return json.load(f)
+        except ValueError:  # Unreadable: redo everything
+            return {}
+
+
+def Run_Step(manifest_file, manifest, step, inputs, params, run):
+    """
+    Do a step of the mapping unless the manifest has it done with the same
+    inputs and params, and its outputs are still there unchanged. run()
+    does the step and returns its output files. The step is recorded in
+    the manifest only once all its outputs are in place.
+    """
+    inputs = [DREEM_Shared.File_Info(f) for f in inputs if f]
+    done = manifest.get(step)
+    if done is not None and done['inputs'] == inputs and \
+            done['params'] == params and \
+            all(os.path.exists(output[0]) and
+                DREEM_Shared.File_Info(output[0]) == output
+                for output in done['outputs']):
+        print('Skipping {}: up to date'.format(step))
+        return
+    with manifest_lock:
+        manifest.pop(step, None)
+    outputs = run()
+    with manifest_lock:  # Steps of a sample can run in threads
+        Record_Step(manifest_file, manifest, step, inputs, params, outputs)
+
+
+def Record_Step(manifest_file, manifest, step, inputs, params, outputs):
+    """
+    Record a finished step in the manifest (inputs as [path, size, mtime])
+    """
+    manifest[step] = {'inputs': inputs, 'params': params,
+                      'outputs': [DREEM_Shared.File_Info(f)
+                                  for f in outputs],
+                      'finished': datetime.datetime.now().strftime(
+                          '%Y-%m-%d %H:%M:%S')}
+    DREEM_Shared.Write_Atomic(manifest_file, json.dumps(
+        manifest, indent=4, sort_keys=True))
+
+
+def Run_InTempDir(cmd, out_dir, step):
+    """
+    Run a command writing to a temp dir (cmd has {} for it), then move its
+    outputs into out_dir. Returns the paths of the outputs.
+    """
+    tmp_dir = os.path.join(out_dir, '.' + step + '_tmp', '')
+    if os.path.exists(tmp_dir):  # Left by a failed run
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    subprocess.check_call(cmd.format(tmp_dir), shell=True)
+    outputs = []
+    for name in sorted(os.listdir(tmp_dir)):
+        output = os.path.join(out_dir, name)
+        if os.path.isdir(output) and not os.path.islink(output):
+            shutil.rmtree(output)
+        os.replace(tmp_dir + name, output)
+        outputs.append(output)
+    os.rmdir(tmp_dir)
+    return outputs
+
+
+def Stream_Alignment(map_cmd, bam_filename, stats_filename,
+                     chunk_size=1 << 20, sam_queue=None):
+    """
+    Run the aligner and stream its SAM output to samtools view (BAM file)
+    and to samtools stats in one pass. Both are written to temp files that
+    are renamed once all the commands have succeeded, so a failed run
+    leaves no partial BAM file behind. With sam_queue, the stream is also
+    put in it, and bam_filename can be None for no BAM file. Returns the
+    BAM and stats files.
+    """
+    tmp_bam = bam_filename + '.tmp' if bam_filename else None
+    tmp_stats = stats_filename + '.tmp'
+    stats_fileobj = open(tmp_stats, 'wb')
+    aligner = subprocess.Popen(map_cmd, shell=True, stdout=subprocess.PIPE)
+    procs = []
+    if bam_filename:
+        procs.append((subprocess.Popen(['samtools', 'view', '-b', '-o',
+                                        tmp_bam, '-'],
+                                       stdin=subprocess.PIPE),
+                      'samtools view'))
+    procs.append((subprocess.Popen(['samtools', 'stats', '-'],
+                                   stdin=subprocess.PIPE,
+                                   stdout=stats_fileobj), 'samtools stats'))
+    try:
+        while True:  # Tee of the SAM stream
+            chunk = aligner.stdout.read(chunk_size)
+            if not chunk:
+                break
+            for proc, cmd in procs:
+                proc.stdin.write(chunk)
+            if sam_queue is not None and not sam_queue.put(chunk):
+                break  # Reader gone: the aligner fails on the closed pipe
+    except BrokenPipeError:  # samtools failed, reported below
+        pass
+    for proc, cmd in procs:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    aligner.stdout.close()
+    returncodes = [(aligner.wait(), map_cmd)] + \
+        [(proc.wait(), cmd) for proc, cmd in procs]
+    stats_fileobj.close()
+    for returncode, cmd in returncodes:
+        if returncode != 0:
+            for tmp_file in (tmp_bam, tmp_stats):
+                if tmp_file and os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+            raise subprocess.CalledProcessError(returncode, cmd)
+    os.replace(tmp_stats, stats_filename)
+    if not bam_filename:
+        return [stats_filename]
+    os.replace(tmp_bam, bam_filename)
+    return [bam_filename, stats_filename]
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Align a FASTQ file to a ' +
                                      'reference genome')
@@ -165,7 +570,15 @@ if __name__ == '__main__':
     parser.add_argument('X', help='Max frag length for valid paired-end align')
     parser.add_argument('input_dir', help='Directory with input files')
     parser.add_argument('output_dir', help='Directory with output files')
-    parser.add_argument('picard_path', help='Path to Picard jar file')
+    parser.add_argument('--shared_dir',
+                        help='Map the sample once in this dir, shared by ' +
+                        'all its window tasks')
+    parser.add_argument('--collapse', action='store_true',
+                        help='Align identical reads only once')
+    parser.add_argument('--qscore_cutoff', type=int, default=20,
+                        help='Qscore cutoff of Bit Vector, for --collapse')
+    parser.add_argument('--status_port', type=int,
+                        help='Serve the job status on 127.0.0.1:PORT')
     args = parser.parse_args()
     sample_name = args.sample_name
     ref_name = args.ref_name
@@ -175,22 +588,19 @@ if __name__ == '__main__':
     X = args.X
     input_dir = args.input_dir
     output_dir = args.output_dir
-    picard_path = args.picard_path
 
     paired = True if paired == 'True' else False
 
-    # Specify reference genome index files base name and fasta file
-    # Index files (in same folder as the fasta file) are created by running:
-    # $bowtie2-build 'refgenome.fasta' 'refgenome'
-    refgenome_basename = input_dir + ref_name
-    refgenome_fasta = refgenome_basename + '.fasta'  # Add extension
-
-    # Output directories
-    outfiles_dir = output_dir + '/Mapping_Files/'
-    outplots_dir = output_dir + '/Mapping_Plots/'
-    if not os.path.exists(outfiles_dir):
-        os.makedirs(outfiles_dir)
-    if not os.path.exists(outplots_dir):
-        os.makedirs(outplots_dir)
-
-    Map()
+    DREEM_Status.Enable(output_dir, sample_name, args.status_port)
+    try:
+        if args.shared_dir:
+            Map_Shared(sample_name, ref_name, paired, p, L, X, input_dir,
+                       output_dir, args.shared_dir, args.collapse,
+                       args.qscore_cutoff)
+        else:
+            Map(sample_name, ref_name, paired, p, L, X, input_dir,
+                output_dir, args.collapse, args.qscore_cutoff)
+    except BaseException:
+        DREEM_Status.Finish('failed')
+        raise
+    DREEM_Status.Finish('done')
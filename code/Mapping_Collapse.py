@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+# Copyright (c) <2019> <The Whitehead Institute for Biomedical Research>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Collapse identical reads (or read pairs) of trimmed FASTQ files before
+alignment.
+
+Reads with the same sequence on both mates, and the same bases passing the
+Q score cutoff, give the same bit vector. They are written once, with the
+name and qualities of their first occurrence and the number of reads as a
+';size=N' suffix of the name. Bowtie2 keeps the name, and Bit Vector and EM
+Clustering count the read N times (see BitVector_Functions.Read_Weight),
+only when told the reads were collapsed: upstream names may carry ';size='
+as well.
+"""
+import os
+import re
+
+weight_tag = ';size='
+weight_pattern = re.compile(re.escape(weight_tag) + r'(\d+)$')  # N at the end
+header_flag = 'collapsed'  # Field of the bit vector file header
+phred_offset = 33  # ASCII+33 encoding of Phred quality scores
+
+
+def Qual_Table(qscore_cutoff):
+    """
+    str.translate table: quality symbol -> 1 if it passes the cutoff else 0
+    """
+    return {code: '1' if code - phred_offset >= qscore_cutoff else '0'
+            for code in range(phred_offset, 127)}
+
+
+def Read_Fastq(fastq_fileobj):
+    """
+    Name, sequence and qualities of each read of a FASTQ file
+    """
+    for header, seq, plus, qual in zip(*[fastq_fileobj] * 4):
+        name = header.split()[0][1:]
+        if name.endswith('/1') or name.endswith('/2'):  # Mate suffix
+            name = name[:-2]
+        yield name, seq.rstrip('\n'), qual.rstrip('\n')
+
+
+def Collapse_Reads(fastq_files, out_files, qscore_cutoff):
+    """
+    Write the distinct reads of fastq_files (1 file, or the 2 mates) to
+    out_files, with their counts. Returns the number of reads and of
+    distinct reads.
+    """
+    table = Qual_Table(qscore_cutoff)
+    fastq_fileobjs = [open(fastq_file) for fastq_file in fastq_files]
+    reads = {}  # reads[key] = [count, name, quals of the mates]
+    n_reads = 0
+    for mates in zip(*[Read_Fastq(f) for f in fastq_fileobjs]):
+        n_reads += 1
+        key = '\t'.join([seq for (name, seq, qual) in mates] +
+                        [qual.translate(table) for (name, seq, qual) in
+                         mates])
+        read = reads.get(key)
+        if read is None:
+            reads[key] = [1, mates[0][0]] + [qual for (name, seq, qual) in
+                                             mates]
+        else:
+            read[0] += 1
+    for f in fastq_fileobjs:
+        f.close()
+
+    for mate_index, out_file in enumerate(out_files):
+        with open(out_file + '.tmp', 'w') as out_fileobj:
+            for key, read in reads.items():
+                seq = key.split('\t')[mate_index]
+                out_fileobj.write('@{}{}{}\n{}\n+\n{}\n'.format(
+                    read[1], weight_tag, read[0], seq, read[2 + mate_index]))
+    for out_file in out_files:
+        os.replace(out_file + '.tmp', out_file)
+    return n_reads, len(reads)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+# Copyright (c) <2019> <The Whitehead Institute for Biomedical Research>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Mapping of many samples from a sample sheet, as one graph of tasks.
+
+The steps of Mapping.py (FastQC of each mate, TrimGalore, collapsing and
+Bowtie2) are tasks of DREEM_Scheduler, run under a global CPU budget. A
+Bowtie2 task takes --threads CPUs and runs Bowtie2 with as many threads;
+the other steps are mostly I/O and take one CPU, so the QC and trimming of
+a sample overlap the alignment of another. The index of each reference is
+built once, before the alignments to it. The time of every step is written
+to the metrics file of its sample.
+
+Sample sheet (tab-separated, with a header line):
+    sample_name ref_name paired input_dir output_dir
+"""
+import os
+import sys
+import csv
+import time
+import argparse
+from functools import partial
+import DREEM_Metrics
+import DREEM_Scheduler
+import Mapping
+
+sheet_cols = ['sample_name', 'ref_name', 'paired', 'input_dir',
+              'output_dir']
+
+
+def Read_SampleSheet(sheet_file):
+    """
+    Rows of the sample sheet, as dicts
+    """
+    with open(sheet_file) as f:
+        rows = [row for row in csv.DictReader(f, delimiter='\t')
+                if any(row.values())]
+    for row in rows:
+        missing = [col for col in sheet_cols if not row.get(col)]
+        if missing:
+            raise ValueError('Sample sheet {}: no {} for {}'.format(
+                sheet_file, ', '.join(missing), row))
+        row['paired'] = row['paired'] == 'True'
+        row['input_dir'] = os.path.join(row['input_dir'], '')
+    return rows
+
+
+def Mapping_Tasks(rows, threads, L, X, collapse, QSCORE_CUTOFF):
+    """
+    Tasks of the mapping of all the samples. Returns the tasks and the
+    job of each sample.
+    """
+    index_tasks, jobs = {}, []
+    align_tasks, other_tasks = [], []
+    for row in rows:
+        job = Mapping.Mapping_Job(row['sample_name'], row['ref_name'],
+                                  row['paired'], threads, L, X,
+                                  row['input_dir'], row['output_dir'],
+                                  collapse, QSCORE_CUTOFF)
+        Mapping.Check_Inputs(job)
+        jobs.append(job)
+        name = job.sample_name + '_' + job.ref_name
+
+        # One index per reference, shared by the samples
+        if job.refgenome_basename not in index_tasks:
+            index_tasks[job.refgenome_basename] = DREEM_Scheduler.Task(
+                job.ref_name + '_index', partial(Mapping.Build_Index, job))
+        index_task = index_tasks[job.refgenome_basename]
+
+        qc_tasks = [DREEM_Scheduler.Task('{}_fastqc_{}'.format(
+            name, mate_index + 1), partial(Mapping.FastQC, job, mate_index))
+            for mate_index in range(len(job.mates))]
+        trim_task = DREEM_Scheduler.Task(name + '_trim',
+                                         partial(Mapping.Trim, job))
+        reads_task = trim_task
+        if collapse:
+            reads_task = DREEM_Scheduler.Task(name + '_collapse',
+                                              partial(Mapping.Collapse, job),
+                                              deps=[trim_task])
+            other_tasks.append(reads_task)
+        align_task = DREEM_Scheduler.Task(name + '_bowtie2',
+                                          partial(Mapping.Align, job),
+                                          deps=[reads_task, index_task],
+                                          cpus=threads)
+        # Log once the sample is done, QC included
+        log_task = DREEM_Scheduler.Task(name + '_log',
+                                        partial(Mapping.Write_Log, job),
+                                        deps=qc_tasks + [align_task])
+        job.tasks = qc_tasks + [trim_task, reads_task, align_task, log_task]
+        align_tasks.append(align_task)
+        other_tasks += qc_tasks + [trim_task, log_task]
+
+    # Ready alignments are started first and keep the CPUs they wait for
+    tasks = list(index_tasks.values()) + align_tasks + other_tasks
+    return tasks, jobs
+
+
+def Record_Timings(jobs, start_time):
+    """
+    Write the time of each step to the metrics file of its sample and
+    print them
+    """
+    for job in jobs:
+        for task in sorted(set(job.tasks), key=lambda task: task.name):
+            if task.start_time is None:
+                continue
+            step = task.name[len(job.sample_name + '_' + job.ref_name) + 1:]
+            time_s = round(task.end_time - task.start_time, 2) if \
+                task.end_time is not None else None
+            DREEM_Metrics.Record(job.output_dir, 'mapping_step',
+                                 job.sample_name, {
+                                     'ref_name': job.ref_name,
+                                     'step': step,
+                                     'status': task.status,
+                                     'cpus': task.cpus,
+                                     'queued_s': round(
+                                         task.start_time - start_time, 2),
+                                     'time_s': time_s})
+            print('{}\t{}\t{}\t{}'.format(job.sample_name, step,
+                                          task.status, time_s))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Map the samples of a ' +
+                                     'sample sheet under a CPU budget')
+    parser.add_argument('sample_sheet', help='Tab-separated sample sheet')
+    parser.add_argument('--cpus', type=int, default=os.cpu_count(),
+                        help='CPUs for all the steps together')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='Bowtie2 threads (CPUs) of each alignment')
+    parser.add_argument('--L', default='12', help='Seed length for Bowtie2')
+    parser.add_argument('--X', default='1000',
+                        help='Max frag length for valid paired-end align')
+    parser.add_argument('--collapse', action='store_true',
+                        help='Align identical reads only once')
+    parser.add_argument('--qscore_cutoff', type=int, default=20,
+                        help='Qscore cutoff of Bit Vector, for --collapse')
+    args = parser.parse_args()
+
+    threads = min(args.threads, args.cpus)
+    tasks, jobs = Mapping_Tasks(Read_SampleSheet(args.sample_sheet), threads,
+                                args.L, args.X, args.collapse,
+                                args.qscore_cutoff)
+    start_time = time.time()
+    ok = DREEM_Scheduler.Run_Tasks(tasks, args.cpus, backfill=False)
+    Record_Timings(jobs, start_time)
+    print('Finished mapping in {} mins.'.format(
+        round((time.time() - start_time) / 60, 2)))
+    if not ok:
+        sys.exit(1)
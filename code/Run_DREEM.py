@@ -19,7 +19,7 @@ Wrapper script for the 2 parts of the DREEM pipeline:
 Step 1: Bit Vector
 Step 2: EM Clustering
 
-The 2 steps are run sequentially.
+The 2 steps are run sequentially, in this process.
 Mapping is done prior to Bit Vector if needed.
 
 This version of the pipeline is designed to be run on a local machine.
@@ -27,34 +27,65 @@ This version of the pipeline is designed to be run on a local machine.
 import os
 import argparse
 import time
-
-
-def Run_DREEM():
+import Mapping
+import BitVector
+import BitVector_Functions
+import EM_Clustering
+import EM_ControlStore
+import DREEM_Profile
+import DREEM_Status
+
+
+def Run_DREEM(input_dir, output_dir, sample_name, ref_name, START, END,
+              paired, struct, fastq, ctrl, ctrl_store, stats_only, bv_files,
+              picard_path, CPUS, L, X, qscore_file, SUR_BASES, QSCORE_CUTOFF,
+              MIN_ITS, INFO_THRESH, CONV_CUTOFF, NUM_RUNS, MAX_K, SIG_THRESH,
+              NORM_PERC_BASES, exc_AC, mem_cap_mb=0, shared_dir='',
+              collapse=False, stream=False, keep_bam=False):
     """
+    Run the steps in this process. The bit vectors are handed from Bit Vector
+    to EM Clustering in memory. A failing step raises an exception.
+    With shared_dir, the sample is mapped once there for all the windows.
+    With collapse, identical reads are aligned once and counted N times.
+    With stream, Bit Vector reads the SAM output of the aligner as it is
+    written, and the BAM file is only written too with keep_bam.
     """
     start_time = time.time()
 
-    map_cmd = 'python3 Mapping.py {} {} {} {} {} {} {} {} {}'
-    map_cmd = map_cmd.format(sample_name, ref_name, paired,
-                             CPUS, L, X, input_dir, output_dir, picard_path)
-    bv_cmd = 'python3 BitVector.py {} {} {} {} {} {} {} {} {} {} {} {}'
-    bv_cmd = bv_cmd.format(sample_name, ref_name, START, END, SUR_BASES,
-                           qscore_file, QSCORE_CUTOFF, input_dir, output_dir,
-                           paired, picard_path, fastq)
-    cluster_cmd = 'python3 EM_Clustering.py {} {} {} {} {} {} {} {} {} {} ' + \
-                  '{} {} {} {} {} {} {}'
-    cluster_cmd = cluster_cmd.format(sample_name, ref_name, START, END,
-                                     MIN_ITS, INFO_THRESH, CONV_CUTOFF,
-                                     NUM_RUNS, MAX_K, CPUS, NORM_PERC_BASES,
-                                     exc_AC, SIG_THRESH, struct, input_dir,
-                                     output_dir, ctrl)
+    ref_file = input_dir + ref_name + '.fasta'
+    refs_seq = BitVector_Functions.Parse_FastaFile(ref_file)  # Ref seqs
 
     # Check if FASTQ option was specified. If so, run mapping
-    if fastq:
-        os.system(map_cmd)
-
-    os.system(bv_cmd)
-    os.system(cluster_cmd)
+    alignment = None
+    if fastq and stream:
+        alignment = Mapping.Map_Stream(sample_name, ref_name, paired, CPUS,
+                                       L, X, input_dir, output_dir, keep_bam,
+                                       collapse, QSCORE_CUTOFF)
+    elif fastq and shared_dir:
+        Mapping.Map_Shared(sample_name, ref_name, paired, CPUS, L, X,
+                           input_dir, output_dir, shared_dir, collapse,
+                           QSCORE_CUTOFF)
+    elif fastq:
+        Mapping.Map(sample_name, ref_name, paired, CPUS, L, X, input_dir,
+                    output_dir, collapse, QSCORE_CUTOFF)
+
+    try:
+        sinks = BitVector.Bit_Vectors(
+            sample_name, ref_name, refs_seq, START, END, SUR_BASES,
+            qscore_file, QSCORE_CUTOFF, input_dir, output_dir, paired,
+            picard_path, fastq, bv_files, keep=True,
+            sam_stream=alignment.sam_queue if alignment else None,
+            collapse=collapse)
+    finally:
+        if alignment is not None:
+            alignment.wait()
+
+    EM_Clustering.EM_Clustering(sample_name, refs_seq, START, END, MIN_ITS,
+                                INFO_THRESH, CONV_CUTOFF, NUM_RUNS, MAX_K,
+                                CPUS, NORM_PERC_BASES, str(exc_AC),
+                                SIG_THRESH, str(struct), input_dir,
+                                output_dir, str(ctrl), ctrl_store, stats_only,
+                                sinks, mem_cap_mb)
 
     end_time = time.time()
     time_taken = round((end_time - start_time) / 60, 2)
@@ -78,6 +109,32 @@ if __name__ == '__main__':
                         action='store_true')
     parser.add_argument('--ctrl', help='Control sample',
                         action='store_true')
+    parser.add_argument('--ctrl_store', default='',
+                        help='Control group stats store. Default for a ' +
+                        'control sample: <sample>_control_stats.bin in ' +
+                        'the parent dir of output_dir')
+    parser.add_argument('--stats_only', action='store_true',
+                        help='Control sample: only record stats, no EM')
+    parser.add_argument('--no_bv_files', action='store_true',
+                        help='Do not write the bit vector text files')
+    parser.add_argument('--profile', nargs='?', const='timers',
+                        choices=DREEM_Profile.modes,
+                        help='Profile the stages (default mode: timers)')
+    parser.add_argument('--status_port', type=int,
+                        help='Serve the job status on 127.0.0.1:PORT')
+    parser.add_argument('--mem_cap_mb', type=float, default=0,
+                        help='Memory cap of the job in MB, to plan the EM')
+    parser.add_argument('--shared_dir', default='',
+                        help='With --fastq: map the sample once in this ' +
+                        'dir, shared by all its window tasks')
+    parser.add_argument('--collapse', action='store_true',
+                        help='Align identical reads once (with --fastq) ' +
+                        'and count them as many times as they occur')
+    parser.add_argument('--stream', action='store_true',
+                        help='With --fastq: make the bit vectors from the ' +
+                        'aligner output as it is written')
+    parser.add_argument('--keep_bam', action='store_true',
+                        help='With --stream: also write the BAM file')
     args = parser.parse_args()
     input_dir = args.input_dir
     output_dir = args.output_dir
@@ -89,6 +146,9 @@ if __name__ == '__main__':
     struct = args.struct
     fastq = args.fastq
     ctrl = args.ctrl
+    ctrl_store = args.ctrl_store
+    stats_only = args.stats_only
+    bv_files = not args.no_bv_files
 
     # ----- Inputs not specified by the user. Modify these as needed. ------- #
 
@@ -123,4 +183,31 @@ if __name__ == '__main__':
 
     paired = False if single else True
 
-    Run_DREEM()
+    if args.stream and not fastq:
+        parser.error('--stream needs --fastq')
+    if args.stream and args.shared_dir:
+        parser.error('--stream maps in this job: no --shared_dir')
+
+    if not ctrl_store:
+        if not ctrl:
+            parser.error('--ctrl_store is needed for an experimental sample')
+        ctrl_store = EM_ControlStore.Default_Store(output_dir, sample_name)
+
+    DREEM_Status.Enable(output_dir, sample_name, args.status_port)
+    if args.profile:
+        DREEM_Profile.Enable(args.profile)
+    try:
+        Run_DREEM(input_dir, output_dir, sample_name, ref_name, START, END,
+                  paired, struct, fastq, ctrl, ctrl_store, stats_only,
+                  bv_files, picard_path, CPUS, L, X, qscore_file, SUR_BASES,
+                  QSCORE_CUTOFF, MIN_ITS, INFO_THRESH, CONV_CUTOFF, NUM_RUNS,
+                  MAX_K, SIG_THRESH, NORM_PERC_BASES, exc_AC,
+                  args.mem_cap_mb, args.shared_dir, args.collapse,
+                  args.stream, args.keep_bam)
+    except BaseException:
+        DREEM_Status.Finish('failed')
+        raise
+    else:
+        DREEM_Status.Finish('done')
+    finally:
+        DREEM_Profile.Write(output_dir)
@@ -13,22 +13,87 @@ Created on Tue Jul 30 2019
 
 @author: harish
 """
-import EM_Files
+import time
+import multiprocessing
+import numpy as np
 from EM_Algorithm import Run_EM
+import EM_Class
 import EM_Plots
+import DREEM_Profile
+import DREEM_Status
 import sys
 sys.setrecursionlimit(10000)
 
+shared_X = None  # X of the parallel runs, inherited by the workers
+
 
 def Run_EMJob(X, bvfile_basename, MIN_ITS, INFO_THRESH, CONV_CUTOFF,
-              SIG_THRESH, outplot_dir, K, CPUS, run):
+              SIG_THRESH, outplot_dir, K, CPUS, run, block_rows=None):
 
     if K == 1:
         EM_Plots.NumReads_File(bvfile_basename, X, outplot_dir)
 
-    EM_res = Run_EM(X, K, MIN_ITS, CONV_CUTOFF, CPUS)
+    with DREEM_Profile.Stage('em_run'):
+        EM_res = Run_EM(X, K, MIN_ITS, CONV_CUTOFF, CPUS, block_rows)
     log_like_list, final_mu, final_obs_pi, final_real_pi, resps, BIC = EM_res
 
-    EM_Plots.Run_Plots(bvfile_basename, X, K, log_like_list, final_mu,
-                       final_obs_pi, final_real_pi, resps, BIC, outplot_dir,
-                       run)
+    with DREEM_Profile.Stage('em_run_plots'):
+        run_dir = EM_Plots.Run_Plots(bvfile_basename, X, K, log_like_list,
+                                     final_mu, final_obs_pi, final_real_pi,
+                                     resps, BIC, outplot_dir, run)
+
+    return EM_Class.EM_Run(K, run, log_like_list, final_mu, final_obs_pi,
+                           final_real_pi, BIC, run_dir)
+
+
+def Run_SharedEMJob(seed, bvfile_basename, MIN_ITS, INFO_THRESH, CONV_CUTOFF,
+                    SIG_THRESH, outplot_dir, K, CPUS, run, block_rows):
+    """
+    An EM run in a worker process, on shared_X. Returns the run and its
+    time in seconds.
+    """
+    np.random.seed(seed)  # Forked workers share the random state
+    start_time = time.time()
+    em_run = Run_EMJob(shared_X, bvfile_basename, MIN_ITS, INFO_THRESH,
+                       CONV_CUTOFF, SIG_THRESH, outplot_dir, K, CPUS, run,
+                       block_rows)
+    return em_run, time.time() - start_time
+
+
+def Init_Worker():
+    """
+    A forked worker leaves the status file and the profiling to the
+    parent: a lock held by a thread of the parent at fork time (status
+    server, sampler) would never be released in the worker, and the stage
+    times of the worker would not reach the profile anyway.
+    """
+    DREEM_Status.enabled = False
+    if DREEM_Profile.profiler is not None:
+        DREEM_Profile.profiler.disable()
+    DREEM_Profile.enabled = False
+
+
+def Run_EMJobs_Parallel(X, bvfile_basename, MIN_ITS, INFO_THRESH,
+                        CONV_CUTOFF, SIG_THRESH, outplot_dir, K, CPUS, runs,
+                        block_rows, workers):
+    """
+    EM runs in workers processes, CPUS threads each. X is shared with the
+    workers by fork instead of being pickled for every run. The seeds of
+    the runs are drawn from the random state of this process.
+    """
+    global shared_X
+    shared_X = X
+    seeds = np.random.randint(2 ** 31 - 1, size=len(runs))
+    job_args = [(int(seed), bvfile_basename, MIN_ITS, INFO_THRESH,
+                 CONV_CUTOFF, SIG_THRESH, outplot_dir, K, CPUS, run,
+                 block_rows) for (seed, run) in zip(seeds, runs)]
+    pool = multiprocessing.get_context('fork').Pool(workers,
+                                                    initializer=Init_Worker)
+    try:
+        results = pool.starmap(Run_SharedEMJob, job_args)
+    finally:
+        pool.close()
+        pool.join()
+        shared_X = None
+    return results
+